@@ -0,0 +1,55 @@
+"""
+Shared synthetic data of the benchmarks, generated once per session. Set V3DPY_BENCH_SCALE to grow or shrink the
+volumes along each axis and the trees by node count, e.g. V3DPY_BENCH_SCALE=2 gives 8x the voxels.
+"""
+
+import os
+import pytest
+import numpy as np
+from synthetic import random_tree, neuron_volume
+from v3dpy.terafly import write_terafly
+
+SCALE = float(os.environ.get('V3DPY_BENCH_SCALE', 1))
+VOLUME_SHAPE = tuple(int(s * SCALE) for s in (128, 512, 512))
+TILE_SHAPE = (64, 128, 128)
+TREE_NODES = int(100000 * SCALE)
+VOLUME_TREE_NODES = int(5000 * SCALE)
+
+
+@pytest.fixture(scope='session')
+def volume_tree():
+    """the tree the volumes are rendered from"""
+    return random_tree(VOLUME_TREE_NODES, VOLUME_SHAPE, seed=0)
+
+
+@pytest.fixture(scope='session', params=['uint8', 'uint16'])
+def volume(request, volume_tree):
+    return neuron_volume(VOLUME_SHAPE, request.param, seed=0, tree=volume_tree)
+
+
+@pytest.fixture(scope='session')
+def volume8(volume_tree):
+    return neuron_volume(VOLUME_SHAPE, np.uint8, seed=0, tree=volume_tree)
+
+
+@pytest.fixture(scope='session')
+def tree():
+    """a large tree for the swc operations"""
+    return random_tree(TREE_NODES, tuple(s * 4 for s in VOLUME_SHAPE), seed=1)
+
+
+@pytest.fixture(scope='session')
+def terafly_dir(tmp_path_factory, volume8):
+    return write_terafly(volume8, tmp_path_factory.mktemp('terafly'), TILE_SHAPE, n_levels=1, compression='none')[0]
+
+
+def throughput(benchmark, unit, amount):
+    """
+    record the throughput of a benchmark from its mean time into the report, skipped if benchmarking is disabled.
+
+    :param benchmark: the benchmark fixture that has been run
+    :param unit: the name of the throughput, e.g. 'MB/s'
+    :param amount: the amount processed in a round, e.g. in MB
+    """
+    if benchmark.stats is not None:
+        benchmark.extra_info[unit] = amount / benchmark.stats.stats.mean
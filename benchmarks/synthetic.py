@@ -0,0 +1,68 @@
+"""
+Deterministic synthetic data for the benchmarks: random neuron trees and sparse neuron-like volumes rendered from
+them. The same seed always gives the same data.
+"""
+
+import numpy as np
+from v3dpy.neuron_utilities.rasterize import rasterize_neuron
+
+
+def random_tree(n_nodes, shape=(256, 1024, 1024), seed=0, step=2., branch_len=(20, 200)):
+    """
+    a random neuron-like tree of random walk branches growing from a soma at the center of the box. Each new
+    branch starts from a random node grown so far.
+
+    :param n_nodes: the number of nodes
+    :param shape: the box the nodes are reflected into (Z, Y, X)
+    :param seed: the random seed
+    :param step: the distance between a node and its parent
+    :param branch_len: the range of the number of nodes in a branch
+    :return: list of swc nodes
+    """
+    rng = np.random.default_rng(seed)
+    box = np.array(shape[::-1], dtype=np.float64) - 1
+    xyz = np.empty((n_nodes, 3), dtype=np.float64)
+    parent = np.empty(n_nodes, dtype=np.int64)
+    xyz[0] = box / 2
+    parent[0] = -1
+    i = 1
+    while i < n_nodes:
+        n = min(int(rng.integers(*branch_len)), n_nodes - i)
+        parent[i:i + n] = np.arange(i - 1, i + n - 1)
+        parent[i] = rng.integers(i)
+        # a persistent walk, the direction drifts slowly along the branch
+        d = rng.normal(size=3) + np.cumsum(rng.normal(scale=.3, size=(n, 3)), axis=0)
+        d *= step / np.linalg.norm(d, axis=1, keepdims=True)
+        pos = xyz[parent[i]] + np.cumsum(d, axis=0)
+        # reflect into the box
+        pos = np.abs(pos)
+        pos = box - np.abs(box - pos % (2 * box))
+        xyz[i:i + n] = pos
+        i += n
+    r = rng.uniform(1, 3, n_nodes)
+    types = np.where(parent < 0, 1, rng.choice([2, 3], n_nodes))
+    return [(i + 1, int(t), *p, float(rr), int(pp + 1) if pp >= 0 else -1)
+            for i, (t, p, rr, pp) in enumerate(zip(types, xyz.tolist(), r, parent))]
+
+
+def neuron_volume(shape=(128, 512, 512), dtype=np.uint8, seed=0, n_nodes=5000, tree=None):
+    """
+    a sparse neuron-like image, bright neurites rendered from a random tree over a dim noisy background.
+
+    :param shape: the image shape (Z, Y, X)
+    :param dtype: uint8 or uint16
+    :param seed: the random seed
+    :param n_nodes: the number of nodes of the random tree
+    :param tree: the tree to render, default as a random one
+    :return: the image
+    """
+    dtype = np.dtype(dtype)
+    if tree is None:
+        tree = random_tree(n_nodes, shape, seed)
+    scale = 1 if dtype == np.uint8 else 16
+    rng = np.random.default_rng(seed)
+    img = rng.poisson(10 * scale, shape).astype(np.float32)
+    mask = rasterize_neuron(tree, shape) > 0
+    img[mask] += rng.normal(150 * scale, 20 * scale, np.count_nonzero(mask))
+    return np.clip(img, 0, np.iinfo(dtype).max).astype(dtype)
+
@@ -0,0 +1,23 @@
+"""
+Throughput of the one-pass streaming reductions, in MB/s of the volume, from memory and from a v3dpbd file.
+"""
+
+import pytest
+from conftest import throughput
+from v3dpy.loaders import PBD
+from v3dpy.image_processing.reduction import reduce_volume
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('downsample', [None, 4])
+def test_reduce(benchmark, volume, downsample):
+    benchmark.pedantic(reduce_volume, (volume,), dict(downsample=downsample), rounds=3, warmup_rounds=1)
+    throughput(benchmark, 'MB/s', volume.nbytes / 1e6)
+
+
+def test_reduce_pbd(benchmark, tmp_path, volume):
+    path = tmp_path / 'img.v3dpbd'
+    PBD().save(path, volume[None])
+    benchmark.pedantic(reduce_volume, (path,), dict(quantiles=(.5, .99)), rounds=3)
+    throughput(benchmark, 'MB/s', volume.nbytes / 1e6)
@@ -0,0 +1,42 @@
+"""
+Throughput of saving and loading v3draw and v3dpbd, and of bulk converting files between them, in MB/s of the
+uncompressed image.
+"""
+
+import pytest
+from conftest import throughput
+from v3dpy.loaders import PBD, Raw
+from v3dpy.convert import convert_files
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('loader', [Raw, PBD])
+def test_save(benchmark, tmp_path, volume, loader):
+    path = tmp_path / ('img.v3dpbd' if loader is PBD else 'img.v3draw')
+    benchmark.pedantic(loader().save, (path, volume[None]), rounds=3, warmup_rounds=1)
+    throughput(benchmark, 'MB/s', volume.nbytes / 1e6)
+    benchmark.extra_info['file MB'] = path.stat().st_size / 1e6
+
+
+@pytest.mark.parametrize('loader', [Raw, PBD])
+def test_load(benchmark, tmp_path, volume, loader):
+    path = tmp_path / ('img.v3dpbd' if loader is PBD else 'img.v3draw')
+    loader().save(path, volume[None])
+    img = benchmark.pedantic(loader().load, (path,), rounds=3, warmup_rounds=1)
+    assert (img[0] == volume).all()
+    throughput(benchmark, 'MB/s', volume.nbytes / 1e6)
+
+
+@pytest.mark.parametrize('budget', [1 << 30, 1 << 22], ids=['whole', 'streamed'])
+def test_convert_files(benchmark, tmp_path, volume, budget):
+    """
+    8 v3draw files into v3dpbd by 4 workers, whole or streamed in slabs
+    """
+    jobs = []
+    for i in range(8):
+        Raw().save(tmp_path / f'{i}.v3draw', volume[None])
+        jobs.append((tmp_path / f'{i}.v3draw', tmp_path / f'{i}.v3dpbd'))
+    summary = benchmark.pedantic(convert_files, (jobs,), dict(num_workers=4, memory_budget=budget), rounds=3)
+    assert summary['done'] == 8
+    throughput(benchmark, 'MB/s', volume.nbytes * 8 / 1e6)
@@ -0,0 +1,66 @@
+"""
+Throughput of radius profiling, resampling and simplification, and the swc_handler operations, in nodes/s.
+"""
+
+import pytest
+from conftest import throughput, VOLUME_SHAPE
+from v3dpy.neuron_utilities import swc_handler
+from v3dpy.neuron_utilities.profiling import profile_radius
+from v3dpy.neuron_utilities.resample import resample, simplify
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('is2d', [True, False], ids=['2d', '3d'])
+def test_profile_radius(benchmark, volume8, volume_tree, is2d):
+    benchmark.pedantic(profile_radius, (volume_tree, volume8, is2d, 40), rounds=3, warmup_rounds=1)
+    throughput(benchmark, 'nodes/s', len(volume_tree))
+
+
+@pytest.mark.parametrize('op, arg', [(resample, 1.), (simplify, 1.)], ids=['resample', 'simplify'])
+def test_resample(benchmark, tree, op, arg):
+    benchmark(op, tree, arg)
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+def test_parse_swc(benchmark, tmp_path, tree):
+    path = tmp_path / 'tree.swc'
+    swc_handler.write_swc(tree, path)
+    assert len(benchmark(swc_handler.parse_swc, path)) == len(tree)
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+def test_write_swc(benchmark, tmp_path, tree):
+    benchmark(swc_handler.write_swc, tree, tmp_path / 'tree.swc')
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+def test_get_child_dict(benchmark, tree):
+    benchmark(swc_handler.get_child_dict, tree)
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+def test_prune(benchmark, tree):
+    # cut the subtrees of every 100th node away
+    ind_set = set(t[0] for t in tree[1::100])
+    benchmark(swc_handler.prune, tree, ind_set)
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+@pytest.mark.parametrize('bfs', [True, False], ids=['bfs', 'dfs'])
+def test_trim_swc(benchmark, tree, bfs):
+    benchmark(swc_handler.trim_swc, tree, [s * 2 for s in VOLUME_SHAPE], True, bfs)
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+def test_trim_out_of_box(benchmark, tree):
+    benchmark(swc_handler.trim_out_of_box, tree, [s * 2 for s in VOLUME_SHAPE])
+    throughput(benchmark, 'nodes/s', len(tree))
+
+
+@pytest.mark.parametrize('op, args', [(swc_handler.shift_swc, (10, 20, 30)),
+                                      (swc_handler.scale_swc, ((.5, .5, 2.),)),
+                                      (swc_handler.flip_swc, ('y', 1000))], ids=['shift', 'scale', 'flip'])
+def test_transform(benchmark, tree, op, args):
+    benchmark(op, tree, *args)
+    throughput(benchmark, 'nodes/s', len(tree))
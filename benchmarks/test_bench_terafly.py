@@ -0,0 +1,53 @@
+"""
+Crop latency of TeraFly tiled volumes at several crop sizes and tile overlaps, without and with the tile cache or a
+warm disk chunk cache, the throughput of walking a volume chunk by chunk, and of converting volumes into TeraFly.
+"""
+
+import pytest
+from conftest import throughput, TILE_SHAPE, VOLUME_SHAPE
+from v3dpy.terafly import TeraflyInterface, DiskChunkCache, write_terafly
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('cache', ['none', 'memory', 'disk'])
+@pytest.mark.parametrize('tiles', [1, 2], ids=['inside', 'across'])
+@pytest.mark.parametrize('size', [16, 32, 64])
+def test_crop(benchmark, tmp_path, terafly_dir, size, tiles, cache):
+    """
+    a cubic crop either inside the first tile or centered at a tile corner so that it spans 2 tiles along each axis
+    """
+    t = TeraflyInterface(terafly_dir, tile_cache_bytes=1 << 30 if cache == 'memory' else 0,
+                         disk_cache=DiskChunkCache(tmp_path, 1 << 34) if cache == 'disk' else None)
+    if tiles == 1:
+        z0, y0, x0 = 0, 0, 0
+    else:
+        z0, y0, x0 = (s - size // 2 for s in TILE_SHAPE)
+    if any(s + size > v for s, v in zip((z0, y0, x0), VOLUME_SHAPE)) or size > min(TILE_SHAPE):
+        pytest.skip('the crop does not fit the volume at this scale')
+    img = benchmark(t.get_sub_volume, x0, x0 + size, y0, y0 + size, z0, z0 + size)
+    assert img.shape[1:] == (size, size, size)
+    benchmark.extra_info['tiles touched'] = tiles ** 3
+    throughput(benchmark, 'MB/s', img.nbytes / 1e6)
+
+
+@pytest.mark.parametrize('halo', [0, 8])
+def test_iter_chunks(benchmark, terafly_dir, halo):
+    """
+    a whole pass over the volume along its chunk grid, in MB/s of the volume
+    """
+    t = TeraflyInterface(terafly_dir)
+    x, y, z, c = t.get_dim()
+    benchmark.pedantic(lambda: sum(1 for _ in t.iter_chunks(halo=halo, workers=4)), rounds=3)
+    throughput(benchmark, 'MB/s', x * y * z * t.get_dtype().itemsize / 1e6)
+
+
+@pytest.mark.parametrize('compression', ['none', 'lzw'])
+def test_write(benchmark, tmp_path, volume, compression):
+    """
+    convert into all the resolutions, in MB/s of the highest one
+    """
+    out = iter(range(1 << 30))
+    benchmark.pedantic(lambda: write_terafly(volume, tmp_path / str(next(out)), TILE_SHAPE, compression=compression),
+                       rounds=3)
+    throughput(benchmark, 'MB/s', volume.nbytes / 1e6)
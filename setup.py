@@ -268,11 +268,47 @@ class MyBuildExtension(build_ext):
                 f.write(main_py)
 
 
+# OpenMP for the prange loops
+if platform.system() == "Windows":
+    openmp_compile_args, openmp_link_args = ['/openmp'], []
+else:
+    openmp_compile_args, openmp_link_args = ['-fopenmp'], ['-fopenmp']
+
+
 extensions = [
+    Extension(
+        'v3dpy.iostats',
+        ['v3dpy/iostats.pyx'],
+        language='c++'
+    ),
     Extension(
         'v3dpy.neuron_utilities.profiling',
         ['v3dpy/neuron_utilities/profiling.pyx'],
         include_dirs=[np.get_include()],
+        extra_compile_args=openmp_compile_args,
+        extra_link_args=openmp_link_args,
+        language='c++'
+    ),
+    Extension(
+        'v3dpy.neuron_utilities.sampling',
+        ['v3dpy/neuron_utilities/sampling.pyx'],
+        include_dirs=[np.get_include()],
+        extra_compile_args=openmp_compile_args,
+        extra_link_args=openmp_link_args,
+        language='c++'
+    ),
+    Extension(
+        'v3dpy.neuron_utilities.rasterize',
+        ['v3dpy/neuron_utilities/rasterize.pyx'],
+        include_dirs=[np.get_include()],
+        extra_compile_args=openmp_compile_args,
+        extra_link_args=openmp_link_args,
+        language='c++'
+    ),
+    Extension(
+        'v3dpy.image_processing.reduction',
+        ['v3dpy/image_processing/reduction.pyx'],
+        include_dirs=[np.get_include()],
         language='c++'
     ),
     Extension(
@@ -0,0 +1,99 @@
+import unittest
+import json
+import tempfile
+from pathlib import Path
+from v3dpy.convert import convert_image, convert_files
+from v3dpy.cli import main, parse_size
+from v3dpy.loaders import PBD, Raw
+import numpy as np
+
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        self.images = {}
+        for i, dtype in enumerate([np.uint8, np.uint16, np.uint16]):
+            img = (rng.integers(0, 50, (2, 20, 30, 40)) * 3).astype(dtype)
+            path = self.root / 'in' / f'sub{i % 2}' / f'{i}.v3draw'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            Raw().save(path, img)
+            self.images[path] = img
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_convert_image(self):
+        src, img = next(iter(self.images.items()))
+        # whole and streamed in slabs of one slice
+        for budget, streamed in [(1 << 30, False), (2000, True)]:
+            dst = self.root / f'{budget}.v3dpbd'
+            self.assertEqual(convert_image(src, dst, budget), (img.nbytes, streamed))
+            np.testing.assert_array_equal(PBD().load(dst), img)
+            self.assertEqual(convert_image(dst, dst.with_suffix('.v3draw'), budget), (img.nbytes, streamed))
+            np.testing.assert_array_equal(Raw().load(dst.with_suffix('.v3draw')), img)
+        self.assertEqual(sorted(p.name for p in self.root.iterdir()),
+                         ['1073741824.v3dpbd', '1073741824.v3draw', '2000.v3dpbd', '2000.v3draw', 'in'])
+
+    def test_terafly(self):
+        from v3dpy.terafly import TeraflyInterface
+        img = np.random.default_rng(1).integers(0, 1000, (1, 20, 30, 40)).astype(np.uint16)
+        Raw().save(self.root / 'a.v3draw', img)
+        convert_image(self.root / 'a.v3draw', self.root / 'a', tile_shape=(8, 16, 16))
+        res = self.root / 'a' / 'RES(30x40x20)'
+        t = TeraflyInterface(res)
+        np.testing.assert_array_equal(t.get_sub_volume(0, 40, 0, 30, 0, 20), img)
+        convert_image(res, self.root / 'b.v3dpbd', 4000)
+        np.testing.assert_array_equal(PBD().load(self.root / 'b.v3dpbd'), img)
+
+    def test_resume(self):
+        jobs = [(p, self.root / 'out' / p.with_suffix('.v3dpbd').name) for p in self.images]
+        jobs.append((self.root / 'missing.v3draw', self.root / 'out' / 'missing.v3dpbd'))
+        manifest = self.root / 'manifest.json'
+        reports = []
+        summary = convert_files(jobs, manifest, num_workers=2, memory_budget=60000, progress=reports.append)
+        self.assertEqual((summary['done'], summary['failed'], summary['skipped']), (3, 1, 0))
+        self.assertEqual(summary['bytes'], sum(img.nbytes for img in self.images.values()))
+        self.assertEqual(len(reports), 4)
+        self.assertGreater(summary['mb_per_s'], 0)
+        for (src, dst), img in zip(jobs, self.images.values()):
+            np.testing.assert_array_equal(PBD().load(dst), img)
+        entries = json.loads(manifest.read_text())
+        self.assertEqual(entries[str(jobs[-1][0])]['status'], 'failed')
+        self.assertEqual([entries[str(src)]['streamed'] for src, _ in jobs[:3]], [False, True, True])
+        # only the failed and the removed outputs are done again
+        jobs[1][1].unlink()
+        summary = convert_files(jobs, manifest, num_workers=2)
+        self.assertEqual((summary['done'], summary['failed'], summary['skipped']), (1, 1, 2))
+        np.testing.assert_array_equal(PBD().load(jobs[1][1]), self.images[jobs[1][0]])
+        self.assertFalse(list((self.root / 'out').glob('*.part')))
+
+    def test_cli(self):
+        self.assertEqual(parse_size('1.5G'), 3 << 29)
+        self.assertEqual(parse_size('512MB'), 512 << 20)
+        out = self.root / 'out'
+        self.assertEqual(main(['convert', str(self.root / 'in'), '-o', str(out), '--to', 'v3dpbd', '-j', '2',
+                               '--memory-budget', '10K']), 0)
+        for src, img in self.images.items():
+            np.testing.assert_array_equal(PBD().load(out / src.relative_to(self.root / 'in').with_suffix('.v3dpbd')),
+                                          img)
+        self.assertEqual(len(json.loads((out / 'convert.json').read_text())), 3)
+
+    def test_dotted_names(self):
+        img = next(iter(self.images.values()))[:1]
+        src = self.root / 'brain.v1.v3draw'
+        Raw().save(src, img)
+        out = self.root / 'out'
+        self.assertEqual(main(['convert', str(src), '-o', str(out), '--to', 'terafly', '--tile-shape', '8', '16', '16',
+                               '--tile-workers', '1']), 0)
+        res = out / 'brain.v1' / 'RES(30x40x20)'
+        self.assertEqual(main(['convert', str(res), '-o', str(out), '--to', 'v3draw']), 0)
+        np.testing.assert_array_equal(Raw().load(out / 'RES(30x40x20).v3draw'), img)
+        # the format given wins over the suffix
+        convert_image(src, self.root / 'brain.v2', to='v3dpbd')
+        np.testing.assert_array_equal(PBD().load(self.root / 'brain.v2'), img)
+
+
+if __name__ == '__main__':
+    unittest.main()
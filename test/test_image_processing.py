@@ -0,0 +1,73 @@
+import unittest
+import tempfile
+import numpy as np
+from pathlib import Path
+from v3dpy.loaders import PBD, Raw
+from v3dpy.terafly import write_terafly
+from v3dpy.image_processing.reduction import reduce_volume, histogram_quantiles
+
+
+def block_mean(img, k):
+    """
+    reference block means with smaller blocks at the far edges
+    """
+    out = np.zeros([-(-s // i) for s, i in zip(img.shape, k)])
+    for z in range(out.shape[0]):
+        for y in range(out.shape[1]):
+            for x in range(out.shape[2]):
+                out[z, y, x] = img[z * k[0]:(z + 1) * k[0], y * k[1]:(y + 1) * k[1], x * k[2]:(x + 1) * k[2]].mean()
+    return out
+
+
+class ReductionTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.img = rng.integers(0, 3000, (37, 45, 51), dtype=np.uint16)
+
+    def check(self, res, img, k=None):
+        for axis, name in enumerate(['mip_z', 'mip_y', 'mip_x']):
+            np.testing.assert_array_equal(res[name], img.max(axis=axis))
+        np.testing.assert_array_equal(res['histogram'], np.bincount(img.ravel(), minlength=1 << 16))
+        self.assertAlmostEqual(res['mean'], img.mean())
+        self.assertAlmostEqual(res['std'], img.std(), places=6)
+        self.assertEqual((res['min'], res['max']), (img.min(), img.max()))
+        if k is not None:
+            np.testing.assert_array_equal(res['downsample'], np.rint(block_mean(img, k)).astype(img.dtype))
+
+    def test_array(self):
+        for depth, workers in [(1, 1), (8, 3), (64, 0)]:
+            res = reduce_volume(self.img, downsample=(2, 3, 4), slab_depth=depth, num_workers=workers)
+            self.check(res, self.img, (2, 3, 4))
+        img = self.img.astype(np.float32) / 7
+        res = reduce_volume(img, reductions=('mip', 'moments'), downsample=2, slab_depth=5)
+        self.assertNotIn('histogram', res)
+        np.testing.assert_array_equal(res['mip_y'], img.max(axis=1))
+        np.testing.assert_allclose(res['downsample'], block_mean(img, (2, 2, 2)), rtol=1e-6)
+        self.assertAlmostEqual(res['mean'], img.mean(dtype=np.float64), places=4)
+        with self.assertRaises(ValueError):
+            reduce_volume(img, reductions=('histogram',))
+
+    def test_quantiles(self):
+        q = [0, .1, .5, .99, 1]
+        res = reduce_volume(self.img, reductions=(), quantiles=q)
+        np.testing.assert_array_equal(res['quantiles'], np.quantile(self.img, q, method='inverted_cdf'))
+        self.assertEqual(histogram_quantiles(res['histogram'], .5), np.quantile(self.img, .5, method='inverted_cdf'))
+
+    def test_sources(self):
+        img = self.img.astype(np.uint8)
+        region = (5, 40, 3, 30, 7, 33)
+        ref = img[7:33, 3:30, 5:40]
+        with tempfile.TemporaryDirectory() as d:
+            PBD().save(Path(d) / 'img.v3dpbd', img[None])
+            Raw().save(Path(d) / 'img.v3draw', img[None])
+            tf = write_terafly(img, Path(d) / 'tf', tile_shape=(8, 16, 16), n_levels=1, compression='none')[0]
+            for src in [img, Path(d) / 'img.v3dpbd', Path(d) / 'img.v3draw', tf]:
+                res = reduce_volume(src, downsample=3, slab_depth=4, num_workers=2)
+                self.check({**res, 'histogram': res['histogram'].tolist() + [0] * 65280}, img, (3, 3, 3))
+                res = reduce_volume(src, region=region, downsample=3, slab_depth=4, num_workers=2)
+                self.check({**res, 'histogram': res['histogram'].tolist() + [0] * 65280}, ref, (3, 3, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
+import tempfile
 from v3dpy.loaders.pbd import PBD
 from v3dpy.loaders.raw import Raw
+from v3dpy.iostats import IOStats
 from pathlib import Path
 import numpy as np
 
@@ -52,5 +54,59 @@ class LoaderTest(unittest.TestCase):
         # self.assertEqual((in_img == out_img).all(), True)  # add assertion here
 
 
+class SlabTest(unittest.TestCase):
+
+    def test_save_slabs(self):
+        rng = np.random.default_rng(0)
+        for dt in [np.uint8, np.uint16]:
+            img = (rng.random((2, 20, 30, 40)) * 8).astype(dt)
+            img[:, 5:9] = 3
+            for loader, name in [(Raw(), 'slabs.v3draw'), (PBD(), 'slabs.v3dpbd')]:
+                with tempfile.TemporaryDirectory() as d:
+                    loader.save_slabs(Path(d) / name, img.shape, dt,
+                                      (img[c, z:z + 7] for c in range(img.shape[0]) for z in range(0, 20, 7)))
+                    np.testing.assert_array_equal(loader.load(Path(d) / name), img)
+                    with self.assertRaises(Exception):
+                        loader.save_slabs(Path(d) / name, img.shape, dt, [img[0]])
+
+    def test_load_slabs(self):
+        rng = np.random.default_rng(0)
+        for dt in [np.uint8, np.uint16]:
+            img = (rng.random((2, 20, 30, 40)) * 8).astype(dt)
+            img[:, 5:9] = 3
+            # a tiny read step so that the compressed stream is refilled many times within a slab
+            for loader, name in [(Raw(), 'slabs.v3draw'), (PBD(read_step_size_bytes=100), 'slabs.v3dpbd')]:
+                with tempfile.TemporaryDirectory() as d:
+                    loader.save(Path(d) / name, img)
+                    self.assertEqual(loader.read_header(Path(d) / name), (img.shape, np.dtype(dt)))
+                    for depth in [1, 7, 20]:
+                        slabs = list(loader.load_slabs(Path(d) / name, depth))
+                        self.assertEqual(len(slabs), 2 * -(-20 // depth))
+                        np.testing.assert_array_equal(np.concatenate(slabs).reshape(img.shape), img)
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_load_stats(self):
+        img = np.zeros((1, 10, 20, 30), dtype=np.uint16)
+        img[0, 3:6] = 7
+        calls = []
+        stats = IOStats(lambda op, s: calls.append((op, s.as_dict())))
+        with tempfile.TemporaryDirectory() as d:
+            for loader, name in [(Raw(stats=stats), 'stats.v3draw'), (PBD(stats=stats), 'stats.v3dpbd')]:
+                loader.save(Path(d) / name, img)
+                np.testing.assert_array_equal(loader.load(Path(d) / name), img)
+                self.assertEqual(calls[-1][1]['bytes_read'], (Path(d) / name).stat().st_size)
+            self.assertEqual([c[0] for c in calls], ['Raw.load', 'PBD.load'])
+            self.assertEqual(stats.calls, 2)
+            self.assertEqual(stats.files_opened, 2)
+            self.assertEqual(stats.bytes_read, sum(c[1]['bytes_read'] for c in calls))
+            self.assertGreater(stats.decode_ns, 0)
+            stats.reset()
+            self.assertEqual(stats.bytes_read, 0)
+            # no instrumentation by default
+            self.assertIsNone(PBD().stats)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,8 @@
 import unittest
 from v3dpy.loaders import PBD
 from v3dpy.neuron_utilities import swc_handler
-from v3dpy.neuron_utilities import radius
-# import numpy as np
+from v3dpy.neuron_utilities import profiling
+import numpy as np
 
 #
 # def neuron_radius(tree, img, is2d, bkg_thr):
@@ -48,9 +48,82 @@ class MyTestCase(unittest.TestCase):
         img = r"D:\rectify\my\15257_13263_25518_2294.v3dpbd"
         img = PBD().load(img)[0]
         swc = swc_handler.parse_swc(swc)
-        res = radius.neuron_radius(swc, img, True, 3)
+        res = profiling.profile_radius(swc, img, True, 3)
         swc_handler.write_swc(res, 'profiled.swc')
 
 
+class SyntheticRadiusTest(unittest.TestCase):
+    def setUp(self):
+        zz, yy, xx = np.mgrid[:64, :64, :64]
+        self.img = np.zeros((64, 64, 64), dtype=np.uint8)
+        self.img[(xx - 32) ** 2 + (yy - 32) ** 2 <= 36] = 200
+        self.tree = [(i + 1, 2, 32., 32., float(z), 1., i if i > 0 else -1) for i, z in enumerate(range(16, 48, 4))]
+
+    def test_tube_radius(self):
+        for is2d in [True, False]:
+            res = profiling.profile_radius(self.tree, self.img, is2d, 10)
+            self.assertEqual(len(res), len(self.tree))
+            for t, r in zip(self.tree, res):
+                self.assertEqual(t[:5], r[:5])
+                self.assertEqual(t[6], r[6])
+                self.assertEqual(r[5], 7)
+
+    def test_threads_consistent(self):
+        xyz = np.random.default_rng(0).uniform(8, 56, (100, 3))
+        one = profiling.markers_radius(xyz, self.img, False, 10, num_threads=1)
+        many = profiling.markers_radius(xyz, self.img, False, 10)
+        np.testing.assert_array_equal(one, many)
+
+    def test_pixel_types(self):
+        xyz = np.random.default_rng(0).uniform(8, 56, (100, 3))
+        ref = profiling.markers_radius(xyz, self.img.astype(np.float32), False, 10)
+        read_only = self.img.astype(np.uint16)
+        read_only.setflags(write=False)
+        for img in [self.img, read_only, self.img.astype('>u2'), self.img.astype(np.int16)]:
+            np.testing.assert_array_equal(profiling.markers_radius(xyz, img, False, 10), ref)
+        self.assertIs(profiling.as_voxel_array(read_only), read_only)
+
+    def test_shell_offsets(self):
+        for is2d in [True, False]:
+            offsets, counts, starts = profiling.shell_offsets(5, is2d)
+            self.assertEqual(starts[-1], len(offsets))
+            r = np.sqrt((offsets.astype(np.float64) ** 2).sum(axis=1))
+            g = np.mgrid[-5:6, -5:6, 0:1] if is2d else np.mgrid[-5:6, -5:6, -5:6]
+            cube = np.sqrt((g.astype(np.float64) ** 2).sum(axis=0))
+            for ir in range(1, 6):
+                shell = r[starts[ir]:starts[ir + 1]]
+                self.assertTrue(((ir - 1 < shell) & (shell <= ir)).all())
+                self.assertEqual(len(shell), ((ir - 1 < cube) & (cube <= ir)).sum())
+            # the smaller radii are views of one table
+            self.assertTrue(np.shares_memory(offsets, profiling.shell_offsets(9, is2d)[0]))
+
+    def test_off_image_2d(self):
+        xyz = np.array([[32., 32., -1.], [32., 32., 64.], [32., 32., 100.], [32., 32., 32.]])
+        res = profiling.markers_radius(xyz, self.img, True, 10)
+        np.testing.assert_array_equal(res, [0, 0, 0, 7])
+
+    def test_group_markers(self):
+        xyz = np.random.default_rng(0).uniform(0, 256, (500, 3))
+        groups = profiling.group_markers(xyz, 64)
+        np.testing.assert_array_equal(np.sort(np.concatenate(groups)), np.arange(500))
+        for g in groups:
+            self.assertEqual(len(np.unique(np.floor(xyz[g] / 64), axis=0)), 1)
+
+
+class MeanshiftTest(unittest.TestCase):
+    def test_converge_to_centerline(self):
+        zz, yy, xx = np.mgrid[:64, :64, :64]
+        img = (200 * np.exp(-((xx - 30.) ** 2 + (yy - 34.) ** 2) / 8)).astype(np.uint8)
+        xyz = np.array([[33, 31, 20], [27, 37, 40], [30, 34, 10]], dtype=float)
+        for im in [img, img.astype(np.float32)]:
+            out, iters = profiling.markers_meanshift(xyz, im, window_radius=6, max_iter=10)
+            np.testing.assert_allclose(out[:, :2], [[30, 34]] * 3, atol=.5)
+            np.testing.assert_allclose(out[:, 2], xyz[:, 2], atol=.5)
+            self.assertTrue(((iters >= 1) & (iters <= 10)).all())
+        tree = profiling.neuron_meanshift([(1, 2, 33., 31., 20., 1., -1)], img, window_radius=6)
+        self.assertEqual(len(tree[0]), 7)
+        self.assertAlmostEqual(tree[0][2], 30, delta=.5)
+
+
 if __name__ == '__main__':
     unittest.main()
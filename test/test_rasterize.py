@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+from pathlib import Path
+from v3dpy.loaders import PBD, Raw
+from v3dpy.neuron_utilities import rasterize
+import numpy as np
+
+
+class RasterizeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = [(1, 1, 10., 10., 10., 3., -1), (2, 3, 30., 12., 10., 1., 1), (3, 3, 30., 30., 20., 1., 2)]
+        self.shape = (30, 40, 50)
+
+    def test_cone(self):
+        mask = rasterize.rasterize_neuron(self.tree, self.shape, min_radius=0)
+        self.assertEqual(mask[10, 10, 10], 1)
+        self.assertEqual(mask[10, 10, 13], 1)
+        self.assertEqual(mask[10, 13, 10], 1)
+        self.assertEqual(mask[10, 14, 10], 0)
+        self.assertEqual(mask[10, 12, 30], 1)
+        self.assertEqual(mask[12, 12, 30], 0)
+
+    def test_spacing(self):
+        dense = rasterize.rasterize_neuron(self.tree, self.shape, min_radius=0)
+        scaled = [(*t[:2], t[2] * 2 + 1, t[3] * 2 + 2, t[4] * 2 + 3, t[5] * 2, t[6]) for t in self.tree]
+        mask = rasterize.rasterize_neuron(scaled, self.shape, offset=(1, 2, 3), spacing=(2, 2, 2), min_radius=0)
+        np.testing.assert_array_equal(mask, dense)
+
+    def test_outputs(self):
+        dense = rasterize.rasterize_neuron(self.tree, self.shape, label='type', block_shape=(8, 16, 16))
+        np.testing.assert_array_equal(np.unique(dense), [0, 1, 3])
+        self.assertEqual(dense[10, 12, 30], 3)
+        sparse = rasterize.rasterize_neuron(self.tree, self.shape, output='sparse', label='type',
+                                            block_shape=(8, 16, 16))
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        for (z, y, x), block in sparse.items():
+            self.assertEqual((z % 8, y % 16, x % 16), (0, 0, 0))
+            mask[z:z + block.shape[0], y:y + block.shape[1], x:x + block.shape[2]] = block
+        np.testing.assert_array_equal(mask, dense)
+        with tempfile.TemporaryDirectory() as d:
+            for name, loader in [('mask.v3dpbd', PBD()), ('mask.v3draw', Raw())]:
+                rasterize.rasterize_neuron(self.tree, self.shape, output=Path(d) / name, label='type',
+                                           block_shape=(8, 16, 16))
+                np.testing.assert_array_equal(loader.load(Path(d) / name)[0], dense)
+            # slabs thinner or thicker than the blocks
+            for depth in [1, 5, 12]:
+                rasterize.rasterize_neuron(self.tree, self.shape, output=Path(d) / 'mask.v3draw', label='type',
+                                           block_shape=(8, 16, 16), slab_depth=depth)
+                np.testing.assert_array_equal(Raw().load(Path(d) / 'mask.v3draw')[0], dense)
+
+    def test_label_range(self):
+        mask = rasterize.rasterize_neuron(self.tree, self.shape, label=300, dtype=np.uint16)
+        np.testing.assert_array_equal(np.unique(mask), [0, 300])
+        with self.assertRaises(ValueError):
+            rasterize.rasterize_neuron(self.tree, self.shape, label=300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import tempfile
+from pathlib import Path
+from v3dpy.neuron_utilities import resample, swc_handler
+import numpy as np
+
+
+class ResampleTest(unittest.TestCase):
+    def setUp(self):
+        # a soma, a straight dendrite forking at node 4 into a dendrite tip and an axon
+        self.tree = [(1, 1, 0., 0., 0., 1., -1), (2, 3, 1., 0., 0., 1., 1), (3, 3, 2., 0., 0., 2., 2),
+                     (4, 3, 3., 0., 0., 3., 3), (5, 3, 3., 1., 0., 1., 4), (6, 2, 3., -1., 0., 1., 4),
+                     (7, 2, 3., -2., 0., 1., 6)]
+
+    def edges(self, tree):
+        index = {t[0]: t for t in tree}
+        return np.array([np.linalg.norm(np.subtract(t[2:5], index[t[6]][2:5])) for t in tree if t[6] in index])
+
+    def test_resample(self):
+        res = resample.resample(self.tree, .5)
+        self.assertEqual(len(res), 13)
+        np.testing.assert_allclose(self.edges(res), .5)
+        # the radius is interpolated, the new nodes take the type of their segment
+        self.assertEqual(res[3], (4, 3, 1.5, 0., 0., 1.5, 3))
+        self.assertEqual([t[1] for t in res if t[3] < 0], [2] * 4)
+        # the critical nodes are kept, node 3 is dropped
+        res = resample.resample(self.tree, 2.)
+        self.assertEqual([t[2:5] for t in res], [t[2:5] for t in self.tree if t[0] != 3])
+        self.assertEqual([t[6] for t in res], [-1, 1, 2, 3, 3, 5])
+
+    def test_unordered(self):
+        tree = self.tree[::-1]
+        res = resample.resample(tree, .5)
+        self.assertEqual(sorted(t[2:5] for t in res), sorted(t[2:5] for t in resample.resample(self.tree, .5)))
+        np.testing.assert_allclose(self.edges(res), .5)
+
+    def test_simplify(self):
+        res = resample.simplify(self.tree, .1)
+        self.assertEqual([t[0] for t in res], [1, 2, 4, 5, 6, 7])
+        self.assertEqual(res[2][6], 2)
+        # a bent branch keeps the node farthest from the chord
+        tree = [(1, 1, 0., 0., 0., 1., -1), (2, 3, 1., 0., 0., 1., 1), (3, 3, 2., .3, 0., 1., 2),
+                (4, 3, 3., 1., 0., 1., 3), (5, 3, 4., 0., 0., 1., 4), (6, 3, 5., 0., 0., 1., 5)]
+        self.assertEqual([t[0] for t in resample.simplify(tree, .5)], [1, 2, 4, 6])
+        self.assertEqual([t[0] for t in resample.simplify(tree, 2.)], [1, 2, 6])
+
+    def test_roots_only(self):
+        tree = [(3, 1, 0., 0., 0., 1., -1), (5, 2, 1., 2., 3., 2., -1)]
+        self.assertEqual(resample.resample(tree[:1], 1.), [(1, 1, 0., 0., 0., 1., -1)])
+        self.assertEqual(resample.resample(tree, 1.), [(1, 1, 0., 0., 0., 1., -1), (2, 2, 1., 2., 3., 2., -1)])
+        self.assertEqual(resample.simplify(tree[:1], 1.), tree[:1])
+        self.assertEqual(resample.simplify(tree, 1.), tree)
+
+    def test_random_tree(self):
+        rng = np.random.default_rng(0)
+        xyz = np.cumsum(rng.normal(size=(500, 3)), axis=0)
+        parent = [-1] + [int(rng.integers(max(i - 3, 0), i)) + 1 for i in range(1, 500)]
+        tree = [(i + 1, 3, *p, 1., pp) for i, (p, pp) in enumerate(zip(xyz.tolist(), parent))]
+        n_children = np.bincount([p for p in parent if p > 0], minlength=501)
+        critical = sum(1 for t in tree if t[6] < 0 or n_children[t[0]] != 1)
+        res = resample.resample(tree, .7)
+        self.assertLessEqual(self.edges(res).max(), .7 + 1e-9)
+        self.assertEqual(sum(1 for t in res if t[6] < 0), 1)
+        simple = resample.simplify(tree, 1.)
+        self.assertGreaterEqual(len(simple), critical)
+        self.assertLess(len(simple), len(tree))
+        self.assertEqual(len(resample.simplify(tree, 1e6)), critical)
+        self.assertEqual(len(resample.simplify(tree, 0.)), len(tree))
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            files = []
+            for i in range(3):
+                files.append(Path(d) / f'{i}.swc')
+                swc_handler.write_swc(self.tree, files[-1])
+            out = resample.map_swc_files(resample.resample, files, Path(d) / 'out', num_workers=2, step=.5)
+            self.assertEqual([p.name for p in out], ['0.swc', '1.swc', '2.swc'])
+            self.assertEqual(len(swc_handler.parse_swc(out[0])), 13)
+            trees = resample.map_swc_files(resample.simplify, files, num_workers=1, tol=.1)
+            self.assertEqual([len(t) for t in trees], [6] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
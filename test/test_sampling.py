@@ -0,0 +1,40 @@
+import unittest
+from v3dpy.neuron_utilities import sampling
+import numpy as np
+
+
+class SamplingTest(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.default_rng(0).integers(0, 1000, (20, 30, 40)).astype(np.uint16)
+
+    def test_nearest(self):
+        xyz = np.array([[1.2, 2.6, 3.4], [39.4, 29.2, 19.], [-3, 0, 0]])
+        res = sampling.sample_image(xyz, self.img, order=0)
+        np.testing.assert_array_equal(res, [self.img[3, 3, 1], self.img[19, 29, 39], 0])
+
+    def test_trilinear(self):
+        xyz = np.array([[1.5, 2., 3.], [5., 6., 7.]])
+        res = sampling.sample_image(xyz, self.img)
+        self.assertAlmostEqual(res[0], (float(self.img[3, 2, 1]) + self.img[3, 2, 2]) / 2)
+        self.assertAlmostEqual(res[1], self.img[7, 6, 5])
+
+    def test_segments(self):
+        img = np.zeros((20, 30, 40), dtype=np.uint8)
+        img[10, 10, 5:30] = 100
+        seg_min, seg_mean, profile, starts = sampling.sample_segments([[5, 10, 10], [5, 10, 10]],
+                                                                      [[29, 10, 10], [29, 20, 10]], img, order=0)
+        self.assertEqual(seg_min[0], 100)
+        self.assertEqual(seg_mean[0], 100)
+        self.assertEqual(seg_min[1], 0)
+        self.assertEqual(starts[1], 25)
+
+    def test_tree(self):
+        tree = [(1, 1, 1., 2., 3., 1., -1), (2, 2, 5., 6., 7., 1., 1)]
+        np.testing.assert_allclose(sampling.neuron_node_intensity(tree, self.img), [self.img[3, 2, 1], self.img[7, 6, 5]])
+        seg_min, seg_mean = sampling.neuron_segment_intensity(tree, self.img)
+        self.assertEqual(seg_min[0], self.img[3, 2, 1])
+        self.assertEqual(len(seg_mean), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,12 @@
 import unittest
-from v3dpy.terafly import TeraflyInterface
+import struct
+import tempfile
+import threading
+from v3dpy.terafly import TeraflyInterface, DiskChunkCache, write_terafly
+from v3dpy.terafly.writer import halve
+from v3dpy.loaders import PBD
+from v3dpy.iostats import IOStats
+from v3dpy.neuron_utilities.sampling import sample_points
 from pathlib import Path
 import numpy as np
 
@@ -31,5 +38,271 @@ class TeraflyTest(unittest.TestCase):
             # PBD(pbd16_full_blood=False).save(outdir / f'{tfpath.parent.name}.v3dpbd', img)
 
 
+def make_terafly(root: Path, img, tile_shape, null_tiles=()):
+    """
+    cut an image (Z, Y, X) into a tiled tiff TeraFly resolution, with the tiles starting at null_tiles (z, y, x) left
+    as NULL tiles
+    """
+    import tifffile
+    depth, height, width = img.shape
+    td, tv, th = tile_shape
+    rows, cols, slices = range(0, height, tv), range(0, width, th), range(0, depth, td)
+    (root / '.iim.format').write_text('Vaa3D raw (tiled, 3D)\n')
+    mdata = struct.pack('f', 2.) + struct.pack('iiifffffffffIIIHH', 1, 2, 3, 1., 1., 1., 1., 1., 1., 0., 0., 0.,
+                                               height, width, depth, len(rows), len(cols))
+    for r in rows:
+        for c in cols:
+            dirname = f'{r:06d}/{r:06d}_{c:06d}'
+            (root / dirname).mkdir(parents=True)
+            tile = img[:, r:r + tv, c:c + th]
+            mdata += struct.pack('IIIIIiiH', tile.shape[1], tile.shape[2], depth, len(slices), 1, r, c,
+                                 len(dirname) + 1) + dirname.encode() + b'\0'
+            for z in slices:
+                filename = f'{r:06d}_{c:06d}_{z:06d}.tif'
+                if (z, r, c) in null_tiles:
+                    filename = 'NULL.tif'
+                else:
+                    tifffile.imwrite(root / dirname / filename, tile[z:z + td], photometric='minisblack')
+                mdata += struct.pack('H', len(filename) + 1) + filename.encode() + b'\0' + \
+                    struct.pack('Ii', min(td, depth - z), z)
+            mdata += struct.pack('I', img.dtype.itemsize)
+    (root / 'mdata.bin').write_bytes(mdata)
+
+
+class SyntheticTeraflyTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import tifffile
+        except ImportError:
+            self.skipTest('tifffile is required to write the synthetic TeraFly volume')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.img = np.random.default_rng(0).integers(0, 1000, (40, 50, 60), dtype=np.uint16)
+        make_terafly(self.root, self.img, (16, 32, 32))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_crop_stats(self):
+        calls = []
+        stats = IOStats(lambda op, s: calls.append((op, s.tiles_touched)))
+        t = TeraflyInterface(self.root, stats=stats)
+        img = t.get_sub_volume(20, 40, 10, 40, 10, 20)
+        np.testing.assert_array_equal(img[0], self.img[10:20, 10:40, 20:40])
+        # 2 rows, 2 columns and 2 slices of tiles
+        self.assertEqual(calls, [('TiledVolume.load_sub_volume', 8)])
+        self.assertEqual(stats.files_opened, 8)
+        self.assertEqual(stats.cache_hits + stats.cache_misses, 0)
+        self.assertGreater(stats.decode_ns, 0)
+        self.assertGreater(stats.copy_ns, 0)
+
+    def test_cache_stats(self):
+        stats = IOStats()
+        t = TeraflyInterface(self.root, tile_cache_bytes=1 << 30, stats=stats)
+        for _ in range(2):
+            img = t.get_sub_volume(20, 40, 10, 40, 10, 20)
+            np.testing.assert_array_equal(img[0], self.img[10:20, 10:40, 20:40])
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.tiles_touched, 16)
+        self.assertEqual((stats.cache_misses, stats.cache_hits), (8, 8))
+        self.assertEqual(stats.files_opened, 8)
+
+    def test_out(self):
+        t = TeraflyInterface(self.root)
+        ref = self.img[10:20, 10:40, 20:40]
+        # contiguous, 3D and a strided view of a larger array
+        for out in [np.full((1, 10, 30, 20), 7, np.uint16), np.full((10, 30, 20), 7, np.uint16)]:
+            img = t.get_sub_volume(20, 40, 10, 40, 10, 20, out=out)
+            self.assertTrue(np.shares_memory(img, out))
+            np.testing.assert_array_equal(out.reshape(ref.shape), ref)
+        big = np.full((30, 50, 40), 7, np.uint16)
+        t.get_sub_volume(20, 40, 10, 40, 10, 20, out=big[5:15, 10:40, 10:30])
+        np.testing.assert_array_equal(big[5:15, 10:40, 10:30], ref)
+        big[5:15, 10:40, 10:30] = 7
+        self.assertTrue((big == 7).all())
+        # non-contiguous rows and flipped axes fall back to a copy
+        for out in [big[:10, :30, :40:2], big[9::-1, 29::-1, :20]]:
+            img = t.get_sub_volume(20, 40, 10, 40, 10, 20, out=out)
+            self.assertTrue(np.shares_memory(img, big))
+            np.testing.assert_array_equal(out, ref)
+        # shared memory
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=ref.nbytes)
+        try:
+            out = np.ndarray(ref.shape, np.uint16, buffer=shm.buf)
+            t.get_sub_volume(20, 40, 10, 40, 10, 20, out=out)
+            np.testing.assert_array_equal(out, ref)
+            del out
+        finally:
+            shm.close()
+            shm.unlink()
+        # beyond the volume
+        out = np.full((15, 20, 20), 7, np.uint16)
+        t.get_sub_volume(50, 70, 40, 60, 30, 45, out=out)
+        np.testing.assert_array_equal(out[:10, :10, :10], self.img[30:, 40:, 50:])
+        out[:10, :10, :10] = 0
+        self.assertFalse(out.any())
+        with self.assertRaises(ValueError):
+            t.get_sub_volume(20, 40, 10, 40, 10, 20, out=np.zeros((10, 30, 20), np.uint8))
+
+    def test_null_tiles(self):
+        with tempfile.TemporaryDirectory() as d:
+            make_terafly(Path(d), self.img, (16, 32, 32), null_tiles={(16, 0, 32)})
+            t = TeraflyInterface(d)
+            ref = self.img.copy()
+            ref[16:32, :32, 32:] = 0
+            for out in [None, np.full((40, 50, 60), 7, np.uint16)]:
+                np.testing.assert_array_equal(t.get_sub_volume(0, 60, 0, 50, 0, 40, out=out)[0], ref)
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = DiskChunkCache(d, 1 << 30)
+            ref = self.img[10:20, 10:40, 20:40]
+            # a second interface stands for another process, which only sees the chunks on disk
+            for i in range(2):
+                stats = IOStats()
+                t = TeraflyInterface(self.root, stats=stats, disk_cache=DiskChunkCache(d, 1 << 30))
+                np.testing.assert_array_equal(t.get_sub_volume(20, 40, 10, 40, 10, 20)[0], ref)
+                if i == 0:
+                    self.assertEqual((stats.disk_misses, stats.disk_hits, stats.files_opened), (8, 0, 8))
+                else:
+                    self.assertEqual((stats.disk_misses, stats.disk_hits, stats.files_opened), (0, 8, 0))
+            self.assertEqual(len(cache.scan()), 8)
+            # in-memory cache in front of the disk
+            stats = IOStats()
+            t = TeraflyInterface(self.root, tile_cache_bytes=1 << 30, stats=stats, disk_cache=cache)
+            for _ in range(2):
+                np.testing.assert_array_equal(t.get_sub_volume(20, 40, 10, 40, 10, 20)[0], ref)
+            self.assertEqual((stats.cache_misses, stats.cache_hits, stats.disk_hits), (8, 8, 8))
+            # the tile cache keeps its own copies, not maps of the disk cache files
+            for path in Path(d).rglob('*.npy'):
+                chunk = np.load(path, mmap_mode='r+')
+                chunk[:] = 0
+                chunk.flush()
+                del chunk
+            np.testing.assert_array_equal(t.get_sub_volume(20, 40, 10, 40, 10, 20)[0], ref)
+            cache.clear()
+            self.assertEqual(cache.usage(), 0)
+
+    def test_disk_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as d:
+            # room for about 3 tiles of 16x32x32 uint16
+            cache = DiskChunkCache(d, 100000)
+            t = TeraflyInterface(self.root, disk_cache=cache)
+            np.testing.assert_array_equal(t.get_sub_volume(0, 60, 0, 50, 0, 40)[0], self.img)
+            self.assertLessEqual(cache.usage(), 100000)
+            self.assertGreater(cache.usage(), 0)
+            np.testing.assert_array_equal(t.get_sub_volume(0, 60, 0, 50, 0, 40)[0], self.img)
+
+    def test_chunk_grid(self):
+        t = TeraflyInterface(self.root)
+        for b, ref in zip(t.chunk_grid(), ([0, 32, 60], [0, 32, 50], [0, 16, 32, 40])):
+            np.testing.assert_array_equal(b, ref)
+        stats = IOStats()
+        t = TeraflyInterface(self.root, stats=stats)
+        chunks = list(t.iter_chunks())
+        self.assertEqual(len(chunks), 12)
+        # z layer by z layer, x the fastest
+        self.assertEqual([c[0] for c in chunks[:3]], [(0, 32, 0, 32, 0, 16), (32, 60, 0, 32, 0, 16),
+                                                      (0, 32, 32, 50, 0, 16)])
+        for (x0, x1, y0, y1, z0, z1), img in chunks:
+            np.testing.assert_array_equal(img[0], self.img[z0:z1, y0:y1, x0:x1])
+        self.assertEqual(stats.files_opened, 12)
+        # every tile is decoded once with the halo too
+        stats = IOStats()
+        t = TeraflyInterface(self.root, stats=stats)
+        padded = np.pad(self.img, ((3, 3), (2, 2), (1, 1)))
+        chunks = []
+        for c in t.iter_chunks(halo=(1, 2, 3), order='xzy', workers=3):
+            # the walk caches the tiles on its own, leaving the interface as it is
+            self.assertEqual(t._volume.tile_cache_bytes, 0)
+            chunks.append(c)
+        self.assertEqual(len(chunks), 12)
+        self.assertEqual([c[0][:2] for c in chunks[:6]], [(0, 32)] * 6)
+        for (x0, x1, y0, y1, z0, z1), img in chunks:
+            np.testing.assert_array_equal(img[0], padded[z0:z1 + 6, y0:y1 + 4, x0:x1 + 2])
+        self.assertEqual(stats.cache_misses, 12)
+        self.assertEqual(stats.files_opened, 12)
+
+    def test_multi_channel(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            channels = [self.img, self.img // 2, self.img // 3]
+            for i, img in enumerate(channels):
+                (root / f'CH_{i:02d}').mkdir()
+                make_terafly(root / f'CH_{i:02d}', img, (16, 32, 32))
+            (root / '.iim.format').write_text('Vaa3D raw (tiled, 4D)\n')
+            # channels not requested are never read, not even their metadata
+            mdata = (root / 'CH_01' / 'mdata.bin').read_bytes()
+            (root / 'CH_01' / 'mdata.bin').write_bytes(b'corrupted')
+            stats = IOStats()
+            t = TeraflyInterface(root, stats=stats)
+            n_threads = threading.active_count()
+            img = t.get_sub_volume(20, 40, 10, 40, 10, 20, channels=[2, 0])
+            # the channel threads end with the crop
+            self.assertEqual(threading.active_count(), n_threads)
+            self.assertEqual(img.shape, (2, 10, 30, 20))
+            np.testing.assert_array_equal(img[0], channels[2][10:20, 10:40, 20:40])
+            np.testing.assert_array_equal(img[1], channels[0][10:20, 10:40, 20:40])
+            self.assertEqual(stats.files_opened, 16)
+            self.assertEqual(t.get_dim(), (60, 50, 40, 3))
+            self.assertEqual(t.get_dtype(), np.uint16)
+            out = np.full((1, 15, 20, 20), 7, np.uint16)
+            t.get_sub_volume(50, 70, 40, 60, 30, 45, out=out, channels=[2])
+            np.testing.assert_array_equal(out[0, :10, :10, :10], channels[2][30:, 40:, 50:])
+            with self.assertRaises(ValueError):
+                t.get_sub_volume(0, 10, 0, 10, 0, 10, channels=[3])
+            (root / 'CH_01' / 'mdata.bin').write_bytes(mdata)
+            t = TeraflyInterface(root)
+            self.assertEqual(t.get_dtype(), np.uint16)
+            img = t.get_sub_volume(0, 60, 0, 50, 0, 40)
+            np.testing.assert_array_equal(img, np.stack(channels))
+            for (x0, x1, y0, y1, z0, z1), img in TeraflyInterface(root).iter_chunks(channels=[1, 2], workers=2):
+                np.testing.assert_array_equal(img, np.stack(channels[1:])[:, z0:z1, y0:y1, x0:x1])
+            # nor is channel 0 when it isn't requested, metadata included
+            (root / 'CH_00' / 'mdata.bin').write_bytes(b'corrupted')
+            t = TeraflyInterface(root)
+            self.assertEqual(t.get_dim([2]), (60, 50, 40, 3))
+            self.assertEqual(t.get_dtype([2]), np.uint16)
+            for (x0, x1, y0, y1, z0, z1), img in t.iter_chunks(halo=2, channels=[2]):
+                np.testing.assert_array_equal(img[0, 2:-2, 2:-2, 2:-2], channels[2][z0:z1, y0:y1, x0:x1])
+            xyz = np.array([[5., 6., 7.], [40., 30., 20.]])
+            np.testing.assert_array_equal(sample_points(xyz, TeraflyInterface(root), order=0, channel=1),
+                                          channels[1][[7, 20], [6, 30], [5, 40]])
+
+
+class WriterTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for dt in [np.uint8, np.uint16]:
+            img = rng.integers(0, 200, (37, 45, 51), dtype=dt)
+            with tempfile.TemporaryDirectory() as d:
+                PBD().save(Path(d) / 'img.v3dpbd', img[None])
+                for src in [img, Path(d) / 'img.v3dpbd']:
+                    paths = write_terafly(src, Path(d) / 'out', tile_shape=(8, 16, 16), slab_depth=5)
+                    self.assertEqual([p.name for p in paths], ['RES(45x51x37)', 'RES(22x25x18)', 'RES(11x12x9)'])
+                    level = img
+                    for p in paths:
+                        t = TeraflyInterface(p)
+                        z, y, x = level.shape
+                        self.assertTupleEqual(t.get_dim(), (x, y, z, 1))
+                        np.testing.assert_array_equal(t.get_sub_volume(0, x, 0, y, 0, z)[0], level)
+                        level = halve(level)
+                # re-tile a TeraFly resolution
+                paths = write_terafly(Path(d) / 'out' / 'RES(45x51x37)', Path(d) / 'retiled', tile_shape=(16, 32, 32),
+                                      n_levels=2, halving='max', compression='none')
+                self.assertEqual(len(paths), 2)
+                np.testing.assert_array_equal(TeraflyInterface(paths[1]).get_sub_volume(0, 25, 0, 22, 0, 18)[0],
+                                              halve(img, 'max'))
+
+    def test_halve(self):
+        img = np.arange(4 * 4 * 5, dtype=np.uint16).reshape(4, 4, 5)
+        self.assertEqual(halve(img).shape, (2, 2, 2))
+        self.assertEqual(halve(img)[0, 0, 0], img[:2, :2, :2].mean() // 1)
+        self.assertEqual(halve(img, 'max')[1, 1, 1], img[3, 3, 3])
+
+
 if __name__ == '__main__':
     unittest.main()
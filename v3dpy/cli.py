@@ -0,0 +1,87 @@
+"""
+The v3dpy command line.
+
+    v3dpy convert INPUT... -o OUT_DIR --to v3dpbd
+
+converts the images, or the images found in the input directories, into the output directory under the same
+relative paths, reporting the throughput as it goes. Rerunning the same command resumes from the manifest.
+"""
+
+import sys
+import argparse
+from pathlib import Path
+from .convert import FORMATS, SUFFIXES, output_name, convert_files
+
+
+def parse_size(text: str) -> int:
+    """
+    :param text: a size in bytes, optionally with a K, M, G or T suffix
+    :return: the number of bytes
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().removesuffix('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def find_images(inputs, out_dir: Path, to: str):
+    """
+    :param inputs: image paths, TeraFly resolution directories or directories to search for v3draw/v3dpbd files
+    :param out_dir: the output directory
+    :param to: the output format, 'v3draw', 'v3dpbd' or 'terafly'
+    :return: the (input, output) path pairs
+    """
+    jobs = []
+    for i in inputs:
+        i = Path(i)
+        if i.is_dir() and not (i / 'mdata.bin').is_file():
+            files = sorted(p for p in i.rglob('*') if p.is_file() and p.suffix.lower() in FORMATS)
+            jobs.extend((p, out_dir / p.parent.relative_to(i) / output_name(p, to)) for p in files)
+        else:
+            jobs.append((i, out_dir / output_name(i, to)))
+    return jobs
+
+
+def report(summary: dict):
+    last = summary['last']
+    status = 'ok' if last['status'] == 'done' else last['error']
+    print(f"[{summary['done'] + summary['failed'] + summary['skipped']}/{summary['total']}] "
+          f"{summary['files_per_s']:.2f} files/s, {summary['mb_per_s']:.1f} MB/s  {last['input']}: {status}",
+          file=sys.stderr, flush=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='v3dpy', description="Vaa3D image tools.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('convert', help="convert images between v3draw, v3dpbd and TeraFly tiled tiff",
+                            description="Convert images between v3draw, v3dpbd and TeraFly tiled tiff in parallel. "
+                                        "Rerun the same command to resume an interrupted conversion.")
+    p.add_argument('inputs', nargs='+', help="images, TeraFly resolutions, or directories to search for images")
+    p.add_argument('-o', '--output', required=True, type=Path, help="the output directory")
+    p.add_argument('--to', required=True, choices=list(SUFFIXES), help="the output format")
+    p.add_argument('-j', '--workers', type=int, default=0, help="converting processes, default as all cores")
+    p.add_argument('--memory-budget', type=parse_size, default='1G',
+                   help="memory of each worker, the larger files are streamed in slabs, default as 1G")
+    p.add_argument('--read-ahead', type=int, default=2, help="inputs read ahead of the workers, default as 2")
+    p.add_argument('--manifest', type=Path, help="the progress manifest, default as convert.json in the output")
+    p.add_argument('--tile-shape', type=int, nargs=3, default=(256, 256, 256), metavar=('Z', 'Y', 'X'),
+                   help="the TeraFly tile shape")
+    p.add_argument('--compression', default='lzw', choices=['none', 'lzw', 'deflate'],
+                   help="the TeraFly tiff compression")
+    p.add_argument('--tile-workers', type=int, default=2,
+                   help="the threads writing the TeraFly tiles of each converting process, default as 2")
+    p.add_argument('--pbd16-compat', action='store_true',
+                   help="write 16bit v3dpbd that other programs can load, at a lower compression ratio")
+    args = parser.parse_args(argv)
+
+    jobs = find_images(args.inputs, args.output, args.to)
+    args.output.mkdir(parents=True, exist_ok=True)
+    summary = convert_files(jobs, args.manifest or args.output / 'convert.json', args.workers, args.read_ahead,
+                            args.memory_budget, report, args.to, tile_shape=tuple(args.tile_shape),
+                            compression=args.compression, tile_workers=args.tile_workers,
+                            pbd16_full_blood=not args.pbd16_compat)
+    print(f"{summary['done']} converted, {summary['failed']} failed, {summary['skipped']} skipped in "
+          f"{summary['seconds']:.1f}s, {summary['files_per_s']:.2f} files/s, {summary['mb_per_s']:.1f} MB/s",
+          file=sys.stderr)
+    return 1 if summary['failed'] else 0
@@ -0,0 +1,304 @@
+"""
+Bulk conversion of images between v3draw, v3dpbd and TeraFly tiled tiff. The files go through a pipeline: the
+next inputs are read ahead into the OS cache by I/O threads while a pool of processes decodes, re-encodes and
+writes the ones before, and files larger than the memory budget are streamed slab by slab, the next slab decoded
+and the last one written in the background while the current one is encoded. Each output is written under a
+temporary name and renamed when complete, and the progress is kept in a JSON manifest, so an interrupted conversion
+resumes where it stopped.
+"""
+
+import os
+import json
+import shutil
+import threading
+import numpy as np
+from time import perf_counter
+from queue import Queue
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+FORMATS = {'.v3draw': 'v3draw', '.raw': 'v3draw', '.v3dpbd': 'v3dpbd'}
+SUFFIXES = {'v3draw': '.v3draw', 'v3dpbd': '.v3dpbd', 'terafly': ''}
+
+
+def image_format(path: os.PathLike | str) -> str:
+    """
+    :param path: an image path, or a TeraFly resolution directory
+    :return: 'v3draw', 'v3dpbd' or 'terafly'
+    """
+    path = Path(path)
+    if path.is_dir():
+        return 'terafly'
+    fmt = FORMATS.get(path.suffix.lower())
+    if fmt is None:
+        raise ValueError(f"Unsupported format of {path}")
+    return fmt
+
+
+def output_format(path: os.PathLike | str) -> str:
+    """
+    :param path: an output path
+    :return: 'v3draw' or 'v3dpbd' by the suffix, otherwise 'terafly', the output of which is a directory
+    """
+    return FORMATS.get(Path(path).suffix.lower(), 'terafly')
+
+
+def output_name(path: os.PathLike | str, to: str) -> str:
+    """
+    :param path: an input path
+    :param to: the output format, 'v3draw', 'v3dpbd' or 'terafly'
+    :return: the output name, the input name with its image suffix, if any, replaced by that of the format
+    """
+    path = Path(path)
+    stem = path.stem if path.suffix.lower() in FORMATS else path.name
+    return stem + SUFFIXES[to]
+
+
+def image_loader(fmt: str):
+    """
+    :param fmt: 'v3draw' or 'v3dpbd'
+    :return: a loader of the format
+    """
+    from .loaders import Raw, PBD
+    return Raw() if fmt == 'v3draw' else PBD()
+
+
+def image_header(path: os.PathLike | str):
+    """
+    :param path: a v3draw/v3dpbd path, or a TeraFly resolution directory
+    :return: the image shape (C,Z,Y,X) and the pixel type
+    """
+    fmt = image_format(path)
+    if fmt == 'terafly':
+        from .terafly import TeraflyInterface
+        t = TeraflyInterface(path)
+        x, y, z, c = t.get_dim()
+        return (c, z, y, x), t.get_dtype()
+    shape, dtype = image_loader(fmt).read_header(path)
+    return tuple(shape), np.dtype(dtype)
+
+
+def prefetch(iterable, depth: int = 1):
+    """
+    run an iterator in a background thread, keeping up to depth items ready ahead of the consumer.
+
+    :param iterable: the items, e.g. the slabs decoded by load_slabs
+    :param depth: the number of items produced ahead
+    :return: a generator of the same items
+    """
+    queue = Queue(max(depth, 1))
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+                if stop.is_set():
+                    return
+            queue.put((done, None))
+        except BaseException as e:
+            queue.put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # unblock the producer if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            while not queue.empty():
+                queue.get_nowait()
+            thread.join(.01)
+
+
+def warm_cache(path: os.PathLike | str, limit: int, chunk_bytes: int = 1 << 23):
+    """
+    read a file ahead into the OS cache, so that the worker converting it next doesn't wait on the storage.
+
+    :param path: the input path, directories are skipped
+    :param limit: the largest number of bytes to read
+    :param chunk_bytes: the read size
+    """
+    path = Path(path)
+    if not path.is_file():
+        return
+    buf = bytearray(chunk_bytes)
+    with open(path, 'rb', buffering=0) as f:
+        n = 0
+        while n < limit:
+            k = f.readinto(buf)
+            if not k:
+                break
+            n += k
+
+
+def replace_output(tmp: Path, dst: Path):
+    """
+    move a complete output into place, replacing an old TeraFly directory.
+    """
+    if dst.is_dir():
+        shutil.rmtree(dst)
+    os.replace(tmp, dst)
+
+
+def convert_image(src: os.PathLike | str, dst: os.PathLike | str, memory_budget: int = 1 << 30, prefetch_depth=1,
+                  tile_shape=(256, 256, 256), compression='lzw', pbd16_full_blood=True, to: str = None,
+                  tile_workers=2):
+    """
+    convert an image by the suffix of the output, loading it whole if it fits in the memory budget or streaming it
+    slab by slab otherwise. The output appears only when complete.
+
+    :param src: a v3draw/v3dpbd path, or a TeraFly resolution directory
+    :param dst: a v3draw/v3dpbd path, or a directory without suffix for TeraFly
+    :param memory_budget: the memory a conversion may take, which decides whether to stream and the slab depth
+    :param prefetch_depth: the number of slabs decoded ahead when streaming
+    :param tile_shape: the tile shape (Z,Y,X) of TeraFly outputs
+    :param compression: the tiff compression of TeraFly outputs, 'none', 'lzw' or 'deflate'
+    :param pbd16_full_blood: the 16bit v3dpbd encoding, see PBD
+    :param to: the output format, 'v3draw', 'v3dpbd' or 'terafly', default as told by the suffix of dst, see
+    output_format
+    :param tile_workers: the threads writing the tiles of TeraFly outputs
+    :return: the image size in bytes, and whether it was streamed
+    """
+    from .loaders import PBD
+    from .terafly import write_terafly
+    from .slabs import open_slabs
+    src, dst = Path(src), Path(dst)
+    src_fmt = image_format(src)
+    dst_fmt = output_format(dst) if to is None else to
+    if dst_fmt not in SUFFIXES:
+        raise ValueError(f"Unsupported output format {dst_fmt}")
+    shape, dtype = image_header(src)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    # the input slab, the encoder's copy of it, its two output buffers of up to twice the size, one being written in
+    # the background, and the slabs decoded ahead
+    plane_bytes = int(np.prod(shape[-2:])) * dtype.itemsize
+    slab_depth = max(1, memory_budget // ((6 + prefetch_depth) * plane_bytes))
+    streamed = nbytes > memory_budget
+    tmp = dst.with_name(dst.name + '.part')
+    if tmp.is_dir():
+        shutil.rmtree(tmp)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    if dst_fmt == 'terafly':
+        # the TeraFly writer streams by itself
+        write_terafly(src, tmp, tile_shape, slab_depth=min(slab_depth, shape[1]), compression=compression,
+                      num_workers=tile_workers)
+        replace_output(tmp, dst)
+        return nbytes, True
+    saver = PBD(pbd16_full_blood) if dst_fmt == 'v3dpbd' else image_loader(dst_fmt)
+    if src_fmt == 'terafly':
+        _, _, slabs = open_slabs(src, slab_depth)
+        saver.save_slabs(tmp, shape, dtype, prefetch(slabs, prefetch_depth))
+        streamed = True
+    elif streamed:
+        slabs = image_loader(src_fmt).load_slabs(src, slab_depth)
+        saver.save_slabs(tmp, shape, dtype, prefetch(slabs, prefetch_depth))
+    else:
+        saver.save(tmp, image_loader(src_fmt).load(src))
+    replace_output(tmp, dst)
+    return nbytes, streamed
+
+
+def load_manifest(path: os.PathLike | str) -> dict:
+    """
+    :param path: the manifest path
+    :return: the entries by input path, empty if there is no manifest yet
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(path: os.PathLike | str, entries: dict):
+    """
+    write the manifest under a temporary name and rename it, so that an interruption never leaves it truncated.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + '.part')
+    with open(tmp, 'w') as f:
+        json.dump(entries, f, indent=1)
+    os.replace(tmp, path)
+
+
+def convert_files(jobs, manifest=None, num_workers=0, read_ahead=2, memory_budget=1 << 30, progress=None,
+                  to: str = None, **kwargs):
+    """
+    convert many images through the pipeline of read-ahead threads and a pool of converting processes.
+
+    :param jobs: the (input, output) path pairs, see convert_image
+    :param manifest: the JSON manifest to record the outcome of each input in, and to skip the inputs done in an
+    earlier run, default as none
+    :param num_workers: number of converting processes, default as all cores
+    :param read_ahead: the number of inputs read ahead of the workers
+    :param memory_budget: the memory of each worker, the files larger than which are streamed
+    :param progress: a callback receiving the summary after each file
+    :param to: the output format of all the jobs, 'v3draw', 'v3dpbd' or 'terafly', default as told by the suffix of
+    each output
+    :param kwargs: passed to convert_image
+    :return: the summary: the numbers of files done, failed and skipped, the bytes converted, the elapsed seconds,
+    the throughput in files/s and MB/s of image data, and the entry of the last file
+    """
+    entries = load_manifest(manifest) if manifest is not None else {}
+    todo = deque()
+    skipped = 0
+    for src, dst in jobs:
+        e = entries.get(str(src))
+        if e is not None and e['status'] == 'done' and e['output'] == str(dst) and Path(dst).exists():
+            skipped += 1
+        else:
+            todo.append((src, dst))
+    summary = dict(total=len(todo) + skipped, done=0, failed=0, skipped=skipped, bytes=0, seconds=0.,
+                   files_per_s=0., mb_per_s=0., last=None)
+    n = num_workers if num_workers > 0 else os.cpu_count() or 1
+    t0 = perf_counter()
+    with ThreadPoolExecutor(max(read_ahead, 1)) as readers, ProcessPoolExecutor(n) as workers:
+        reading = deque()
+        running = {}
+        while todo or reading or running:
+            while todo and len(reading) < read_ahead + n - len(running):
+                src, dst = todo.popleft()
+                reading.append((src, dst, readers.submit(warm_cache, src, memory_budget)))
+            while reading and len(running) < n and reading[0][2].done():
+                src, dst, _ = reading.popleft()
+                running[workers.submit(convert_image, src, dst, memory_budget, to=to, **kwargs)] = (src, dst, perf_counter())
+            waiting = set(running)
+            if reading and len(running) < n:
+                waiting.add(reading[0][2])
+            finished, _ = wait(waiting, return_when=FIRST_COMPLETED)
+            for f in finished:
+                if f not in running:
+                    continue
+                src, dst, t = running.pop(f)
+                e = dict(output=str(dst), seconds=perf_counter() - t)
+                try:
+                    e['bytes'], e['streamed'] = f.result()
+                    e['status'] = 'done'
+                    summary['done'] += 1
+                    summary['bytes'] += e['bytes']
+                except Exception as ex:
+                    e['status'], e['error'] = 'failed', f'{type(ex).__name__}: {ex}'
+                    summary['failed'] += 1
+                entries[str(src)] = e
+                if manifest is not None:
+                    save_manifest(manifest, entries)
+                summary['seconds'] = perf_counter() - t0
+                summary['files_per_s'] = (summary['done'] + summary['failed']) / summary['seconds']
+                summary['mb_per_s'] = summary['bytes'] / 1e6 / summary['seconds']
+                summary['last'] = dict(input=str(src), **e)
+                if progress is not None:
+                    progress(summary)
+    summary['seconds'] = perf_counter() - t0
+    return summary
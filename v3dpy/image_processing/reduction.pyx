@@ -0,0 +1,238 @@
+"""
+Streaming reductions of volumes larger than the memory. The volume is read once in z slabs, from an array, a
+v3draw/v3dpbd file or a TeraFly resolution, and each slab is reduced in a single pass into all the requested
+statistics: the maximum intensity projections along each axis, the histogram and its quantiles, the mean, std,
+min and max, and a block-mean downsampled volume. Slabs are reduced in parallel threads and the partial results
+merged.
+"""
+
+cimport numpy as np
+import numpy as np
+import os
+import cython
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+ctypedef fused voxel_t:
+    np.uint8_t
+    np.uint16_t
+    np.float32_t
+
+
+REDUCTIONS = ('mip', 'histogram', 'moments')
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void reduce_kernel(const voxel_t[:, :, ::1] slab, long long[::1] hist, double[::1] moments, voxel_t[:, ::1] mip_z,
+                        voxel_t[:, ::1] mip_y, voxel_t[:, ::1] mip_x, double[:, :, ::1] down, long long[::1] down_x,
+                        int kz, int ky):
+    """
+    reduce a slab in one pass, skipping the outputs of size 0.
+
+    :param slab: the slab (Z, Y, X)
+    :param hist: the histogram to add to, indexed by the voxel value
+    :param moments: sum, sum of squares, min and max of the slab
+    :param mip_z: the projection of the slab along z (Y, X)
+    :param mip_y: the projection along y (Z, X) of the slab
+    :param mip_x: the projection along x (Z, Y) of the slab
+    :param down: the block sums of the slab
+    :param down_x: the block index of each x
+    :param kz: the block depth
+    :param ky: the block height
+    """
+    cdef:
+        Py_ssize_t z, y, x, dz, dy
+        voxel_t v, row_max, vmin = slab[0, 0, 0], vmax = slab[0, 0, 0]
+        double d, s = 0., s2 = 0.
+        bint do_hist = hist.shape[0] > 0, do_mip = mip_z.shape[0] > 0, do_moments = moments.shape[0] > 0
+        bint do_down = down.shape[0] > 0
+    with nogil:
+        for z in range(slab.shape[0]):
+            dz = z // kz
+            for y in range(slab.shape[1]):
+                dy = y // ky
+                row_max = slab[z, y, 0]
+                for x in range(slab.shape[2]):
+                    v = slab[z, y, x]
+                    if do_moments:
+                        d = v
+                        s += d
+                        s2 += d * d
+                        if v < vmin:
+                            vmin = v
+                        if v > vmax:
+                            vmax = v
+                    if voxel_t is not np.float32_t:
+                        if do_hist:
+                            hist[v] += 1
+                    if do_mip:
+                        if v > row_max:
+                            row_max = v
+                        if z == 0 or v > mip_z[y, x]:
+                            mip_z[y, x] = v
+                        if y == 0 or v > mip_y[z, x]:
+                            mip_y[z, x] = v
+                    if do_down:
+                        down[dz, dy, down_x[x]] += v
+                if do_mip:
+                    mip_x[z, y] = row_max
+        if do_moments:
+            moments[0] = s
+            moments[1] = s2
+            moments[2] = vmin
+            moments[3] = vmax
+
+
+def reduce_slab(slab, reductions, factors=None):
+    """
+    reduce a slab into its partial results.
+
+    :param slab: the slab (Z, Y, X) of uint8, uint16 or float32
+    :param reductions: the names of the reductions, from 'mip', 'histogram' and 'moments'
+    :param factors: the downsampling factors (z, y, x), default as no downsampling
+    :return: a dict of the histogram, the moments [sum, sum of squares, min, max], the projections along z, y and
+    x, and the block means of the slab, as requested
+    """
+    slab = np.ascontiguousarray(slab)
+    depth, height, width = slab.shape
+    dtype = slab.dtype
+    if 'histogram' in reductions and dtype == np.float32:
+        raise ValueError("The histogram only supports uint8 and uint16")
+    hist = np.zeros(1 << dtype.itemsize * 8 if 'histogram' in reductions else 0, dtype=np.int64)
+    moments = np.zeros(4 if 'moments' in reductions else 0, dtype=np.float64)
+    n = 1 if 'mip' in reductions else 0
+    mip_z = np.empty((height * n, width), dtype=dtype)
+    mip_y = np.empty((depth * n, width), dtype=dtype)
+    mip_x = np.empty((depth * n, height), dtype=dtype)
+    kz, ky, kx = factors if factors is not None else (1, 1, 1)
+    down_shape = [-(-s // k) for s, k in zip(slab.shape, (kz, ky, kx))] if factors is not None else (0, 0, 0)
+    down = np.zeros(down_shape, dtype=np.float64)
+    down_x = np.arange(width, dtype=np.int64) // kx
+    if dtype == np.uint8:
+        reduce_kernel[np.uint8_t](slab, hist, moments, mip_z, mip_y, mip_x, down, down_x, kz, ky)
+    elif dtype == np.uint16:
+        reduce_kernel[np.uint16_t](slab, hist, moments, mip_z, mip_y, mip_x, down, down_x, kz, ky)
+    elif dtype == np.float32:
+        reduce_kernel[np.float32_t](slab, hist, moments, mip_z, mip_y, mip_x, down, down_x, kz, ky)
+    else:
+        raise ValueError(f"Unsupported pixel type {dtype}")
+    res = {}
+    if 'histogram' in reductions:
+        res['histogram'] = hist
+    if 'moments' in reductions:
+        res['moments'] = moments
+    if 'mip' in reductions:
+        res['mip_z'], res['mip_y'], res['mip_x'] = mip_z, mip_y, mip_x
+    if factors is not None:
+        # divide by the voxels in each block, fewer at the far edges
+        counts = [np.minimum(k, s - np.arange(0, s, k)) for s, k in zip(slab.shape, (kz, ky, kx))]
+        res['downsample'] = down / (counts[0][:, None, None] * counts[1][None, :, None] * counts[2])
+    return res
+
+
+def histogram_quantiles(hist: np.ndarray, q):
+    """
+    quantiles of the voxel values from their histogram, the smallest values with at least the fraction q of the
+    voxels lower or equal.
+
+    :param hist: the histogram indexed by the voxel value
+    :param q: a quantile or a sequence of them, in [0, 1]
+    :return: the voxel values of the quantiles
+    """
+    cdf = np.cumsum(hist)
+    q = np.asarray(q, dtype=np.float64)
+    return np.searchsorted(cdf, np.maximum(np.ceil(q * cdf[-1]), 1))
+
+
+def reduce_volume(src, reductions=REDUCTIONS, downsample=None, quantiles=None, region=None, slab_depth=64,
+                  num_workers=0):
+    """
+    compute statistics of a volume in one streaming pass. Each worker thread holds one slab at a time, so the memory
+    use is bounded by the slab size besides the results.
+
+    :param src: a 3D (Z, Y, X) or single channel 4D array, a v3draw/v3dpbd path, a TeraFly resolution path or a
+    TeraflyInterface, of uint8, uint16 or float32
+    :param reductions: the names of the reductions, from 'mip', 'histogram' and 'moments'
+    :param downsample: the block-mean downsampling factor, an int or (z, y, x), default as no downsampling
+    :param quantiles: the quantiles to compute from the histogram, e.g. (.5, .99) to choose a background threshold
+    :param region: the region (x0, x1, y0, y1, z0, z1) to reduce, ends exclusive, default as the whole volume
+    :param slab_depth: the number of z slices read at a time, rounded up to a multiple of the z downsampling factor
+    :param num_workers: number of slabs reduced at the same time, default as all cores
+    :return: a dict with the requested results:
+    'mip_z', 'mip_y', 'mip_x' the maximum intensity projections along each axis, of shape (Y, X), (Z, X) and (Z, Y);
+    'histogram' the voxel counts of each value; 'quantiles' the voxel values at the quantiles;
+    'mean', 'std', 'min', 'max' of the voxels;
+    'downsample' the block means rounded to the pixel type, the blocks at the far edges can be smaller
+    """
+    from ..slabs import open_slabs
+    reductions = set(reductions)
+    if quantiles is not None:
+        reductions.add('histogram')
+    unknown = reductions - set(REDUCTIONS)
+    if unknown:
+        raise ValueError(f"Unknown reductions {unknown}")
+    factors = None
+    if downsample is not None:
+        factors = (downsample,) * 3 if np.isscalar(downsample) else tuple(downsample)
+        factors = tuple(int(k) for k in factors)
+        assert len(factors) == 3 and min(factors) >= 1, "The downsampling factors have to be positive"
+        slab_depth = -(-slab_depth // factors[0]) * factors[0]
+    shape, dtype, slabs = open_slabs(src, slab_depth, region)
+    depth, height, width = shape
+
+    res = {}
+    if 'mip' in reductions:
+        res['mip_z'] = None
+        res['mip_y'] = np.empty((depth, width), dtype=dtype)
+        res['mip_x'] = np.empty((depth, height), dtype=dtype)
+    if factors is not None:
+        res['downsample'] = np.empty([-(-s // k) for s, k in zip(shape, factors)], dtype=dtype)
+    hist = None
+    moments = []
+
+    def merge(z, part):
+        nonlocal hist
+        if 'histogram' in part:
+            hist = part['histogram'] if hist is None else hist + part['histogram']
+        if 'moments' in part:
+            moments.append(part['moments'])
+        if 'mip_z' in part:
+            res['mip_z'] = part['mip_z'] if res['mip_z'] is None else np.maximum(res['mip_z'], part['mip_z'])
+            res['mip_y'][z:z + len(part['mip_y'])] = part['mip_y']
+            res['mip_x'][z:z + len(part['mip_x'])] = part['mip_x']
+        if 'downsample' in part:
+            down = part['downsample']
+            if dtype != np.float32:
+                down = np.rint(down)
+            zd = z // factors[0]
+            res['downsample'][zd:zd + len(down)] = down
+
+    n = num_workers if num_workers > 0 else os.cpu_count() or 1
+    with ThreadPoolExecutor(n) as pool:
+        pending = deque()
+        z = 0
+        for slab in slabs:
+            pending.append((z, pool.submit(reduce_slab, slab, reductions, factors)))
+            z += slab.shape[0]
+            # bound the slabs in flight
+            while len(pending) > n:
+                z0, f = pending.popleft()
+                merge(z0, f.result())
+        while pending:
+            z0, f = pending.popleft()
+            merge(z0, f.result())
+
+    if 'histogram' in reductions:
+        res['histogram'] = hist
+        if quantiles is not None:
+            res['quantiles'] = histogram_quantiles(hist, quantiles)
+    if 'moments' in reductions:
+        moments = np.array(moments)
+        count = depth * height * width
+        res['mean'] = moments[:, 0].sum() / count
+        res['std'] = np.sqrt(max(moments[:, 1].sum() / count - res['mean'] ** 2, 0.))
+        res['min'] = moments[:, 2].min().astype(dtype)
+        res['max'] = moments[:, 3].max().astype(dtype)
+    return res
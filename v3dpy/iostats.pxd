@@ -0,0 +1,13 @@
+from libc.stdint cimport int64_t
+
+
+cdef class IOStats:
+    cdef:
+        public int64_t calls, files_opened, bytes_read, tiles_touched, cache_hits, cache_misses
+        public int64_t disk_hits, disk_misses
+        public int64_t open_ns, read_ns, decode_ns, copy_ns
+        public object callback
+        object lock
+
+    cpdef void merge(self, IOStats other)
+    cpdef void report(self, str op, IOStats call)
@@ -0,0 +1,82 @@
+"""
+Opt-in I/O statistics of the loaders. Attach an IOStats to a PBD, Raw or TeraflyInterface to accumulate the counters
+and timers of every load, and optionally have each call reported to a callback, e.g. to export them to a metrics
+system. Without one, the loaders skip all the timing.
+"""
+
+from threading import Lock
+
+
+cdef class IOStats:
+    """
+    Counters and timers accumulated over the loading calls.
+
+    * calls: the number of loading calls
+    * files_opened: the number of files opened
+    * bytes_read: the bytes read from the files. For tiffs, libtiff does the reading, and the decoded bytes are counted
+    * tiles_touched: the number of TeraFly tile files a crop intersects, NULL tiles excluded
+    * cache_hits, cache_misses: the tile cache lookups of TeraFly crops
+    * disk_hits, disk_misses: the disk chunk cache lookups of TeraFly crops, after missing the tile cache
+    * open_ns: the time of opening files and parsing their headers, e.g. TIFFOpen and counting the pages
+    * read_ns: the time of reading the file contents that is not part of decoding
+    * decode_ns: the time of decoding, e.g. PBD decompression, or tiff page seeking, strip decoding and byte swapping
+    * copy_ns: the time of copying decoded tiles into the crops
+    """
+    def __init__(self, callback=None):
+        """
+        :param callback: a function called as callback(op, stats) after each loading call, where op names the call,
+        e.g. 'PBD.load', and stats is an IOStats of that call alone. It can be called from multiple threads.
+        """
+        self.callback = callback
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all the counters and timers.
+        """
+        self.calls = self.files_opened = self.bytes_read = self.tiles_touched = self.cache_hits = \
+            self.cache_misses = self.disk_hits = self.disk_misses = self.open_ns = self.read_ns = self.decode_ns = \
+            self.copy_ns = 0
+
+    cpdef void merge(self, IOStats other):
+        """
+        Add the counters and timers of another IOStats to this one.
+        """
+        self.calls += other.calls
+        self.files_opened += other.files_opened
+        self.bytes_read += other.bytes_read
+        self.tiles_touched += other.tiles_touched
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.disk_hits += other.disk_hits
+        self.disk_misses += other.disk_misses
+        self.open_ns += other.open_ns
+        self.read_ns += other.read_ns
+        self.decode_ns += other.decode_ns
+        self.copy_ns += other.copy_ns
+
+    cpdef void report(self, str op, IOStats call):
+        """
+        Count a finished call, add its statistics and pass them to the callback.
+
+        :param op: the name of the call
+        :param call: the statistics of the call alone
+        """
+        call.calls = 1
+        with self.lock:
+            self.merge(call)
+        if self.callback is not None:
+            self.callback(op, call)
+
+    def as_dict(self) -> dict:
+        """
+        :return: the counters and timers by name
+        """
+        return dict(calls=self.calls, files_opened=self.files_opened, bytes_read=self.bytes_read,
+                    tiles_touched=self.tiles_touched, cache_hits=self.cache_hits, cache_misses=self.cache_misses,
+                    disk_hits=self.disk_hits, disk_misses=self.disk_misses, open_ns=self.open_ns, read_ns=self.read_ns,
+                    decode_ns=self.decode_ns, copy_ns=self.copy_ns)
+
+    def __repr__(self):
+        return f"IOStats({', '.join(f'{k}={v}' for k, v in self.as_dict().items())})"
@@ -1,11 +1,14 @@
 import struct
 import os
+from concurrent.futures import ThreadPoolExecutor
 import cython
 cimport cython
 import numpy as np
 cimport numpy as np
 import sys
+from time import perf_counter_ns
 
+from ..iostats cimport IOStats
 from cpython.bytearray cimport PyByteArray_AsString
 from libc.stdio cimport FILE, fopen, fread, fclose, fwrite
 
@@ -40,34 +43,37 @@ cdef class PBD:
     2022/6/23
     """
     cdef:
-        long long total_read_bytes, compression_pos, decompression_pos, read_step_size_bytes
+        long long total_read_bytes, compression_pos, decompression_pos, read_step_size_bytes, look_ahead_pos
         bytearray compression_buffer, decompression_buffer
         bint endian_switch, pbd16_full_blood
         bytes endian_sys
+        public IOStats stats
 
-    def __init__(self, pbd16_full_blood=True, read_step_size_bytes = 1024 * 20000):
+    def __init__(self, pbd16_full_blood=True, read_step_size_bytes = 1024 * 20000, IOStats stats=None):
         """
         :param pbd16_full_blood: Turn off or on to allow the full blood saving of 16bit image loading. Note
          other programs may not be able to load it. Default is on. Default as turned on.
         :param read_step_size_bytes: Adjust the number of bytes for each time of buffer loading, default as 20000KB.
+        :param stats: an IOStats to accumulate the loading statistics in, default as None (no instrumentation).
         """
+        self.stats = stats
         self.endian_sys = sys.byteorder[0].upper().encode('ascii')
         self.endian_switch = False
-        self.decompression_pos = self.compression_pos = self.total_read_bytes = 0
+        self.decompression_pos = self.compression_pos = self.total_read_bytes = self.look_ahead_pos = 0
         self.compression_buffer = self.decompression_buffer = bytearray()
         self.pbd16_full_blood = pbd16_full_blood
         self.read_step_size_bytes = read_step_size_bytes
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef long long decompress_pbd8(self, long long look_ahead):
+    cdef long long decompress_pbd8(self, long long look_ahead, long long limit):
         cdef:
             unsigned char* decomp = <unsigned char*>PyByteArray_AsString(self.decompression_buffer)
             unsigned char* comp = <unsigned char*>PyByteArray_AsString(self.compression_buffer)
             long long cp = self.compression_pos, dp = self.decompression_pos
             unsigned char count, shift, carry
             char delta
-        while cp < look_ahead:
+        while cp < look_ahead and dp < limit:
             count = comp[cp]
             cp += 1
             if count < 33:
@@ -96,11 +102,12 @@ cdef class PBD:
                     decomp[dp + shift] = comp[cp]
                 dp += count
                 cp += 1
+        self.compression_pos = cp
         return dp
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef long long decompress_pbd16(self, long long look_ahead):
+    cdef long long decompress_pbd16(self, long long look_ahead, long long limit):
         cdef:
             unsigned char * decomp = <unsigned char *> PyByteArray_AsString(self.decompression_buffer)
             unsigned char * comp = <unsigned char *> PyByteArray_AsString(self.compression_buffer)
@@ -110,7 +117,7 @@ cdef class PBD:
             unsigned short carry
             unsigned short* ptr
 
-        while cp < look_ahead:
+        while cp < look_ahead and dp < limit:
             count = comp[cp]
             cp += 1
             if count < 32:
@@ -161,13 +168,14 @@ cdef class PBD:
                 ptr += 1
                 dp += 2
                 count -= 1
+        self.compression_pos = cp
         return dp
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef void update_compression_buffer8(self):
+    cdef void update_compression_buffer8(self, long long limit):
         cdef:
-            long long look_ahead = self.compression_pos
+            long long look_ahead = max(self.compression_pos, self.look_ahead_pos)
             unsigned char lav, compressed_diff_entries
         while look_ahead < self.total_read_bytes:
             lav = self.compression_buffer[look_ahead]
@@ -187,14 +195,14 @@ cdef class PBD:
                     look_ahead += 2
                 else:
                     break
-        self.decompression_pos = self.decompress_pbd8(look_ahead)
-        self.compression_pos = look_ahead
+        self.look_ahead_pos = look_ahead
+        self.decompression_pos = self.decompress_pbd8(look_ahead, limit)
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef void update_compression_buffer16(self):
+    cdef void update_compression_buffer16(self, long long limit):
         cdef:
-            long long look_ahead = self.compression_pos
+            long long look_ahead = max(self.compression_pos, self.look_ahead_pos)
             unsigned char lav, compressed_diff_bytes
         while look_ahead < self.total_read_bytes:
             lav = self.compression_buffer[look_ahead]
@@ -226,8 +234,22 @@ cdef class PBD:
                     look_ahead += 3
                 else:
                     break
-        self.decompression_pos = self.decompress_pbd16(look_ahead)
-        self.compression_pos = look_ahead
+        self.look_ahead_pos = look_ahead
+        self.decompression_pos = self.decompress_pbd16(look_ahead, limit)
+
+    cdef tuple parse_header(self, bytearray header):
+        """
+        Parse the header of a v3dpbd file and set up the endian switch for decompression.
+
+        :return: the endian of the file, the datatype in bytes, the dimension sizes from x to c
+        """
+        assert header.find(FORMAT_KEY) == 0, "Format key loading failed."
+        header = header[len(FORMAT_KEY):]
+        endian = '<' if header[:1] == LITTLE else '>'
+        self.endian_switch = header[:1] != self.endian_sys
+        datatype = struct.unpack(f'{endian}h', header[1:3])[0]
+        assert datatype in [1, 2], "Datatype can only be 1 or 2."
+        return endian, datatype, struct.unpack(f'{endian}iiii', header[3:])
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
@@ -237,6 +259,10 @@ cdef class PBD:
         :param path: output image path of v3dpbd.
         :return: a 4D numpy array of either uint8 or uint16.
         """
+        cdef IOStats call = IOStats() if self.stats is not None else None
+        cdef long long t
+        if call is not None:
+            t = perf_counter_ns()
         file_size = os.path.getsize(path)
         assert file_size >= HEADER_SIZE, "File size smaller than header size."
         cdef:
@@ -249,35 +275,111 @@ cdef class PBD:
         try:
             header = bytearray(HEADER_SIZE)
             fread(PyByteArray_AsString(header), HEADER_SIZE, 1, f)
-            assert header.find(FORMAT_KEY) == 0, "Format key loading failed."
-            header = header[len(FORMAT_KEY):]
-            endian = '<' if header[:1] == LITTLE else '>'
-            self.endian_switch = header[:1] != self.endian_sys
-            datatype = struct.unpack(f'{endian}h', header[1:3])[0]
-            assert datatype in [1, 2], "Datatype can only be 1 or 2."
-            sz = struct.unpack(f'{endian}iiii', header[3:])
+            endian, datatype, sz = self.parse_header(header)
             channel_len = sz[0] * sz[1] * sz[2]
             remaining_bytes = file_size - HEADER_SIZE
             self.total_read_bytes = 0
             self.compression_buffer = bytearray(remaining_bytes)
             self.decompression_buffer = bytearray(channel_len * sz[3] * datatype)
-            self.compression_pos = self.decompression_pos = 0
+            self.compression_pos = self.decompression_pos = self.look_ahead_pos = 0
+            if call is not None:
+                call.files_opened += 1
+                call.bytes_read += HEADER_SIZE
+                call.open_ns += perf_counter_ns() - t
             while remaining_bytes > 0:
                 current_read_bytes = min(remaining_bytes, self.read_step_size_bytes,
                                          (self.total_read_bytes // channel_len + 1) *
                                          channel_len - self.total_read_bytes)
+                if call is not None:
+                    t = perf_counter_ns()
                 fread(PyByteArray_AsString(self.compression_buffer) + self.total_read_bytes, current_read_bytes, 1, f)
                 self.total_read_bytes += current_read_bytes
                 remaining_bytes -= current_read_bytes
+                if call is not None:
+                    call.bytes_read += current_read_bytes
+                    call.read_ns += perf_counter_ns() - t
+                    t = perf_counter_ns()
                 if datatype == 1:
-                    self.update_compression_buffer8()
+                    self.update_compression_buffer8(len(self.decompression_buffer))
                 elif datatype == 2:
-                    self.update_compression_buffer16()
+                    self.update_compression_buffer16(len(self.decompression_buffer))
                 else:
                     raise Exception("Invalid datatype")
-            return np.frombuffer(self.decompression_buffer, f'{endian}u{datatype}').reshape(sz[::-1])
+                if call is not None:
+                    call.decode_ns += perf_counter_ns() - t
         finally:
             fclose(f)
+        if call is not None:
+            self.stats.report('PBD.load', call)
+        return np.frombuffer(self.decompression_buffer, f'{endian}u{datatype}').reshape(sz[::-1])
+
+    cpdef tuple read_header(self, path: str | os.PathLike):
+        """
+        :param path: input image path of v3dpbd.
+        :return: the 4D image shape (C,Z,Y,X) and the pixel type.
+        """
+        assert os.path.getsize(path) >= HEADER_SIZE, "File size smaller than header size."
+        with open(path, 'rb') as f:
+            endian, datatype, sz = self.parse_header(bytearray(f.read(HEADER_SIZE)))
+        return sz[::-1], np.dtype(f'u{datatype}')
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def load_slabs(self, path: str | os.PathLike, int slab_depth):
+        """
+        Load an image slab by slab along z, channel by channel. The compressed stream is read and decompressed
+        progressively, only as far as the current slab, so the memory use is bounded by the slab size and
+        read_step_size_bytes rather than the image size.
+
+        :param path: input image path of v3dpbd.
+        :param slab_depth: the number of z slices of a slab.
+        :return: a generator of native-endian 3D arrays (Z,Y,X), the reverse of save_slabs.
+        """
+        file_size = os.path.getsize(path)
+        assert file_size >= HEADER_SIZE, "File size smaller than header size."
+        cdef:
+            short datatype
+            long long remaining_bytes = file_size - HEADER_SIZE, plane_bytes, slab_bytes, n, tail, chunk
+            # room for the last decompressed value that the difference tokens of the next slab start from
+            long long prefix = 2
+        with open(path, 'rb') as f:
+            endian, datatype, sz = self.parse_header(bytearray(f.read(HEADER_SIZE)))
+            dtype = np.dtype(f'=u{datatype}')
+            plane_bytes = <long long>sz[0] * sz[1] * datatype
+            slab_bytes = plane_bytes * slab_depth
+            # a token decompresses to at most 255 bytes, which is how far a slab can be overrun
+            self.decompression_buffer = bytearray(prefix + slab_bytes + 256)
+            self.compression_buffer = bytearray(min(self.read_step_size_bytes, remaining_bytes) + 256)
+            self.decompression_pos = prefix
+            self.compression_pos = self.total_read_bytes = self.look_ahead_pos = 0
+            for c in range(sz[3]):
+                for z in range(0, sz[2], slab_depth):
+                    n = min(slab_depth, sz[2] - z) * plane_bytes
+                    while self.decompression_pos - prefix < n:
+                        if datatype == 1:
+                            self.update_compression_buffer8(prefix + n)
+                        else:
+                            self.update_compression_buffer16(prefix + n)
+                        if self.decompression_pos - prefix >= n:
+                            break
+                        # move the incomplete token to the front and read more
+                        tail = self.total_read_bytes - self.compression_pos
+                        if remaining_bytes == 0:
+                            raise Exception("Compressed data ended before the image is filled.")
+                        self.compression_buffer[:tail] = self.compression_buffer[self.compression_pos:
+                                                                                 self.total_read_bytes]
+                        self.look_ahead_pos -= self.compression_pos
+                        self.compression_pos = 0
+                        chunk = min(remaining_bytes, len(self.compression_buffer) - tail)
+                        f.readinto(memoryview(self.compression_buffer)[tail:tail + chunk])
+                        self.total_read_bytes = tail + chunk
+                        remaining_bytes -= chunk
+                    slab = np.frombuffer(self.decompression_buffer, dtype, n // datatype, prefix).copy()
+                    yield slab.reshape(-1, sz[1], sz[0])
+                    # keep the overrun, behind the last value of this slab
+                    self.decompression_buffer[:self.decompression_pos - n] = \
+                        self.decompression_buffer[n:self.decompression_pos]
+                    self.decompression_pos -= n
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
@@ -491,3 +593,60 @@ cdef class PBD:
                 "Buffer saving failed."
         finally:
             fclose(f)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef void save_slabs(self, path: str | os.PathLike, tuple shape, dtype, slabs):
+        """
+        Save an image slab by slab, without holding the whole image in memory. Each slab is compressed on its own,
+        so the output is a regular v3dpbd. The slabs are written in a background thread while the next ones are
+        compressed.
+
+        :param path: output image path of v3dpbd.
+        :param shape: the 4D shape (C,Z,Y,X) of the image.
+        :param dtype: the pixel type, uint8 or uint16.
+        :param slabs: an iterable of 3D arrays (Z,Y,X) stacking up the image along z, channel by channel.
+        """
+        assert len(shape) == 4, "The image has to be 4D"
+        dtype = np.dtype(dtype)
+        assert dtype in [np.uint8, np.uint16], "The pixel type has to be uint8 or uint16"
+        cdef:
+            bytearray header
+            int[4] sz = [shape[0], shape[1], shape[2], shape[3]]
+            int[:] size = sz
+            long long compression_size, written = 0, total = <long long>sz[0] * sz[1] * sz[2] * sz[3]
+            short datatype = dtype.itemsize
+            # slabs are compressed into one buffer while the other is being written
+            list buffers = [bytearray(), bytearray()]
+            int k = 0
+        endian = '<' if self.endian_sys == LITTLE else '>'
+        header = bytearray(FORMAT_KEY + self.endian_sys + struct.pack(f'{endian}hiiii', datatype, *size[::-1]))
+        with open(path, 'wb') as f, ThreadPoolExecutor(1) as writer:
+            pending = writer.submit(f.write, header)
+            self.decompression_buffer = bytearray()
+            for slab in slabs:
+                slab = np.ascontiguousarray(slab, dtype=dtype.newbyteorder('='))
+                assert slab.ndim == 3 and slab.shape[1:] == tuple(shape[2:]), "Slab shape doesn't match the image"
+                written += slab.size
+                if written > total:
+                    raise Exception("Slabs exceeding the image size.")
+                if slab.size == 0:
+                    continue
+                self.decompression_pos = slab.nbytes
+                if len(self.decompression_buffer) < self.decompression_pos:
+                    self.decompression_buffer = bytearray(self.decompression_pos)
+                if len(buffers[k]) < self.decompression_pos * COMPRESSION_ENLARGEMENT:
+                    buffers[k] = bytearray(self.decompression_pos * COMPRESSION_ENLARGEMENT)
+                self.compression_buffer = buffers[k]
+                self.decompression_buffer[:self.decompression_pos] = slab.data.cast('B')
+                self.compression_pos = len(self.compression_buffer)
+                if datatype == 1:
+                    compression_size = self.compress_pbd8()
+                else:
+                    compression_size = self.compress_pbd16()
+                pending.result()
+                pending = writer.submit(f.write, memoryview(self.compression_buffer)[:compression_size])
+                k = 1 - k
+            pending.result()
+            if written != total:
+                raise Exception("Slabs don't fill up the image.")
@@ -2,10 +2,13 @@ import io
 import os
 import struct
 import sys
+from time import perf_counter_ns
+from concurrent.futures import ThreadPoolExecutor
 import cython
 cimport cython
 import numpy as np
 cimport numpy as np
+from ..iostats cimport IOStats
 
 
 DEF FORMAT_KEY_4 = b"raw_image_stack_by_hpeng"
@@ -32,19 +35,22 @@ cdef class Raw:
     """
     cdef:
         bint sz2byte
+        public IOStats stats
 
-    def __init__(self, sz2byte = False):
+    def __init__(self, sz2byte = False, IOStats stats=None):
         """
 
         :param sz2byte: set size array to be 2 byte (short int), for compatibility. Default as False.
+        :param stats: an IOStats to accumulate the loading statistics in, default as None (no instrumentation).
         """
         self.sz2byte = sz2byte
+        self.stats = stats
 
-    cpdef np.ndarray load(self, path: str | os.PathLike, int choose = -1):
+    cdef tuple parse_header(self, f, long long filesize):
         """
-        :param path: input image path of v3draw.
-        :param choose: choose a channel(4D) or stack(5D) to load, starting from 0, default as -1, meaning all.
-        :return: a numpy array of 4D or 5D based on the format key.
+        Parse the header at the beginning of an opened v3draw file.
+
+        :return: the header size, the numpy dtype string of the pixels, the dimension sizes from x to the last
         """
         cdef:
             short datatype
@@ -53,55 +59,114 @@ cdef class Raw:
             str endian, dt
             char dim, header_sz, i
             bytes format_key
-            long long bulk_sz, filesize
+            long long bulk_sz
 
+        format_key = f.read(FORMAT_LEN)
+        if format_key == FORMAT_KEY_4:
+            dim = 4
+        elif format_key == FORMAT_KEY_5:
+            dim = 5
+        else:
+            raise RuntimeError("Format key isn't for v3draw")
+        if self.sz2byte:
+            header_sz = FORMAT_LEN + dim * 2 + 2 + 1
+        else:
+            header_sz = FORMAT_LEN + dim * 4 + 2 + 1
+        assert filesize >= header_sz, "File size too small, file might be corrupted"
+        endian_code_data = f.read(1)
+        if endian_code_data == b'B':
+            endian = '>'
+        elif endian_code_data == b'L':
+            endian = '<'
+        else:
+            raise RuntimeError('Endian code should be either B/L')
+        datatype = struct.unpack(f'{endian}h', f.read(2))[0]
+        if datatype == 1:
+            dt = 'u1'
+        elif datatype == 2:
+            dt = 'u2'
+        elif datatype == 4:
+            dt = 'f4'
+        else:
+            raise RuntimeError('v3draw data type can only be 1/2/4')
+        if self.sz2byte:
+            sz = list(struct.unpack(f'{endian}{dim}h', f.read(dim * 2)))
+        else:
+            sz = list(struct.unpack(f'{endian}{dim}i', f.read(dim * 4)))
+        bulk_sz = 1
+        for i in range(dim):
+            bulk_sz *= sz[i]
+        assert bulk_sz * datatype + header_sz == filesize, "file size doesn't match with the image"
+        return header_sz, endian + dt, sz
+
+    cpdef np.ndarray load(self, path: str | os.PathLike, int choose = -1):
+        """
+        :param path: input image path of v3draw.
+        :param choose: choose a channel(4D) or stack(5D) to load, starting from 0, default as -1, meaning all.
+        :return: a numpy array of 4D or 5D based on the format key.
+        """
+        cdef:
+            list sz
+            str dt
+            long long header_sz, filesize, t
+            bytes buf
+            IOStats call = IOStats() if self.stats is not None else None
+
+        if call is not None:
+            t = perf_counter_ns()
         filesize = os.path.getsize(path)
         assert filesize >= FORMAT_LEN, "File size too small, file might be corrupted"
 
         with open(path, "rb") as f:
-            format_key = f.read(FORMAT_LEN)
-            if format_key == FORMAT_KEY_4:
-                dim = 4
-            elif format_key == FORMAT_KEY_5:
-                dim = 5
-            else:
-                raise RuntimeError("Format key isn't for v3draw")
-            if self.sz2byte:
-                header_sz = FORMAT_LEN + dim * 2 + 2 + 1
-            else:
-                header_sz = FORMAT_LEN + dim * 4 + 2 + 1
-            assert filesize >= header_sz, "File size too small, file might be corrupted"
-            endian_code_data = f.read(1)
-            if endian_code_data == b'B':
-                endian = '>'
-            elif endian_code_data == b'L':
-                endian = '<'
-            else:
-                raise RuntimeError('Endian code should be either B/L')
-            datatype = struct.unpack(f'{endian}h', f.read(2))[0]
-            if datatype == 1:
-                dt = 'u1'
-            elif datatype == 2:
-                dt = 'u2'
-            elif datatype == 4:
-                dt = 'f4'
-            else:
-                raise RuntimeError('v3draw data type can only be 1/2/4')
-            if self.sz2byte:
-                sz = list(struct.unpack(f'{endian}{dim}h', f.read(dim * 2)))
-            else:
-                sz = list(struct.unpack(f'{endian}{dim}i', f.read(dim * 4)))
-            bulk_sz = 1
-            for i in range(dim - 1):
-                bulk_sz *= sz[i]
-            assert bulk_sz * sz[-1] * datatype + header_sz == filesize, "file size doesn't match with the image"
+            header_sz, dt, sz = self.parse_header(f, filesize)
+            if call is not None:
+                call.files_opened += 1
+                call.bytes_read += header_sz
+                call.open_ns += perf_counter_ns() - t
+                t = perf_counter_ns()
             if choose < 0:
-                return np.frombuffer(f.read(), endian + dt).reshape(sz[::-1])
+                buf = f.read()
             else:
                 assert choose < sz[-1], "Choose index exceeding the range"
-                f.seek(bulk_sz * datatype * choose, 1)
-                img = np.frombuffer(f.read(bulk_sz * datatype), endian + dt)
-                return img.reshape(sz[-2::-1])
+                f.seek((filesize - header_sz) // sz[-1] * choose, 1)
+                buf = f.read((filesize - header_sz) // sz[-1])
+            if call is not None:
+                call.bytes_read += len(buf)
+                call.read_ns += perf_counter_ns() - t
+                self.stats.report('Raw.load', call)
+        if choose < 0:
+            return np.frombuffer(buf, dt).reshape(sz[::-1])
+        return np.frombuffer(buf, dt).reshape(sz[-2::-1])
+
+    cpdef tuple read_header(self, path: str | os.PathLike):
+        """
+        :param path: input image path of v3draw.
+        :return: the image shape, 4D or 5D based on the format key, and the pixel type.
+        """
+        filesize = os.path.getsize(path)
+        assert filesize >= FORMAT_LEN, "File size too small, file might be corrupted"
+        with open(path, "rb") as f:
+            header_sz, dt, sz = self.parse_header(f, filesize)
+        return tuple(sz[::-1]), np.dtype(dt)
+
+    def load_slabs(self, path: str | os.PathLike, int slab_depth):
+        """
+        Load a 4D image slab by slab along z, channel by channel, through a memory map so that only the slab being
+        used is read into memory.
+
+        :param path: input image path of v3draw.
+        :param slab_depth: the number of z slices of a slab.
+        :return: a generator of 3D arrays (Z,Y,X), the reverse of save_slabs.
+        """
+        filesize = os.path.getsize(path)
+        assert filesize >= FORMAT_LEN, "File size too small, file might be corrupted"
+        with open(path, "rb") as f:
+            header_sz, dt, sz = self.parse_header(f, filesize)
+        assert len(sz) == 4, "Only 4D v3draw can be loaded by slabs"
+        img = np.memmap(path, dtype=dt, mode='r', offset=header_sz, shape=tuple(sz[::-1]))
+        for c in range(img.shape[0]):
+            for z in range(0, img.shape[1], slab_depth):
+                yield np.array(img[c, z:z + slab_depth])
 
     cpdef void save(self, path: str | os.PathLike, np.ndarray img):
         """
@@ -152,3 +217,47 @@ cdef class Raw:
             f.write(header)
             f.write(img.tobytes())
 
+    cpdef void save_slabs(self, path: str | os.PathLike, tuple shape, dtype, slabs):
+        """
+        Save an image slab by slab, without holding the whole image in memory. The slabs are written in a background
+        thread while the next ones are produced.
+
+        :param path: output image path of v3draw.
+        :param shape: the 4D shape (C,Z,Y,X) of the image.
+        :param dtype: the pixel type, uint8, uint16 or float32.
+        :param slabs: an iterable of 3D arrays (Z,Y,X) stacking up the image along z, channel by channel.
+        """
+        assert len(shape) == 4, "The image has to be 4D"
+        cdef:
+            short datatype
+            bytes endian_code_data = b'B' if sys.byteorder == 'big' else b'L'
+            str endian = '>' if sys.byteorder == 'big' else '<'
+            long long written = 0, total = shape[0] * shape[1] * shape[2] * shape[3]
+
+        dtype = np.dtype(dtype)
+        if dtype == np.uint8:
+            datatype = 1
+        elif dtype == np.uint16:
+            datatype = 2
+        elif dtype == np.float32:
+            datatype = 4
+        else:
+            raise RuntimeError("numpy data type not supported by v3draw")
+
+        header = struct.pack(f'{endian}{FORMAT_LEN}sch4{"h" if self.sz2byte else "i"}',
+                             FORMAT_KEY_4, endian_code_data, datatype, *shape[::-1])
+
+        with open(path, 'wb') as f, ThreadPoolExecutor(1) as writer:
+            pending = writer.submit(f.write, header)
+            for slab in slabs:
+                slab = np.asarray(slab)
+                assert slab.ndim == 3 and slab.shape[1:] == tuple(shape[2:]), "Slab shape doesn't match the image"
+                data = np.ascontiguousarray(slab, dtype=dtype.newbyteorder('=')).data
+                pending.result()
+                pending = writer.submit(f.write, data)
+                written += slab.size
+                if written > total:
+                    raise RuntimeError("Slabs exceeding the image size")
+            pending.result()
+        if written != total:
+            raise RuntimeError("Slabs don't fill up the image")
@@ -1,34 +1,276 @@
 cimport numpy as np
 import numpy as np
-from libc.math cimport sqrt, exp, pow
+import os
+from libc.math cimport sqrt, pow, floor
 import cython
+from cython.parallel import prange
+
+
+ctypedef fused voxel_t:
+    np.uint8_t
+    np.uint16_t
+    np.float32_t
+    np.float64_t
+
+
+cpdef np.ndarray as_voxel_array(img):
+    """
+    View an image as one of the pixel types the kernels are specialized for. uint8, uint16, float32 and float64
+    arrays are passed through without copying, including read-only and memory-mapped ones. Others are converted
+    to float32.
+
+    :param img: the neuronal image
+    :return: an array of a native supported pixel type
+    """
+    img = np.asarray(img)
+    if img.dtype.type not in (np.uint8, np.uint16, np.float32, np.float64):
+        return img.astype(np.float32)
+    if not img.dtype.isnative:
+        return img.astype(img.dtype.newbyteorder('='))
+    return img
+
+cpdef tuple gaussian_kernel_table(int window_radius, double sigma):
+    """
+    Precompute the offsets inside a spherical window and their Gaussian weights.
+
+    :param window_radius: the radius of the window
+    :param sigma: the standard deviation of the Gaussian
+    :return: offsets (N, 3) in x, y, z, weights (N,)
+    """
+    r = np.arange(-window_radius, window_radius + 1, dtype=np.int32)
+    dz, dy, dx = np.meshgrid(r, r, r, indexing='ij')
+    d2 = (dx * dx + dy * dy + dz * dz).ravel()
+    keep = d2 <= window_radius * window_radius
+    offsets = np.ascontiguousarray(np.stack([dx.ravel(), dy.ravel(), dz.ravel()], axis=1)[keep])
+    return offsets, np.exp(-d2[keep] / (2 * sigma * sigma))
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef neuron_meanshift(tree: list[tuple], img: np.ndarray, window_radius=32, order=2.):
+cpdef tuple markers_meanshift(xyz, img: np.ndarray, int window_radius=8, double sigma=0, double order=2.,
+                              int max_iter=20, double tol=.5, int num_threads=0):
     """
-    profile swc radius based on an image.
+    refine an array of markers towards the local intensity centroid by Gaussian meanshift, in parallel.
+
+    In each iteration, the marker moves to the mean of the voxels within the window around its nearest voxel,
+    weighted by the Gaussian of the offset and the intensity raised to the order.
+
+    :param xyz: marker coordinates of shape (N, 3), in x, y, z order
+    :param img: 3D neuronal image
+    :param window_radius: the radius of the meanshift window
+    :param sigma: the standard deviation of the Gaussian kernel, default as half the window radius
+    :param order: the order to scale the intensity
+    :param max_iter: the max number of iterations
+    :param tol: stop when a marker moves less than this distance
+    :param num_threads: number of threads, default as all cores
+    :return: refined coordinates (N, 3), number of iterations of each marker (N,)
+    """
+    assert img.ndim == 3
+    img = as_voxel_array(img)
+    cdef:
+        float[:, ::1] xyz_ = np.array(xyz, dtype=np.float32).reshape(-1, 3)
+        int[::1] iters = np.zeros(xyz_.shape[0], dtype=np.int32)
+        double[::1] lut
+        int n = num_threads if num_threads > 0 else os.cpu_count() or 1
+    offsets, weights = gaussian_kernel_table(window_radius, sigma if sigma > 0 else window_radius / 2.)
+    if img.dtype == np.uint8:
+        lut = np.arange(1 << 8, dtype=np.float64) ** order
+        markers_meanshift_kernel[np.uint8_t](xyz_, img, iters, offsets, weights, lut, order, max_iter, tol, n)
+    elif img.dtype == np.uint16:
+        lut = np.arange(1 << 16, dtype=np.float64) ** order
+        markers_meanshift_kernel[np.uint16_t](xyz_, img, iters, offsets, weights, lut, order, max_iter, tol, n)
+    elif img.dtype == np.float32:
+        lut = np.zeros(0)
+        markers_meanshift_kernel[np.float32_t](xyz_, img, iters, offsets, weights, lut, order, max_iter, tol, n)
+    else:
+        lut = np.zeros(0)
+        markers_meanshift_kernel[np.float64_t](xyz_, img, iters, offsets, weights, lut, order, max_iter, tol, n)
+    return np.asarray(xyz_), np.asarray(iters)
+
+
+cpdef neuron_meanshift(tree: list[tuple], img: np.ndarray, window_radius=8, order=2., sigma=0., max_iter=20,
+                       tol=.5, int num_threads=0):
+    """
+    refine swc node positions by meanshift, see markers_meanshift.
 
     :param tree: list of swc nodes 
     :param img: 3D neuronal image
-    :param window_radius: the max radius of meanshift window
+    :param window_radius: the radius of the meanshift window
     :param order: the order to scale the intensity
-    :return: 
+    :param sigma: the standard deviation of the Gaussian kernel, default as half the window radius
+    :param max_iter: the max number of iterations
+    :param tol: stop when a node moves less than this distance
+    :param num_threads: number of threads, default as all cores
+    :return: the swc tree with the refined positions
+    """
+    if len(tree) == 0:
+        return []
+    xyz, _ = markers_meanshift([t[2:5] for t in tree], img, window_radius, sigma, order, max_iter, tol, num_threads)
+    return [(*t[:2], *p, *t[5:]) for t, p in zip(tree, xyz.tolist())]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void markers_meanshift_kernel(float[:, ::1] xyz, const voxel_t[:, :, :] img, int[::1] iters,
+                                   int[:, ::1] offsets, double[::1] weights, double[::1] lut, double order,
+                                   int max_iter, double tol, int num_threads):
+    cdef:
+        Py_ssize_t t, e
+        long long sz0 = img.shape[2], sz1 = img.shape[1], sz2 = img.shape[0], X, Y, Z, cx, cy, cz
+        double x, y, z, w, v, tot_x, tot_y, tot_z, sum_v, dx, dy, dz
+        int it
+    for t in prange(xyz.shape[0], nogil=True, schedule='dynamic', num_threads=num_threads):
+        x = xyz[t, 0]
+        y = xyz[t, 1]
+        z = xyz[t, 2]
+        for it in range(max_iter):
+            cx = <long long>floor(x + .5)
+            cy = <long long>floor(y + .5)
+            cz = <long long>floor(z + .5)
+            tot_x = tot_y = tot_z = sum_v = 0.
+            for e in range(offsets.shape[0]):
+                X = cx + offsets[e, 0]
+                Y = cy + offsets[e, 1]
+                Z = cz + offsets[e, 2]
+                if X < 0 or X >= sz0 or Y < 0 or Y >= sz1 or Z < 0 or Z >= sz2:
+                    continue
+                if voxel_t is np.uint8_t or voxel_t is np.uint16_t:
+                    w = lut[img[Z, Y, X]]
+                else:
+                    v = img[Z, Y, X]
+                    w = pow(v, order) if v > 0 else 0.
+                w = w * weights[e]
+                tot_x = tot_x + w * X
+                tot_y = tot_y + w * Y
+                tot_z = tot_z + w * Z
+                sum_v = sum_v + w
+            if sum_v < 1e-12:
+                break
+            dx = tot_x / sum_v - x
+            dy = tot_y / sum_v - y
+            dz = tot_z / sum_v - z
+            x = x + dx
+            y = y + dy
+            z = z + dz
+            iters[t] = it + 1
+            if dx * dx + dy * dy + dz * dz < tol * tol:
+                break
+        xyz[t, 0] = x
+        xyz[t, 1] = y
+        xyz[t, 2] = z
+
+
+SHELL_TABLE_MAX_RADIUS = 64
+# the shell tables up to SHELL_TABLE_MAX_RADIUS in 3D and 2D, built on first use
+_shell_tables = [None, None]
+
+
+def build_shell_table(bint is2d):
+    """
+    :param is2d: shells on the xy plane
+    :return: offsets (N, 3) in x, y, z, scan counts (N,), shell starts (SHELL_TABLE_MAX_RADIUS + 2,)
+    """
+    max_radius = SHELL_TABLE_MAX_RADIUS
+    r = np.arange(-max_radius, max_radius + 1, dtype=np.int64)
+    if is2d:
+        dy, dx = np.meshgrid(r, r, indexing='ij')
+        dz = np.zeros_like(dx)
+    else:
+        dz, dy, dx = np.meshgrid(r, r, r, indexing='ij')
+    dx, dy, dz = dx.ravel(), dy.ravel(), dz.ravel()
+    d2 = dx * dx + dy * dy + dz * dz
+    # the shell a voxel falls in is ceil(r), computed in integers to match the float comparison exactly
+    ir = np.ceil(np.sqrt(d2)).astype(np.int64)
+    ir[(ir - 1) * (ir - 1) >= d2] -= 1
+    ir[ir * ir < d2] += 1
+    keep = (d2 > 0) & (ir <= max_radius)
+    dx, dy, dz, ir = dx[keep], dy[keep], dz[keep], ir[keep]
+    order = np.lexsort((dx, dy, dz, ir))
+    dx, dy, dz, ir = dx[order], dy[order], dz[order], ir[order]
+    w = 2 * ir + 1
+    if is2d:
+        count = (dy + ir) * w + dx + ir + 1
+    else:
+        count = ((dz + ir) * w + dy + ir) * w + dx + ir + 1
+    offsets = np.ascontiguousarray(np.stack([dx, dy, dz], axis=1), dtype=np.int32)
+    starts = np.searchsorted(ir, np.arange(max_radius + 2)).astype(np.int64)
+    return offsets, count.astype(np.int64), starts
+
+
+cpdef tuple shell_offsets(int max_radius, bint is2d):
+    """
+    Precompute the voxel offsets on each radius shell used by Hanchuan's radius estimation.
+
+    Shell `ir` holds the offsets satisfying `ir - 1 < r <= ir`, in the same z-y-x order as a scan over the
+    (2ir+1)^3 cube (or (2ir+1)^2 square for 2D), together with the scan count at which each offset is reached,
+    so the background ratio test gives the same result as the brute force scan. The shells are in the order of
+    their radius, so the tables of smaller radii are prefixes of the one table kept for each of 2D and 3D.
+
+    :param max_radius: the largest shell radius, up to SHELL_TABLE_MAX_RADIUS
+    :param is2d: shells on the xy plane
+    :return: offsets (N, 3) in x, y, z, scan counts (N,), shell starts (max_radius + 2,)
+    """
+    assert 0 <= max_radius <= SHELL_TABLE_MAX_RADIUS, f"The shell radius has to be within {SHELL_TABLE_MAX_RADIUS}"
+    if _shell_tables[is2d] is None:
+        _shell_tables[is2d] = build_shell_table(is2d)
+    offsets, counts, starts = _shell_tables[is2d]
+    n = starts[max_radius + 1]
+    return offsets[:n], counts[:n], starts[:max_radius + 2]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef np.ndarray markers_radius(xyz, img: np.ndarray, is2d: bool, bkg_thr: float, int num_threads=0,
+                                double max_radius=0):
+    """
+    profile the radius of an array of markers in parallel.
+
+    :param xyz: marker coordinates of shape (N, 3), in x, y, z order
+    :param img: 3D neuronal image
+    :param is2d: 2D radius profiling
+    :param bkg_thr: background threshold
+    :param num_threads: number of threads, default as all cores
+    :param max_radius: the largest radius to profile, capped at and default as half the smallest image dimension
+    :return: the radius of each marker
     """
     assert img.ndim == 3
-    tree_ = [list(t) for t in tree]
-    cdef float x, y, z, r
-    cdef np.ndarray[np.float32_t, ndim=3] img_ = img.astype(np.float32)
-    for t in tree_:
-        x, y, z = t[2:5]
-        marker_meanshift(x, y, z, img_, window_radius, order)
-        t[2:5] = x, y, z
-    return [tuple(t) for t in tree]
+    img = as_voxel_array(img)
+    cdef:
+        float[:, ::1] xyz_ = np.ascontiguousarray(xyz, dtype=np.float32).reshape(-1, 3)
+        double[::1] radius = np.zeros(xyz_.shape[0], dtype=np.float64)
+        double max_r = min(img.shape[2], img.shape[1]) / 2.
+        int table_r, n
+    if not is2d:
+        max_r = min(max_r, img.shape[0] / 2.)
+    if max_radius > 0:
+        max_r = min(max_r, max_radius)
+    table_r = min(<int>(max_r + 1) - 1, SHELL_TABLE_MAX_RADIUS)
+    offsets, counts, starts = shell_offsets(max(table_r, 0), is2d)
+    n = num_threads if num_threads > 0 else os.cpu_count() or 1
+    if img.dtype == np.uint8:
+        markers_radius_kernel[np.uint8_t](xyz_, img, radius, bkg_thr, max_r, is2d, offsets, counts, starts, table_r, n)
+    elif img.dtype == np.uint16:
+        markers_radius_kernel[np.uint16_t](xyz_, img, radius, bkg_thr, max_r, is2d, offsets, counts, starts, table_r, n)
+    elif img.dtype == np.float32:
+        markers_radius_kernel[np.float32_t](xyz_, img, radius, bkg_thr, max_r, is2d, offsets, counts, starts, table_r, n)
+    else:
+        markers_radius_kernel[np.float64_t](xyz_, img, radius, bkg_thr, max_r, is2d, offsets, counts, starts, table_r, n)
+    return np.asarray(radius)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef profile_radius(tree: list[tuple], img: np.ndarray, is2d: bool, bkg_thr: float):
+cdef void markers_radius_kernel(float[:, ::1] xyz, const voxel_t[:, :, :] img, double[::1] radius, double thr,
+                                double max_r, bint is2d, int[:, ::1] offsets, long long[::1] counts,
+                                long long[::1] starts, int table_r, int num_threads):
+    cdef Py_ssize_t t
+    for t in prange(xyz.shape[0], nogil=True, schedule='dynamic', num_threads=num_threads):
+        radius[t] = marker_radius_hanchuan(xyz[t, 0], xyz[t, 1], xyz[t, 2], img, thr, max_r, is2d,
+                                           offsets, counts, starts, table_r)
+
+
+cpdef profile_radius(tree: list[tuple], img: np.ndarray, is2d: bool, bkg_thr: float, int num_threads=0):
     """
     profile swc radius based on an image.
     
@@ -36,42 +278,59 @@ cpdef profile_radius(tree: list[tuple], img: np.ndarray, is2d: bool, bkg_thr: fl
     :param img: 3D neuronal image
     :param is2d: 2D radius profiling
     :param bkg_thr: background threshold
-    :return: 
+    :param num_threads: number of threads, default as all cores
+    :return: the swc tree with the profiled radius
     """
-    assert img.ndim == 3
-    tree_ = [list(t) for t in tree]
-    cdef float x, y, z, r
-    cdef np.ndarray[np.float32_t, ndim=3] img_
-    if img.dtype == np.float32:
-        img_ = img
-    else:
-        img_ = img.astype(np.float32)
-    for t in tree_:
-        x, y, z = t[2:5]
-        if is2d:
-            t[5] = marker_radius_hanchuan_xy(x, y, z, img_, bkg_thr)
-        else:
-            t[5] = marker_radius_hanchuan(x, y, z, img_, bkg_thr)
-    return [tuple(t) for t in tree]
+    if len(tree) == 0:
+        return []
+    radius = markers_radius([t[2:5] for t in tree], img, is2d, bkg_thr, num_threads)
+    return [(*t[:5], r, *t[6:]) for t, r in zip(tree, radius.tolist())]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef double marker_radius_hanchuan(float x, float y, float z, np.ndarray[np.float32_t, ndim=3] img, double thr):
-    cdef long long sz0 = img.shape[2], sz1 = img.shape[1], sz2 = img.shape[0], i, j, k
-    cdef double max_r = sz0 / 2, total_num, background_num, ir, dz, dy, dx, zlower, zupper, r
-    max_r = min(max_r, sz1 / 2)
-    max_r = min(max_r, sz2 / 2)
+cdef double marker_radius_hanchuan(float x, float y, float z, const voxel_t[:, :, :] img, double thr, double max_r,
+                                   bint is2d, int[:, ::1] offsets, long long[::1] counts, long long[::1] starts,
+                                   int table_r) noexcept nogil:
+    cdef:
+        long long sz0 = img.shape[2], sz1 = img.shape[1], sz2 = img.shape[0], i, j, k, e, total_num
+        long long zk = <long long>z
+        double background_num
+        int ir, dz, dy, dx, zr
+        double r
 
+    if is2d and (z < 0 or zk >= sz2):
+        # the 2D plane of the marker is off the image
+        return 0
     for ir in range(1, <int>(max_r + 1)):
-        total_num = background_num = 0
-
-        zlower = -ir
-        zupper = ir
-        for dz in range(<int>zlower, <int>(zupper + 1)):
-            for dy in range(<int>-ir, <int>(ir + 1)):
-                for dx in range(<int>-ir, <int>(ir + 1)):
+        background_num = 0
+        if ir <= table_r:
+            # walk only the precomputed shell
+            for e in range(starts[ir], starts[ir + 1]):
+                i = <long long>(x + offsets[e, 0])
+                if i < 0 or i >= sz0:
+                    return ir
+                j = <long long>(y + offsets[e, 1])
+                if j < 0 or j >= sz1:
+                    return ir
+                if is2d:
+                    k = zk
+                else:
+                    k = <long long>(z + offsets[e, 2])
+                    if k < 0 or k >= sz2:
+                        return ir
+                if img[k, j, i] <= thr:
+                    background_num += 1
+                    if background_num / counts[e] > 0.001:
+                        return ir
+            continue
+        # radius beyond the table, scan the whole cube
+        total_num = 0
+        zr = 0 if is2d else ir
+        for dz in range(-zr, zr + 1):
+            for dy in range(-ir, ir + 1):
+                for dx in range(-ir, ir + 1):
                     total_num += 1
                     r = sqrt(dx*dx + dy*dy + dz*dz)
                     if ir - 1 < r <= ir:
@@ -81,98 +340,102 @@ cdef double marker_radius_hanchuan(float x, float y, float z, np.ndarray[np.floa
                         j = <long long>(y + dy)
                         if j < 0 or j >= sz1:
                             return ir
-                        k = <long long>(z + dz)
-                        if k < 0 or k >= sz2:
-                            return ir
+                        if is2d:
+                            k = zk
+                        else:
+                            k = <long long>(z + dz)
+                            if k < 0 or k >= sz2:
+                                return ir
                         if img[k, j, i] <= thr:
                             background_num += 1
                             if background_num / total_num > 0.001:
                                 return ir
-    return ir
+    return max(1, <int>(max_r + 1) - 1)
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef double marker_radius_hanchuan_xy(float x, float y, float z, np.ndarray[np.float32_t, ndim=3] img, double thr):
-    cdef long long sz0 = img.shape[2], sz1 = img.shape[1], i, j, k = <long long>z
-    cdef double max_r = sz0 / 2, total_num, background_num, ir, dy, dx, r
-    max_r = min(max_r, sz1 / 2)
+def group_markers(xyz, block_size: int):
+    """
+    group markers by the cubic block they fall in, with neighboring blocks next to each other.
 
-    for ir in range(1, <int>(max_r + 1)):
-        total_num = background_num = 0
-
-        for dy in range(<int>-ir, <int>(ir + 1)):
-            for dx in range(<int>-ir, <int>(ir + 1)):
-                total_num += 1
-                r = sqrt(dx*dx + dy*dy)
-                if ir - 1 < r <= ir:
-                    i = <long long>(x + dx)
-                    if i < 0 or i >= sz0:
-                        return ir
-                    j = <long long>(y + dy)
-                    if j < 0 or j >= sz1:
-                        return ir
-                    if img[k, j, i] <= thr:
-                        background_num += 1
-                        if background_num / total_num > 0.001:
-                            return ir
-    return ir
+    :param xyz: marker coordinates of shape (N, 3), in x, y, z order
+    :param block_size: the edge length of the blocks
+    :return: a list of marker index arrays
+    """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+    if len(xyz) == 0:
+        return []
+    cells = np.floor(xyz / block_size).astype(np.int64)
+    order = np.lexsort((cells[:, 0], cells[:, 1], cells[:, 2]))
+    cells = cells[order]
+    starts = np.flatnonzero(np.any(cells[1:] != cells[:-1], axis=1)) + 1
+    return np.split(order, starts)
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef void marker_meanshift(float & x, float & y, float & z, np.ndarray[np.float32_t, ndim=3] img, int window_radius, double order):
-    cdef:
-        int wr_t = window_radius
-        long long X, Y, Z, dX, dY, dZ
-        double mean = 0., count = 0., w, center_dist, s2, prefactor, tot_x, tot_y, tot_z, sum_v, s, x_, y_, z_, dist
-    for X in range( <int>max(x+.5-wr_t, 0), <int>min(img.shape[2] - 1, x + .5 + wr_t) ):
-        for Y in range(<int> max(x + .5 - wr_t, 0), <int> min(img.shape[1] - 1, x + .5 + wr_t)):
-            for Z in range(<int> max(x + .5 - wr_t, 0), <int> min(img.shape[0] - 1, x + .5 + wr_t)):
-                dX = <int>(X - x)
-                dY = <int>(Y - y)
-                dZ = <int>(Z - z)
-                dist = sqrt(dX*dX + dY*dY + dZ*dZ)
-                if dist > wr_t:
-                    continue
-                w = pow(img[Z, Y, X], order)
-                mean += w * dist
-                count += w
-    mean /= count + 1e-5
-    wr_t = <int>max(1., mean)
-    s = wr_t / 4.
-    s2 = pow(s, 2)
-    prefactor = 1. / pow(2 * np.pi * s2, 1.5)
-    while True:
-        tot_x = tot_y = tot_z = sum_v = 0.
-        for X in range(<int> max(x + .5 - wr_t, 0), <int> min(img.shape[2] - 1, x + .5 + wr_t)):
-            for Y in range(<int> max(x + .5 - wr_t, 0), <int> min(img.shape[1] - 1, x + .5 + wr_t)):
-                for Z in range(<int> max(x + .5 - wr_t, 0), <int> min(img.shape[0] - 1, x + .5 + wr_t)):
-                    dX = <int>(X - x)
-                    dY = <int>(Y - y)
-                    dZ = <int>(Z - z)
-                    dist = sqrt(dX * dX + dY * dY + dZ * dZ)
-                    if dist > wr_t:
-                        continue
-                    w = pow(img[Z, Y, X], order) * prefactor * exp(-dist / (2 * s2))
-                    tot_x += w * X
-                    tot_y += w * Y
-                    tot_z += w * Z
-                    sum_v += w
-        if sum_v < 1e-5:
-            break
-        x_ = tot_x / sum_v
-        y_ = tot_y / sum_v
-        z_ = tot_z / sum_v
-        center_dist = sqrt( (x-x_)*(x-x_) + (y-y_)*(y-y_) + (z-z_)*(z-z_) )
-        x = x_
-        y = y_
-        z = z_
-        wr_t -= <int>s
-        if center_dist < 1:
-            break
-
-
-# cpdef neuron_radius_terafly(tree: list[tuple], img_path: str, is2d: bool, block_size: int, meanshift: bool, bkg_thr: float)
\ No newline at end of file
+def terafly_markers_radius(xyz, terafly, is2d: bool, bkg_thr: float, block_size=128, max_radius=32,
+                           num_workers=0, tile_cache_bytes=1 << 30, channel=0):
+    """
+    profile the radius of an array of markers out-of-core against a TeraFly volume.
+
+    Markers are grouped by blocks, and each group only fetches the window around it padded by max_radius, so
+    memory stays bounded regardless of the neuron extent. Groups run in parallel, and neighboring groups reuse the
+    decoded tiles through the tile cache of the TeraFly interface. Markers profiled to max_radius have been
+    truncated.
+
+    :param xyz: marker coordinates of shape (N, 3), in x, y, z order
+    :param terafly: a TeraflyInterface, or the path of a TeraFly resolution to be opened with a tile cache
+    :param is2d: 2D radius profiling
+    :param bkg_thr: background threshold
+    :param block_size: the edge length of the marker groups
+    :param max_radius: the largest radius to profile
+    :param num_workers: number of groups processed at the same time, default as all cores
+    :param tile_cache_bytes: the tile cache capacity used when opening the volume from a path
+    :param channel: the channel to profile, the only one read from the volume
+    :return: the radius of each marker
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not hasattr(terafly, 'get_sub_volume'):
+        from ..terafly import TeraflyInterface
+        terafly = TeraflyInterface(terafly, tile_cache_bytes=tile_cache_bytes)
+    xyz = np.asarray(xyz, dtype=np.float32).reshape(-1, 3)
+    dims = np.array(terafly.get_dim([channel])[:3], dtype=np.int64)
+    vol_r = min(dims[0], dims[1]) / 2. if is2d else dims.min() / 2.
+    max_r = min(vol_r, max_radius)
+    radius = np.zeros(len(xyz), dtype=np.float64)
+
+    def profile_group(ind):
+        pts = xyz[ind]
+        lo = np.clip(np.floor(pts.min(axis=0)).astype(np.int64) - max_radius - 1, 0, dims - 1)
+        hi = np.clip(np.floor(pts.max(axis=0)).astype(np.int64) + max_radius + 2, lo + 1, dims)
+        if is2d:
+            lo[2] = np.clip(np.floor(pts[:, 2].min()), 0, dims[2] - 1)
+            hi[2] = np.clip(np.floor(pts[:, 2].max()) + 1, lo[2] + 1, dims[2])
+        img = terafly.get_sub_volume(lo[0], hi[0], lo[1], hi[1], lo[2], hi[2], channels=[channel])[0]
+        radius[ind] = markers_radius(pts - lo, img, is2d, bkg_thr, 1, max_r)
+
+    with ThreadPoolExecutor(num_workers if num_workers > 0 else os.cpu_count()) as pool:
+        for _ in pool.map(profile_group, group_markers(xyz, block_size)):
+            pass
+    return radius
+
+
+def neuron_radius_terafly(tree: list[tuple], terafly, is2d: bool, bkg_thr: float, block_size=128, max_radius=32,
+                          num_workers=0, tile_cache_bytes=1 << 30, channel=0):
+    """
+    profile swc radius out-of-core against a TeraFly volume, see terafly_markers_radius.
+
+    :param tree: list of swc nodes
+    :param terafly: a TeraflyInterface, or the path of a TeraFly resolution to be opened with a tile cache
+    :param is2d: 2D radius profiling
+    :param bkg_thr: background threshold
+    :param block_size: the edge length of the node groups
+    :param max_radius: the largest radius to profile
+    :param num_workers: number of groups processed at the same time, default as all cores
+    :param tile_cache_bytes: the tile cache capacity used when opening the volume from a path
+    :param channel: the channel to profile, the only one read from the volume
+    :return: the swc tree with the profiled radius
+    """
+    if len(tree) == 0:
+        return []
+    radius = terafly_markers_radius([t[2:5] for t in tree], terafly, is2d, bkg_thr, block_size, max_radius,
+                                    num_workers, tile_cache_bytes, channel)
+    return [(*t[:5], r, *t[6:]) for t, r in zip(tree, radius.tolist())]
\ No newline at end of file
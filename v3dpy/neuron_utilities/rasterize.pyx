@@ -0,0 +1,241 @@
+cimport numpy as np
+import numpy as np
+import os
+import cython
+import itertools
+from libc.math cimport floor, ceil
+from cython.parallel import prange
+from pathlib import Path
+
+
+ctypedef fused label_t:
+    np.uint8_t
+    np.uint16_t
+
+
+def neuron_segments(tree: list[tuple], label=1):
+    """
+    turn swc nodes into cone segments from each node to its parent. Nodes without a parent in the tree become
+    spheres, i.e. segments of zero length.
+
+    :param tree: list of swc nodes
+    :param label: a constant label value, or 'type' to label by the swc types
+    :return: starts (N, 3), ends (N, 3) in x, y, z, start radius (N,), end radius (N,), labels (N,)
+    """
+    xyz = np.array([t[2:5] for t in tree], dtype=np.float64).reshape(-1, 3)
+    r = np.array([t[5] for t in tree], dtype=np.float64)
+    index = {t[0]: i for i, t in enumerate(tree)}
+    parent = np.array([index.get(t[6], i) for i, t in enumerate(tree)], dtype=np.int64)
+    if label == 'type':
+        labels = np.array([t[1] for t in tree], dtype=np.int64)
+    else:
+        labels = np.full(len(tree), label, dtype=np.int64)
+    return xyz, xyz[parent], r, r[parent], labels
+
+
+def rasterize_segments(p0, p1, r0, r1, labels, shape, offset=(0., 0., 0.), spacing=(1., 1., 1.), output='dense',
+                       dtype=np.uint8, block_shape=(64, 256, 256), min_radius=None, int num_threads=0, loader=None,
+                       slab_depth=1):
+    """
+    voxelize cone segments into a grid block by block. Voxel (z, y, x) of the grid is centered at
+    offset + (x, y, z) * spacing, and the segments are in the same physical space. A voxel belongs to a segment if
+    it is within the radius interpolated at its projection on the segment, with the two ends rounded. Overlapping
+    segments take the larger label.
+
+    Only the blocks touched by the segments are computed, so a whole-brain neuron can be rasterized at full
+    resolution as long as the output is not dense. Streamed to a file, only a slab of slab_depth planes is held.
+
+    :param p0: segment starts (N, 3), in x, y, z order
+    :param p1: segment ends (N, 3), in x, y, z order
+    :param r0: radius at the starts (N,)
+    :param r1: radius at the ends (N,)
+    :param labels: the label of each segment (N,), within the range of dtype
+    :param shape: the grid shape (Z, Y, X)
+    :param offset: the physical position of voxel (0, 0, 0), in x, y, z order
+    :param spacing: the voxel size, in x, y, z order as loaded by swc_handler.load_spacings
+    :param output: 'dense' for a 3D array, 'sparse' for a dict mapping block starts (z, y, x) to the nonzero
+    blocks, or a v3draw/v3dpbd path to stream the mask into slab by slab
+    :param dtype: the label type, uint8 or uint16
+    :param block_shape: the block shape (Z, Y, X)
+    :param min_radius: the smallest radius, default as half the largest voxel size so that thin segments stay
+    connected
+    :param num_threads: number of threads, default as all cores
+    :param loader: the loader to stream with, default as PBD or Raw based on the suffix of the output path
+    :param slab_depth: the number of z planes streamed at a time, default as 1
+    :return: the mask, or None when streaming to a file
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in [np.uint8, np.uint16], "The label type has to be uint8 or uint16"
+    shape = tuple(int(i) for i in shape)
+    block_shape = tuple(min(int(b), s) if s > 0 else int(b) for b, s in zip(block_shape, shape))
+    offset = np.asarray(offset, dtype=np.float64)
+    spacing = np.asarray(spacing, dtype=np.float64)
+    p0 = np.ascontiguousarray(p0, dtype=np.float64).reshape(-1, 3)
+    p1 = np.ascontiguousarray(p1, dtype=np.float64).reshape(-1, 3)
+    if min_radius is None:
+        min_radius = spacing.max() / 2
+    r0 = np.maximum(np.asarray(r0, dtype=np.float64), min_radius)
+    r1 = np.maximum(np.asarray(r1, dtype=np.float64), min_radius)
+    labels = np.asarray(labels)
+    info = np.iinfo(dtype)
+    if len(labels) > 0 and (labels.min() < info.min or labels.max() > info.max):
+        raise ValueError(f"The labels range from {labels.min()} to {labels.max()}, beyond {dtype}")
+    labels = labels.astype(dtype)
+    n = num_threads if num_threads > 0 else os.cpu_count() or 1
+
+    # segment bounding boxes in voxels, z, y, x order
+    rmax = np.maximum(r0, r1)[:, None]
+    lo = np.floor((np.minimum(p0, p1) - rmax - offset) / spacing)[:, ::-1]
+    hi = np.ceil((np.maximum(p0, p1) + rmax - offset) / spacing)[:, ::-1] + 1
+    bshape = np.array(block_shape)
+    inside = (hi > 0).all(axis=1) & (lo < np.array(shape)).all(axis=1)
+    # the range of blocks each segment touches, grouped by range
+    boxes = np.concatenate([np.clip(lo[inside], 0, None) // bshape,
+                            (np.minimum(hi[inside], shape) - 1) // bshape], axis=1).astype(np.int64)
+    boxes, inverse = np.unique(boxes.reshape(-1, 6), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    groups = np.split(np.flatnonzero(inside)[np.argsort(inverse, kind='stable')],
+                      np.cumsum(np.bincount(inverse, minlength=len(boxes)))[:-1])
+    block_segments = {}
+    for box, seg in zip(boxes, groups):
+        for b in itertools.product(*[range(l, h + 1) for l, h in zip(box[:3], box[3:])]):
+            block_segments.setdefault(b, []).append(seg)
+
+    def fill(block, block_index, start=None):
+        # start is the grid index of the first voxel of the block, which can be a part of the block of the index
+        ind = np.concatenate(block_segments[block_index])
+        start = np.array(block_index, dtype=np.int64) * bshape if start is None else np.array(start, dtype=np.int64)
+        if dtype == np.uint8:
+            rasterize_block[np.uint8_t](block, start, offset, spacing, p0[ind], p1[ind], r0[ind], r1[ind],
+                                        labels[ind], n)
+        else:
+            rasterize_block[np.uint16_t](block, start, offset, spacing, p0[ind], p1[ind], r0[ind], r1[ind],
+                                         labels[ind], n)
+
+    if output == 'dense':
+        mask = np.zeros(shape, dtype=dtype)
+        for b in sorted(block_segments):
+            fill(mask[tuple(slice(i * s, (i + 1) * s) for i, s in zip(b, block_shape))], b)
+        return mask
+    elif output == 'sparse':
+        blocks = {}
+        for b in sorted(block_segments):
+            start = tuple(int(i * s) for i, s in zip(b, block_shape))
+            block = np.zeros([min(s, t - i) for i, s, t in zip(start, block_shape, shape)], dtype=dtype)
+            fill(block, b)
+            if block.any():
+                blocks[start] = block
+        return blocks
+
+    path = Path(output)
+    if loader is None:
+        from ..loaders import PBD, Raw
+        if path.suffix.lower() == '.v3dpbd':
+            loader = PBD()
+        elif path.suffix.lower() in ['.v3draw', '.raw']:
+            loader = Raw()
+        else:
+            raise ValueError(f"Unsupported output {output}")
+
+    depth = max(int(slab_depth), 1)
+    layers = {}
+    for bz, by, bx in sorted(block_segments):
+        layers.setdefault(bz, []).append((by, bx))
+
+    def slabs():
+        for z0 in range(0, shape[0], depth):
+            z1 = min(z0 + depth, shape[0])
+            slab = np.zeros((z1 - z0, shape[1], shape[2]), dtype=dtype)
+            # fill the slab from the parts of the blocks it cuts through
+            for bz in range(z0 // block_shape[0], (z1 - 1) // block_shape[0] + 1):
+                b0, b1 = max(bz * block_shape[0], z0), min((bz + 1) * block_shape[0], z1)
+                for by, bx in layers.get(bz, []):
+                    y0, x0 = by * block_shape[1], bx * block_shape[2]
+                    fill(slab[b0 - z0:b1 - z0, y0:y0 + block_shape[1], x0:x0 + block_shape[2]], (bz, by, bx),
+                         (b0, y0, x0))
+            yield slab
+
+    loader.save_slabs(path, (1, *shape), dtype, slabs())
+
+
+def rasterize_neuron(tree: list[tuple], shape, offset=(0., 0., 0.), spacing=(1., 1., 1.), output='dense', label=1,
+                     **kwargs):
+    """
+    voxelize a neuron into a mask using the node radius and parent links, see rasterize_segments.
+
+    :param tree: list of swc nodes
+    :param shape: the grid shape (Z, Y, X)
+    :param offset: the physical position of voxel (0, 0, 0), in x, y, z order
+    :param spacing: the voxel size, in x, y, z order as loaded by swc_handler.load_spacings
+    :param output: 'dense', 'sparse', or a v3draw/v3dpbd path
+    :param label: a constant label value, or 'type' to label by the swc types
+    :param kwargs: passed to rasterize_segments
+    :return: the mask, or None when streaming to a file
+    """
+    return rasterize_segments(*neuron_segments(tree, label), shape, offset, spacing, output, **kwargs)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void rasterize_block(label_t[:, :, :] block, long long[::1] start, double[::1] offset, double[::1] spacing,
+                           double[:, ::1] p0, double[:, ::1] p1, double[::1] r0, double[::1] r1, label_t[::1] labels,
+                           int num_threads):
+    """
+    voxelize cone segments into a block of the grid, in parallel over z, and over bands of rows too for thin blocks.
+
+    :param block: the block to draw in, indexed by z, y, x
+    :param start: the grid index (z, y, x) of the first voxel of the block
+    :param offset: the physical position of voxel (0, 0, 0), in x, y, z order
+    :param spacing: the voxel size, in x, y, z order
+    :param p0: segment starts (N, 3), in x, y, z order
+    :param p1: segment ends (N, 3), in x, y, z order
+    :param r0: radius at the starts (N,)
+    :param r1: radius at the ends (N,)
+    :param labels: the label of each segment (N,)
+    :param num_threads: number of threads
+    """
+    cdef:
+        Py_ssize_t q, k, s, c
+        long long i, j, i0, i1, j0, j1
+        double px, py, pz, ax, ay, az, bx, by, bz, l2, t, dx, dy, dz, r, rm
+        # split the planes into bands of rows when there are too few of them for the threads
+        Py_ssize_t bands = min(max((4 * num_threads + block.shape[0] - 1) // max(block.shape[0], 1), 1),
+                               max(block.shape[1], 1))
+    for q in prange(block.shape[0] * bands, nogil=True, schedule='dynamic', num_threads=num_threads):
+        k = q // bands
+        c = q % bands
+        pz = offset[2] + (start[0] + k) * spacing[2]
+        for s in range(p0.shape[0]):
+            rm = max(r0[s], r1[s])
+            if pz < min(p0[s, 2], p1[s, 2]) - rm or pz > max(p0[s, 2], p1[s, 2]) + rm:
+                continue
+            # the x, y index range of the segment bounding box within the band
+            j0 = max(<long long>floor((min(p0[s, 1], p1[s, 1]) - rm - offset[1]) / spacing[1]) - start[1],
+                     c * block.shape[1] // bands)
+            j1 = min(<long long>ceil((max(p0[s, 1], p1[s, 1]) + rm - offset[1]) / spacing[1]) - start[1] + 1,
+                     (c + 1) * block.shape[1] // bands)
+            i0 = max(<long long>floor((min(p0[s, 0], p1[s, 0]) - rm - offset[0]) / spacing[0]) - start[2], 0)
+            i1 = min(<long long>ceil((max(p0[s, 0], p1[s, 0]) + rm - offset[0]) / spacing[0]) - start[2] + 1,
+                     block.shape[2])
+            ax = p0[s, 0]
+            ay = p0[s, 1]
+            az = p0[s, 2]
+            bx = p1[s, 0] - ax
+            by = p1[s, 1] - ay
+            bz = p1[s, 2] - az
+            l2 = bx * bx + by * by + bz * bz
+            for j in range(j0, j1):
+                py = offset[1] + (start[1] + j) * spacing[1]
+                for i in range(i0, i1):
+                    if block[k, j, i] >= labels[s]:
+                        continue
+                    px = offset[0] + (start[2] + i) * spacing[0]
+                    t = 0.
+                    if l2 > 0:
+                        t = min(max(((px - ax) * bx + (py - ay) * by + (pz - az) * bz) / l2, 0.), 1.)
+                    dx = px - ax - t * bx
+                    dy = py - ay - t * by
+                    dz = pz - az - t * bz
+                    r = r0[s] + (r1[s] - r0[s]) * t
+                    if dx * dx + dy * dy + dz * dz <= r * r:
+                        block[k, j, i] = labels[s]
@@ -0,0 +1,233 @@
+"""
+Array-backed resampling and simplification of swc trees. The tree is split into its unbranched segments, from a
+critical node, i.e. a root, a branch point, a tip or a node of a different type from its parent, down to the next
+one, and all the segments are processed at once. The critical nodes are always kept.
+"""
+
+import os
+import numpy as np
+from functools import partial
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from .swc_handler import parse_swc, write_swc
+
+
+def tree_arrays(tree: list[tuple]):
+    """
+    :param tree: list of swc nodes
+    :return: ids (N,), types (N,), xyz (N, 3), radius (N,), the index of the parent of each node, -1 for the nodes
+    without a parent in the tree (N,)
+    """
+    a = np.array(tree, dtype=np.float64).reshape(-1, 7)
+    ids = a[:, 0].astype(np.int64)
+    pids = a[:, 6].astype(np.int64)
+    order = np.argsort(ids, kind='stable')
+    parent = order[np.minimum(np.searchsorted(ids, pids, sorter=order), len(ids) - 1)]
+    parent = np.where((ids[parent] == pids) & (parent != np.arange(len(ids))), parent, -1)
+    return ids, a[:, 1].astype(np.int64), a[:, 2:5], a[:, 5], parent
+
+
+def unbranched_segments(parent: np.ndarray, types: np.ndarray):
+    """
+    split a tree into its unbranched segments, each from a critical node down to the next one.
+
+    :param parent: the parent index of each node, -1 for none
+    :param types: the swc type of each node
+    :return: the critical node mask (N,), the nodes of all the segments in order, each segment starting with its
+    critical parent and ending with a critical node (M,), the position of the start of each segment in them (S,)
+    """
+    n = len(parent)
+    nodes = np.arange(n)
+    has_parent = parent >= 0
+    p = np.where(has_parent, parent, nodes)
+    n_children = np.bincount(parent[has_parent], minlength=n)
+    critical = ~has_parent | (n_children != 1) | (types != types[p])
+    # the head of a segment is its first node below the critical parent, find it by pointer jumping
+    head = np.where(has_parent & ~critical[p], p, nodes)
+    depth = (head != nodes).astype(np.int64)
+    for _ in range(int(np.log2(max(n, 1))) + 2):
+        up = head[head]
+        if (up == head).all():
+            break
+        depth += depth[head]
+        head = up
+    else:
+        raise ValueError("The tree has a cycle")
+    members = np.flatnonzero(has_parent)
+    members = members[np.lexsort((depth[members], head[members]))]
+    heads, first = np.unique(head[members], return_index=True)
+    start = first + np.arange(len(heads))
+    pts = np.empty(len(members) + len(heads), dtype=np.int64)
+    is_start = np.zeros(len(pts), dtype=bool)
+    is_start[start] = True
+    pts[start] = parent[heads]
+    pts[~is_start] = members
+    return critical, pts, start
+
+
+def resample(tree: list[tuple], step: float):
+    """
+    resample a tree to a uniform node spacing. Each unbranched segment is divided evenly into the fewest parts no
+    longer than the step, with the positions and radius interpolated along it. The critical nodes and their
+    properties are kept, and the new nodes take the type of the segment.
+
+    :param tree: list of swc nodes
+    :param step: the max distance between a node and its parent
+    :return: list of swc nodes, renumbered from 1 with the parents before their children if they were so, -1 for
+    the roots
+    """
+    assert step > 0, "The step has to be positive"
+    if len(tree) == 0:
+        return []
+    ids, types, xyz, r, parent = tree_arrays(tree)
+    critical, pts, start = unbranched_segments(parent, types)
+    if len(pts) == 0:
+        # only roots, there is nothing to resample
+        return list(zip(range(1, len(ids) + 1), types.tolist(), *xyz.T.tolist(), r.tolist(), [-1] * len(ids)))
+    ends = np.append(start[1:], len(pts)) - 1
+    n_seg = len(start)
+
+    # the arc length along the segments, which are kept apart by a gap of 1 so that one curve serves them all
+    d = np.linalg.norm(np.diff(xyz[pts], axis=0), axis=1)
+    d[start[1:] - 1] = 1.
+    g = np.concatenate([[0.], np.cumsum(d)])
+    length = g[ends] - g[start]
+    parts = np.maximum(np.ceil(length / step - 1e-9), 1).astype(np.int64)
+    n_new = parts - 1
+    offsets = np.cumsum(n_new) - n_new
+    seg = np.repeat(np.arange(n_seg), n_new)
+    j = np.arange(n_new.sum()) - offsets[seg] + 1
+    gs = g[start[seg]] + length[seg] * j / parts[seg]
+    new_xyz = np.stack([np.interp(gs, g, xyz[pts, a]) for a in range(3)], axis=1)
+    new_r = np.interp(gs, g, r[pts])
+    new_types = types[pts[start + 1]][seg]
+
+    # the kept critical nodes come first, then the new ones, each chained from the parent of its segment
+    crit = np.flatnonzero(critical)
+    n_crit = len(crit)
+    crit_index = np.full(len(ids), -1, dtype=np.int64)
+    crit_index[crit] = np.arange(n_crit)
+    seg_parent = crit_index[pts[start]]
+    new_parent = np.where(j == 1, seg_parent[seg], n_crit + np.arange(len(seg)) - 1)
+    seg_of_end = np.full(len(ids), -1, dtype=np.int64)
+    seg_of_end[pts[ends]] = np.arange(n_seg)
+    s = seg_of_end[crit]
+    crit_parent = np.where(s < 0, -1, np.where(n_new[s] > 0, n_crit + offsets[s] + n_new[s] - 1, seg_parent[s]))
+
+    # each critical node follows the new nodes of its segment, in the original order of the critical nodes
+    key = np.concatenate([crit, pts[ends][seg]])
+    kind = np.concatenate([np.ones(n_crit, dtype=np.int64), np.zeros(len(seg), dtype=np.int64)])
+    rank = np.concatenate([np.zeros(n_crit, dtype=np.int64), j])
+    order = np.lexsort((rank, kind, key))
+    new_id = np.empty(len(order), dtype=np.int64)
+    new_id[order] = np.arange(1, len(order) + 1)
+    all_parent = np.concatenate([crit_parent, new_parent])
+    pid = np.where(all_parent < 0, -1, new_id[all_parent])
+    all_types = np.concatenate([types[crit], new_types])
+    all_xyz = np.concatenate([xyz[crit], new_xyz])
+    all_r = np.concatenate([r[crit], new_r])
+    return list(zip(range(1, len(order) + 1), all_types[order].tolist(), *all_xyz[order].T.tolist(),
+                    all_r[order].tolist(), pid[order].tolist()))
+
+
+def simplify(tree: list[tuple], tol: float):
+    """
+    simplify a tree by the Douglas-Peucker algorithm on each unbranched segment, keeping the fewest nodes such that
+    every removed node is within the tolerance of the path through the kept ones. The critical nodes are kept.
+
+    :param tree: list of swc nodes
+    :param tol: the largest distance of a removed node to the simplified path
+    :return: list of the kept swc nodes in their original order, with their ids and the parents relinked, -1 for
+    the roots
+    """
+    assert tol >= 0, "The tolerance can't be negative"
+    if len(tree) == 0:
+        return []
+    ids, types, xyz, r, parent = tree_arrays(tree)
+    critical, pts, start = unbranched_segments(parent, types)
+    if len(pts) == 0:
+        # only roots, all of which are kept
+        return list(zip(ids.tolist(), types.tolist(), *xyz.T.tolist(), r.tolist(), [-1] * len(ids)))
+    ends = np.append(start[1:], len(pts)) - 1
+    p = xyz[pts]
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[start] = keep[ends] = True
+
+    # split all the intervals at their farthest point at once, until every point is within the tolerance
+    a, b = start, ends
+    while True:
+        sel = b - a >= 2
+        a, b = a[sel], b[sel]
+        if len(a) == 0:
+            break
+        cnt = b - a - 1
+        first = np.cumsum(cnt) - cnt
+        iv = np.repeat(np.arange(len(a)), cnt)
+        k = np.arange(cnt.sum()) - first[iv] + a[iv] + 1
+        # the distance to the chord of the interval
+        ab = (p[b] - p[a])[iv]
+        ak = p[k] - p[a[iv]]
+        l2 = (ab * ab).sum(axis=1)
+        t = np.clip((ak * ab).sum(axis=1) / np.where(l2 > 0, l2, 1.), 0., 1.)
+        dist = np.linalg.norm(ak - t[:, None] * ab, axis=1)
+        dmax = np.maximum.reduceat(dist, first)
+        far = np.flatnonzero(dist == dmax[iv])
+        _, i = np.unique(iv[far], return_index=True)
+        split = dmax > tol
+        s = k[far[i]][split]
+        keep[s] = True
+        a, b = np.concatenate([a[split], s]), np.concatenate([s, b[split]])
+
+    # relink each kept node to the previous kept one in its segment
+    last_kept = np.maximum.accumulate(np.where(keep, np.arange(len(pts)), 0))
+    is_start = np.zeros(len(pts), dtype=bool)
+    is_start[start] = True
+    q = np.flatnonzero(keep & ~is_start)
+    new_parent = parent.copy()
+    new_parent[pts[q]] = pts[last_kept[q - 1]]
+    kept = critical.copy()
+    kept[pts[keep]] = True
+    kept = np.flatnonzero(kept)
+    pid = np.where(new_parent[kept] < 0, -1, ids[new_parent[kept]])
+    return list(zip(ids[kept].tolist(), types[kept].tolist(), *xyz[kept].T.tolist(), r[kept].tolist(),
+                    pid.tolist()))
+
+
+def process_swc_file(func, swc_file, out_dir=None, **kwargs):
+    """
+    apply a tree function to an swc file.
+
+    :param func: resample, simplify or any function taking and returning a tree
+    :param swc_file: the swc path
+    :param out_dir: the directory to write the result in under the same name, default as not writing
+    :param kwargs: passed to func
+    :return: the result tree, or its path if written
+    """
+    tree = func(parse_swc(swc_file), **kwargs)
+    if out_dir is None:
+        return tree
+    path = Path(out_dir) / Path(swc_file).name
+    write_swc(tree, path)
+    return path
+
+
+def map_swc_files(func, swc_files, out_dir=None, num_workers=0, **kwargs):
+    """
+    apply a tree function such as resample or simplify to many swc files in parallel processes.
+
+    :param func: a function taking and returning a tree, defined at the module level so that it can be pickled
+    :param swc_files: the swc paths
+    :param out_dir: the directory to write the results in under the same names, default as returning them
+    :param num_workers: number of processes, default as all cores
+    :param kwargs: passed to func, e.g. step or tol
+    :return: the result trees, or their paths if written, in the order of the files
+    """
+    swc_files = list(swc_files)
+    if out_dir is not None:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+    n = num_workers if num_workers > 0 else os.cpu_count() or 1
+    job = partial(process_swc_file, func, out_dir=out_dir, **kwargs)
+    if n == 1 or len(swc_files) <= 1:
+        return [job(f) for f in swc_files]
+    with ProcessPoolExecutor(min(n, len(swc_files))) as pool:
+        return list(pool.map(job, swc_files, chunksize=max(1, len(swc_files) // (4 * n))))
@@ -0,0 +1,209 @@
+"""
+Batched image intensity sampling at swc nodes and along parent-child segments, for finding reconstructions that
+pass through the background. The sources can be in-memory volumes or TeraFly volumes, the latter of which are read
+block by block around the points.
+"""
+
+cimport numpy as np
+import numpy as np
+import os
+import cython
+from libc.math cimport floor
+from cython.parallel import prange
+from .profiling import as_voxel_array, group_markers
+
+
+ctypedef fused voxel_t:
+    np.uint8_t
+    np.uint16_t
+    np.float32_t
+    np.float64_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef np.ndarray sample_image(xyz, img: np.ndarray, int order=1, double cval=0., int num_threads=0):
+    """
+    sample an in-memory image at an array of points.
+
+    :param xyz: point coordinates of shape (N, 3), in x, y, z order
+    :param img: 3D image indexed by z, y, x
+    :param order: 0 for nearest neighbor, 1 for trilinear interpolation
+    :param cval: the value of voxels outside the image
+    :param num_threads: number of threads, default as all cores
+    :return: the sampled intensity of each point
+    """
+    assert img.ndim == 3
+    assert order in (0, 1), "Only nearest neighbor (0) and trilinear (1) sampling are supported."
+    img = as_voxel_array(img)
+    cdef:
+        double[:, ::1] xyz_ = np.ascontiguousarray(xyz, dtype=np.float64).reshape(-1, 3)
+        double[::1] out = np.empty(xyz_.shape[0], dtype=np.float64)
+        int n = num_threads if num_threads > 0 else os.cpu_count() or 1
+    if img.dtype == np.uint8:
+        sample_kernel[np.uint8_t](xyz_, img, out, order, cval, n)
+    elif img.dtype == np.uint16:
+        sample_kernel[np.uint16_t](xyz_, img, out, order, cval, n)
+    elif img.dtype == np.float32:
+        sample_kernel[np.float32_t](xyz_, img, out, order, cval, n)
+    else:
+        sample_kernel[np.float64_t](xyz_, img, out, order, cval, n)
+    return np.asarray(out)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double voxel_at(const voxel_t[:, :, :] img, long long x, long long y, long long z, double cval) noexcept nogil:
+    if x < 0 or y < 0 or z < 0 or x >= img.shape[2] or y >= img.shape[1] or z >= img.shape[0]:
+        return cval
+    return img[z, y, x]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void sample_kernel(double[:, ::1] xyz, const voxel_t[:, :, :] img, double[::1] out, int order, double cval,
+                        int num_threads):
+    cdef:
+        Py_ssize_t t
+        long long x0, y0, z0
+        double fx, fy, fz, c00, c01, c10, c11
+    for t in prange(xyz.shape[0], nogil=True, schedule='static', num_threads=num_threads):
+        if order == 0:
+            out[t] = voxel_at(img, <long long>floor(xyz[t, 0] + .5), <long long>floor(xyz[t, 1] + .5),
+                              <long long>floor(xyz[t, 2] + .5), cval)
+            continue
+        x0 = <long long>floor(xyz[t, 0])
+        y0 = <long long>floor(xyz[t, 1])
+        z0 = <long long>floor(xyz[t, 2])
+        fx = xyz[t, 0] - x0
+        fy = xyz[t, 1] - y0
+        fz = xyz[t, 2] - z0
+        c00 = voxel_at(img, x0, y0, z0, cval) * (1 - fx) + voxel_at(img, x0 + 1, y0, z0, cval) * fx
+        c01 = voxel_at(img, x0, y0, z0 + 1, cval) * (1 - fx) + voxel_at(img, x0 + 1, y0, z0 + 1, cval) * fx
+        c10 = voxel_at(img, x0, y0 + 1, z0, cval) * (1 - fx) + voxel_at(img, x0 + 1, y0 + 1, z0, cval) * fx
+        c11 = voxel_at(img, x0, y0 + 1, z0 + 1, cval) * (1 - fx) + voxel_at(img, x0 + 1, y0 + 1, z0 + 1, cval) * fx
+        out[t] = ((c00 * (1 - fy) + c10 * fy) * (1 - fz) + (c01 * (1 - fy) + c11 * fy) * fz)
+
+
+def sample_terafly(xyz, terafly, order=1, cval=0., block_size=128, num_workers=0, channel=0):
+    """
+    sample a TeraFly volume at an array of points. The points are grouped by blocks and each group only
+    fetches the small window it touches. Turn on the tile cache of the interface to reuse tiles across groups.
+
+    :param xyz: point coordinates of shape (N, 3), in x, y, z order
+    :param terafly: a TeraflyInterface
+    :param order: 0 for nearest neighbor, 1 for trilinear interpolation
+    :param cval: the value of voxels outside the volume
+    :param block_size: the edge length of the point groups
+    :param num_workers: number of groups processed at the same time, default as all cores
+    :param channel: the channel to sample, the only one read from the volume
+    :return: the sampled intensity of each point
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+    dims = np.array(terafly.get_dim([channel])[:3], dtype=np.int64)
+    out = np.full(len(xyz), cval, dtype=np.float64)
+
+    def sample_group(ind):
+        pts = xyz[ind]
+        lo = np.floor(pts.min(axis=0)).astype(np.int64)
+        hi = np.floor(pts.max(axis=0)).astype(np.int64) + 2
+        lo, hi = np.maximum(lo, 0), np.minimum(hi, dims)
+        if (hi <= lo).any():    # the whole group is outside the volume
+            return
+        img = terafly.get_sub_volume(lo[0], hi[0], lo[1], hi[1], lo[2], hi[2], channels=[channel])[0]
+        out[ind] = sample_image(pts - lo, img, order, cval, 1)
+
+    with ThreadPoolExecutor(num_workers if num_workers > 0 else os.cpu_count()) as pool:
+        for _ in pool.map(sample_group, group_markers(xyz, block_size)):
+            pass
+    return out
+
+
+def sample_points(xyz, source, order=1, cval=0., **kwargs):
+    """
+    sample an in-memory image or a TeraFly volume at an array of points.
+
+    :param xyz: point coordinates of shape (N, 3), in x, y, z order
+    :param source: 3D image indexed by z, y, x, or a TeraflyInterface
+    :param order: 0 for nearest neighbor, 1 for trilinear interpolation
+    :param cval: the value of voxels outside the image
+    :param kwargs: passed to sample_terafly or sample_image
+    :return: the sampled intensity of each point
+    """
+    if hasattr(source, 'get_sub_volume'):
+        return sample_terafly(xyz, source, order, cval, **kwargs)
+    return sample_image(xyz, source, order, cval, **kwargs)
+
+
+def segment_points(p0, p1, step=1.):
+    """
+    evenly spaced points along segments, both ends included.
+
+    :param p0: segment starts of shape (N, 3)
+    :param p1: segment ends of shape (N, 3)
+    :param step: the max spacing between the points
+    :return: the points (M, 3), the index of the first point of each segment (N,)
+    """
+    p0 = np.asarray(p0, dtype=np.float64).reshape(-1, 3)
+    p1 = np.asarray(p1, dtype=np.float64).reshape(-1, 3)
+    n = np.ceil(np.linalg.norm(p1 - p0, axis=1) / step).astype(np.int64) + 1
+    starts = np.zeros(len(n), dtype=np.int64)
+    np.cumsum(n[:-1], out=starts[1:])
+    seg = np.repeat(np.arange(len(n)), n)
+    frac = (np.arange(n.sum()) - starts[seg]) / np.maximum(n - 1, 1)[seg]
+    return p0[seg] + (p1 - p0)[seg] * frac[:, None], starts
+
+
+def sample_segments(p0, p1, source, step=1., order=1, cval=0., **kwargs):
+    """
+    sample intensity profiles along segments and summarize them by segment.
+
+    :param p0: segment starts of shape (N, 3), in x, y, z order
+    :param p1: segment ends of shape (N, 3), in x, y, z order
+    :param source: 3D image indexed by z, y, x, or a TeraflyInterface
+    :param step: the max spacing between the samples along a segment
+    :param order: 0 for nearest neighbor, 1 for trilinear interpolation
+    :param cval: the value of voxels outside the image
+    :param kwargs: passed to sample_points
+    :return: min (N,), mean (N,) of each segment, the profile of all the samples (M,), the index of the first
+    sample of each segment (N,)
+    """
+    pts, starts = segment_points(p0, p1, step)
+    if len(starts) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0), starts
+    profile = sample_points(pts, source, order, cval, **kwargs)
+    n = np.diff(np.append(starts, len(pts)))
+    return np.minimum.reduceat(profile, starts), np.add.reduceat(profile, starts) / n, profile, starts
+
+
+def neuron_node_intensity(tree: list[tuple], source, order=1, **kwargs):
+    """
+    sample the intensity at swc nodes.
+
+    :param tree: list of swc nodes
+    :param source: 3D image indexed by z, y, x, or a TeraflyInterface
+    :param order: 0 for nearest neighbor, 1 for trilinear interpolation
+    :param kwargs: passed to sample_points
+    :return: the intensity of each node
+    """
+    return sample_points(np.array([t[2:5] for t in tree], dtype=np.float64).reshape(-1, 3), source, order, **kwargs)
+
+
+def neuron_segment_intensity(tree: list[tuple], source, step=1., order=1, **kwargs):
+    """
+    summarize the intensity along the segment from each swc node to its parent. Nodes without a parent in the tree
+    get the intensity at themselves.
+
+    :param tree: list of swc nodes
+    :param source: 3D image indexed by z, y, x, or a TeraflyInterface
+    :param step: the max spacing between the samples along a segment
+    :param order: 0 for nearest neighbor, 1 for trilinear interpolation
+    :param kwargs: passed to sample_points
+    :return: min, mean of each segment
+    """
+    xyz = np.array([t[2:5] for t in tree], dtype=np.float64).reshape(-1, 3)
+    index = {t[0]: i for i, t in enumerate(tree)}
+    parent = np.array([index.get(t[6], i) for i, t in enumerate(tree)], dtype=np.int64)
+    seg_min, seg_mean, _, _ = sample_segments(xyz, xyz[parent], source, step, order, **kwargs)
+    return seg_min, seg_mean
@@ -0,0 +1,79 @@
+"""
+Reading of volumes slab by slab along z, shared by the TeraFly writer, the streaming reductions and the converter.
+"""
+
+import numpy as np
+from pathlib import Path
+
+
+def open_slabs(src, slab_depth: int, region=None):
+    """
+    Open a single channel volume to be read slab by slab along z.
+
+    :param src: a 3D (Z,Y,X) or single channel 4D array, a v3draw/v3dpbd path, a TeraFly resolution path or a
+    TeraflyInterface
+    :param slab_depth: the number of z slices of a slab
+    :param region: the region (x0, x1, y0, y1, z0, z1) to read, ends exclusive, default as the whole volume. TeraFly
+    volumes only read the region, files are still read up to z1.
+    :return: the region shape (Z,Y,X), the pixel type, and a generator of native-endian slabs
+    """
+    from .terafly import TeraflyInterface
+    from .loaders import PBD, Raw
+    if isinstance(src, np.ndarray):
+        assert src.ndim == 3 or src.ndim == 4 and src.shape[0] == 1, "Only single channel volumes are supported"
+        img = src.reshape(src.shape[-3:])
+        shape, dtype = img.shape, img.dtype
+        slabs = None
+    else:
+        if not isinstance(src, TeraflyInterface) and Path(src).is_dir():
+            src = TeraflyInterface(src)
+        if isinstance(src, TeraflyInterface):
+            x, y, z, c = src.get_dim()
+            assert c == 1, "Only single channel volumes are supported"
+            shape, dtype = (z, y, x), src.get_dtype()
+        else:
+            path = Path(src)
+            if path.suffix.lower() == '.v3dpbd':
+                loader = PBD()
+            elif path.suffix.lower() in ['.v3draw', '.raw']:
+                loader = Raw()
+            else:
+                raise ValueError(f"Unsupported input {src}")
+            shape, dtype = loader.read_header(path)
+            assert len(shape) == 4 and shape[0] == 1, "Only single channel volumes are supported"
+            shape = shape[1:]
+            slabs = loader.load_slabs(path, slab_depth)
+    x0, x1, y0, y1, z0, z1 = region if region is not None else (0, shape[2], 0, shape[1], 0, shape[0])
+    x0, y0, z0 = max(x0, 0), max(y0, 0), max(z0, 0)
+    x1, y1, z1 = min(x1, shape[2]), min(y1, shape[1]), min(z1, shape[0])
+    assert x1 > x0 and y1 > y0 and z1 > z0, "The region is empty"
+    if isinstance(src, np.ndarray):
+        img = img[z0:z1, y0:y1, x0:x1]
+        slabs = (img[z:z + slab_depth] for z in range(0, img.shape[0], slab_depth))
+    elif isinstance(src, TeraflyInterface):
+        slabs = (src.get_sub_volume(x0, x1, y0, y1, z, min(z + slab_depth, z1))[0] for z in range(z0, z1, slab_depth))
+    elif region is not None:
+        slabs = crop_slabs(slabs, slab_depth, (x0, x1, y0, y1, z0, z1))
+    dtype = np.dtype(dtype).newbyteorder('=')
+    return (z1 - z0, y1 - y0, x1 - x0), dtype, (np.ascontiguousarray(s, dtype=dtype) for s in slabs)
+
+
+def crop_slabs(slabs, slab_depth: int, region):
+    """
+    Crop a stream of slabs from z = 0 to a region, regrouping the slices into slabs of the depth.
+    """
+    x0, x1, y0, y1, z0, z1 = region
+    z, buffer, buffered = 0, [], 0
+    for slab in slabs:
+        part = slab[max(z0 - z, 0):max(z1 - z, 0), y0:y1, x0:x1]
+        z += slab.shape[0]
+        if len(part) > 0:
+            buffer.append(part)
+            buffered += len(part)
+        while buffered >= slab_depth or buffered > 0 and z >= z1:
+            data = buffer[0] if len(buffer) == 1 else np.concatenate(buffer)
+            yield data[:slab_depth]
+            buffer = [data[slab_depth:]] if len(data) > slab_depth else []
+            buffered = len(data) - len(data[:slab_depth])
+        if z >= z1:
+            break
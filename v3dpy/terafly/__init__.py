@@ -5,21 +5,40 @@ The indexing style of TeraFly is [start, end]
 """
 
 import os
+import itertools
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from .volume_managers import VirtualVolume, TiledVolume
+from .volume_managers import VirtualVolume, TiledVolume, TiledMCVolume
+from .writer import write_terafly
+from .disk_cache import DiskChunkCache
 from pathlib import Path
 from .config import *
+from ..iostats import IOStats
 
 
-__all__ = ['TeraflyInterface']
+__all__ = ['TeraflyInterface', 'DiskChunkCache', 'write_terafly']
 
 
 class TeraflyInterface:
     """
     Currently only support 3D tiff tiles.
     """
-    def __init__(self, path: os.PathLike | str):
+    def __init__(self, path: os.PathLike | str, tile_cache_bytes: int = 0, stats: IOStats = None,
+                 disk_cache: DiskChunkCache = None):
+        """
+        :param path: teraconverted brain / resolution
+        :param tile_cache_bytes: the capacity of the in-memory cache of decoded tiles, default as 0 (no cache).
+        Turn it on when neighboring crops are loaded repeatedly so that the shared tiles are decoded only once.
+        :param stats: an IOStats to accumulate the crop statistics in, default as None (no instrumentation).
+        :param disk_cache: a DiskChunkCache on local disk to share the decoded tiles with other processes and later
+        runs, default as None (no disk cache).
+        """
         self._path = Path(path)
+        self._tile_cache_bytes = tile_cache_bytes
+        self._stats = stats
+        self._disk_cache = disk_cache
         self._volume: VirtualVolume
         self.update_metadata()
 
@@ -37,11 +56,12 @@ class TeraflyInterface:
                     with open(self._path / FORMAT_MDATA_FILE_NAME) as f:
                         format = f.readline().rstrip()
                     if format == TILED_MC_FORMAT:
-                        raise NotImplementedError
+                        self._volume = TiledMCVolume(self._path, self._tile_cache_bytes, self._stats,
+                                                     self._disk_cache)
                     elif format == STACKED_FORMAT:
                         raise NotImplementedError
                     elif format == TILED_FORMAT:
-                        self._volume = TiledVolume(self._path)
+                        self._volume = TiledVolume(self._path, self._tile_cache_bytes, self._stats, self._disk_cache)
                     elif format == SIMPLE_FORMAT:
                         raise NotImplementedError
                     elif format == SIMPLE_RAW_FORMAT:
@@ -62,7 +82,7 @@ class TeraflyInterface:
                 #     except:
                 #         print(f"cannot import StackedVolume at {path}")
                 try:
-                    self._volume = TiledVolume(self._path)
+                    self._volume = TiledVolume(self._path, self._tile_cache_bytes, self._stats, self._disk_cache)
                 except:
                     print(f"Cannot import TiledVolume at {self._path}")
                     # try:
@@ -88,14 +108,35 @@ class TeraflyInterface:
         else:
             raise ValueError(f"Path {self._path} does not exist")
 
-    def get_dim(self) -> tuple[int, int, int, int]:
+    def open_channels(self, channels=None):
+        """
+        Open the first of the channels to be loaded, so that the metadata of a multi channel volume is read from it
+        rather than from channel 0, and the folders of the channels not requested are never touched.
+
+        :param channels: the channel indices to be loaded, default as all
+        """
+        if channels is not None and len(channels) > 0 and isinstance(self._volume, TiledMCVolume):
+            self._volume.channel(int(channels[0]))
+
+    def get_dim(self, channels=None) -> tuple[int, int, int, int]:
         """
         Get TeraConvert dimensionality range.
+        :param channels: the channel indices to be loaded, see open_channels
         :return: (max x, max y, max z, max c)
         """
-        return self._volume.DIM_H, self._volume.DIM_V, self._volume.DIM_D, self._volume.DIM_C
+        self.open_channels(channels)
+        return self._volume.get_dim()
+
+    def get_dtype(self, channels=None) -> np.dtype:
+        """
+        :param channels: the channel indices to be loaded, see open_channels
+        :return: the pixel type of the volume
+        """
+        self.open_channels(channels)
+        return np.dtype({1: np.uint8, 2: np.uint16, 4: np.float32}[self._volume.bytes_per_channel()])
 
-    def get_sub_volume(self, x0: int, x1: int, y0: int, y1: int, z0: int, z1: int):
+    def get_sub_volume(self, x0: int, x1: int, y0: int, y1: int, z0: int, z1: int, out: np.ndarray = None,
+                       channels=None):
         """
         Different from Vaa3D, it returns the image of its original pixel type.
         The indexing is pixel-wise, so you have to use different coordinates for different resolutions
@@ -108,6 +149,87 @@ class TeraflyInterface:
         :param y1: ending y
         :param z0: starting z
         :param z1: ending z
-        :return: the image crop
+        :param out: the array (C, Z, Y, X) or (Z, Y, X) to load the crop into in place, e.g. a view of shared memory,
+        of the extent requested, which can go beyond the volume. Only the parts not covered by tiles are zeroed.
+        :param channels: the channel indices to load, default as all. Multi channel volumes only read the folders of
+        these, decoding them concurrently.
+        :return: the image crop, a view of out if given
         """
-        return self._volume.load_sub_volume(y0, y1, x0, x1, z0, z1)
+        return self._volume.load_sub_volume(y0, y1, x0, x1, z0, z1, out, channels)
+
+    def chunk_grid(self, channels=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The native chunk grid of the volume, i.e. its tile boundaries. Blockwise processing aligned to it decodes every
+        tile once, whereas boxes straddling the tiles decode most of them several times.
+
+        :param channels: the channel indices to be loaded, see open_channels
+        :return: the sorted chunk boundaries along x, y and z, each from 0 to the size of the volume
+        """
+        self.open_channels(channels)
+        v, h, d = self._volume.chunk_grid()
+        return h, v, d
+
+    def iter_chunks(self, halo=0, order: str = 'zyx', workers: int = 1, channels=None, cache_bytes: int = 1 << 30):
+        """
+        Walk the volume chunk by chunk along its native chunk grid, loading the next chunks in the background.
+
+        With a halo, each chunk also reads the margins of its neighbor tiles, which are kept in a tile cache of the
+        walk's own, freed when the walk ends. Every tile is decoded once if the cache holds two layers of tiles along
+        the outermost axis of the walk, otherwise about once per layer that needs it. The tile cache of the interface is
+        used instead if larger, and is left as it is either way.
+
+        :param halo: the padding around each chunk, an int or (x, y, z), zeroed beyond the volume
+        :param order: the axes from the outermost to the innermost of the walk, default as 'zyx', i.e. z layer by z
+        layer and x the fastest
+        :param workers: the number of chunks loaded ahead in parallel
+        :param channels: the channel indices to load, default as all
+        :param cache_bytes: the largest tile cache to use for the halo
+        :return: a generator of (x0, x1, y0, y1, z0, z1), the chunk box without the halo with ends exclusive, and its
+        padded image (C, Z, Y, X)
+        """
+        hx, hy, hz = (int(h) for h in ((halo,) * 3 if np.isscalar(halo) else halo))
+        assert min(hx, hy, hz) >= 0, "The halo can't be negative"
+        assert sorted(order) == ['x', 'y', 'z'], f"Invalid order {order}"
+        assert workers >= 1, "There has to be at least one worker"
+        grid = dict(zip('xyz', self.chunk_grid(channels)))
+        n_channels = self.get_dim(channels)[3] if channels is None else len(channels)
+        dtype = self.get_dtype(channels)
+        volume = self._volume
+
+        def boxes():
+            for index in itertools.product(*[range(len(grid[a]) - 1) for a in order]):
+                box = {a: (int(grid[a][i]), int(grid[a][i + 1])) for a, i in zip(order, index)}
+                yield *box['x'], *box['y'], *box['z']
+
+        def load(box):
+            x0, x1, y0, y1, z0, z1 = box
+            img = np.empty((n_channels, z1 - z0 + 2 * hz, y1 - y0 + 2 * hy, x1 - x0 + 2 * hx), dtype=dtype)
+            # the crop starts are clamped to the volume, so zero the padding before them here
+            pz, py, px = max(hz - z0, 0), max(hy - y0, 0), max(hx - x0, 0)
+            img[:, :pz] = 0
+            img[:, :, :py] = 0
+            img[:, :, :, :px] = 0
+            volume.load_sub_volume(max(y0 - hy, 0), y1 + hy, max(x0 - hx, 0), x1 + hx, max(z0 - hz, 0), z1 + hz,
+                                   img[:, pz:, py:, px:], channels)
+            return box, img
+
+        if hx or hy or hz:
+            # a tile is last needed 2 layers, 2 rows and 2 chunks after its first use
+            n = [len(grid[a]) - 1 for a in order]
+            window = 2 * n[1] * n[2] + 2 * n[2] + 3
+            size = min(cache_bytes // n_channels, window * volume.tile_nbytes())
+            if self._tile_cache_bytes < size:
+                # open the volume again for the walk, so that other users of the interface keep their cache
+                volume = type(volume)(self._path, size, self._stats, self._disk_cache)
+        pool = ThreadPoolExecutor(workers)
+        pending = deque()
+        try:
+            for box in boxes():
+                pending.append(pool.submit(load, box))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # stop loading ahead if the walk is left early
+            pool.shutdown(cancel_futures=True)
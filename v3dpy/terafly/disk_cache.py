@@ -0,0 +1,155 @@
+"""
+A persistent cache of decoded TeraFly tiles on local disk, shared by the processes on a node and kept across
+restarts. Each decoded tile file is stored uncompressed as a .npy chunk and served memory-mapped, so repeat crops
+only copy from the page cache instead of reading and decoding from the network storage again.
+
+Chunks are written to a temporary file and renamed into place, so concurrent writers never expose partial chunks.
+Reading refreshes the modification time of a chunk, by which the least recently used ones are evicted when the
+cache outgrows its capacity.
+"""
+
+import os
+import hashlib
+import threading
+import time
+import numpy as np
+from pathlib import Path
+
+
+class DiskChunkCache:
+    """
+    Decoded tile chunks under a local directory, keyed by the volume, resolution and tile, with a size cap and LRU
+    eviction. It can be shared by any number of TeraflyInterface objects, threads and processes.
+    """
+    def __init__(self, root: os.PathLike | str, capacity_bytes: int):
+        """
+        :param root: the cache directory, preferably on a local SSD
+        :param capacity_bytes: the size cap of the chunks in the directory
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.capacity_bytes = capacity_bytes
+        self.lock = threading.Lock()
+        self.used = None        # the estimated size of the chunks, scanned on the first write
+        self.unscanned = 0      # the bytes written since the last scan, other processes are not seen until a rescan
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        :param parts: the parts identifying a chunk, e.g. the volume token, the tile directory and file name
+        :return: the chunk key
+        """
+        return hashlib.sha1('\0'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def chunk_path(self, key: str) -> Path:
+        return self.root / key[:2] / f'{key}.npy'
+
+    def get(self, key: str):
+        """
+        :param key: the chunk key
+        :return: the chunk memory-mapped read-only, or None if not cached
+        """
+        path = self.chunk_path(key)
+        try:
+            chunk = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):     # missing, just evicted, or unreadable
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return chunk
+
+    def put(self, key: str, chunk: np.ndarray):
+        """
+        Store a chunk, evicting the least recently used ones if the cache is over capacity.
+
+        :param key: the chunk key
+        :param chunk: the decoded array, skipped if larger than the capacity or if it cannot be written
+        """
+        if chunk.nbytes > self.capacity_bytes:
+            return
+        path = self.chunk_path(key)
+        tmp = path.with_name(f'{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            path.parent.mkdir(exist_ok=True)
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(chunk))
+            os.replace(tmp, path)
+        except OSError:     # disk full, or the chunk is mapped by another process on Windows
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.unscanned += chunk.nbytes
+            if self.used is None or self.used + self.unscanned > self.capacity_bytes or \
+                    self.unscanned > self.capacity_bytes // 8:
+                entries = self.scan()
+                self.used, self.unscanned = sum(e[1] for e in entries), 0
+                if self.used > self.capacity_bytes:
+                    self.shrink(entries, self.capacity_bytes * 9 // 10)
+
+    def scan(self) -> list[tuple[int, int, Path]]:
+        """
+        :return: the modification time, size and path of every chunk, removing the temporary files left over by
+        writers that crashed over an hour ago
+        """
+        entries = []
+        stale = time.time_ns() - 3600 * 10 ** 9
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith('.npy'):
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, Path(e.path)))
+                elif e.name.endswith('.tmp'):
+                    try:
+                        if e.stat().st_mtime_ns < stale:
+                            os.unlink(e.path)
+                    except OSError:
+                        pass
+        return entries
+
+    def shrink(self, entries: list, target: int):
+        """
+        Remove the least recently used of the scanned chunks until the rest fit in the target size.
+        """
+        used = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if used <= target:
+                break
+            try:
+                path.unlink()
+                used -= size
+            except FileNotFoundError:   # evicted by another process
+                used -= size
+            except OSError:     # still mapped on Windows
+                pass
+        self.used, self.unscanned = used, 0
+
+    def evict(self, target: int):
+        """
+        Remove the least recently used chunks until the cache fits in the target size.
+
+        :param target: the size to shrink to
+        """
+        with self.lock:
+            self.shrink(self.scan(), target)
+
+    def usage(self) -> int:
+        """
+        :return: the total size of the chunks on disk
+        """
+        return sum(e[1] for e in self.scan())
+
+    def clear(self):
+        """
+        Remove all the chunks.
+        """
+        self.evict(0)
@@ -1,11 +1,21 @@
 from libc.stdint cimport uint8_t, int64_t, int32_t, uint32_t
+cimport numpy as cnp
+from ..iostats cimport IOStats
 
 
 cdef class VirtualFmtMngr:
+    cdef public IOStats stats
+
+    cdef cnp.ndarray read_file_block(self, const char* filename, int32_t sD0, int32_t sD1, uint32_t pxl_size)
+
     cdef public void copy_file_block2buffer(self, const char* filename, int32_t sV0, int32_t sV1, int32_t sH0, int32_t sH1, int32_t sD0, int32_t sD1,
                                              uint8_t * buf, uint32_t pxl_size, int64_t offs, int64_t stridex,
                                              int64_t stridexy, int64_t stridexyz)
 
+    cdef void copy_array_block2buffer(self, cnp.ndarray block, int32_t sV0, int32_t sV1, int32_t sH0, int32_t sH1,
+                                      int32_t sD0, int32_t sD1, uint8_t * buf, uint32_t pxl_size, int64_t offs,
+                                      int64_t stridex, int64_t stridexy, int64_t stridexyz)
+
     cdef void copy_block2sub_buf(self, uint8_t * src, uint8_t * dst,
                                 int32_t dimi, int32_t dimj, int32_t dimk, int32_t typesize,
                                 int64_t s_stridej, int64_t s_strideij,
@@ -18,6 +28,4 @@ cdef class VirtualFmtMngr:
 
 
 cdef class Tiff3DFmtMngr(VirtualFmtMngr):
-    cdef public void copy_file_block2buffer(self, const char* filename, int32_t sV0, int32_t sV1, int32_t sH0, int32_t sH1, int32_t sD0, int32_t sD1,
-                                            uint8_t* buf, uint32_t pxl_size, int64_t offs, int64_t stridex,
-                                            int64_t stridexy, int64_t stridexyz)
\ No newline at end of file
+    cdef cnp.ndarray read_file_block(self, const char* filename, int32_t sD0, int32_t sD1, uint32_t pxl_size)
\ No newline at end of file
@@ -1,5 +1,6 @@
 # Import relevant Cython modules
 import numpy as np
+from time import perf_counter_ns
 cimport cython
 from .tiff_manage cimport read_tiff_3d_file_to_buffer, load_tiff3d2metadata, close_tiff3d_file
 from libc.stdint cimport uint8_t, int64_t, uint16_t, int32_t, uint32_t
@@ -8,10 +9,59 @@ cimport numpy as cnp
 
 
 cdef class VirtualFmtMngr:
+    cdef cnp.ndarray read_file_block(self, const char* filename, int32_t sD0, int32_t sD1, uint32_t pxl_size):
+        """
+        Decode the slices [sD0, sD1) of a file block, counting the file opening and decoding in stats if set.
+
+        :return: a uint8 array of shape (depth, height, width, channels * pxl_size)
+        """
+        raise NotImplementedError
+
     cdef void copy_file_block2buffer(self, const char* filename, int32_t sV0, int32_t sV1, int32_t sH0, int32_t sH1, int32_t sD0, int32_t sD1,
                                      uint8_t * buf, uint32_t pxl_size, int64_t offs, int64_t stridex,
                                      int64_t stridexy, int64_t stridexyz):
-        raise NotImplementedError
+        cdef cnp.ndarray block = self.read_file_block(filename, sD0, sD1, pxl_size)
+        cdef int64_t t
+        if self.stats is not None:
+            t = perf_counter_ns()
+        self.copy_array_block2buffer(block, sV0, sV1, sH0, sH1, 0, sD1 - sD0,
+                                     buf, pxl_size, offs, stridex, stridexy, stridexyz)
+        if self.stats is not None:
+            self.stats.copy_ns += perf_counter_ns() - t
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void copy_array_block2buffer(self, cnp.ndarray block, int32_t sV0, int32_t sV1, int32_t sH0, int32_t sH1,
+                                      int32_t sD0, int32_t sD1, uint8_t * buf, uint32_t pxl_size, int64_t offs,
+                                      int64_t stridex, int64_t stridexy, int64_t stridexyz):
+        """
+        Copy a sub block of a decoded file block (from read_file_block) to the buffer.
+        """
+        cdef:
+            int64_t n_chans = block.shape[3] // pxl_size
+            int64_t s_stridej = block.shape[2]
+            int64_t s_strideij = block.shape[2] * block.shape[1]
+            uint8_t * buf_t = <uint8_t *> block.data + n_chans * pxl_size * s_strideij * sD0
+            int32_t dimi = sV1 - sV0
+            int32_t dimj = sH1 - sH0
+            int32_t dimk = sD1 - sD0
+
+        if n_chans == 1:  # single channel Tiff
+            self.copy_block2sub_buf(
+                buf_t + pxl_size * (s_stridej * sV0 + sH0),
+                buf + pxl_size * offs,
+                dimi, dimj, dimk, pxl_size,
+                s_stridej, s_strideij, stridex, stridexy
+            )
+        elif n_chans == 3:  # RGB Tiff
+            self.copy_rgb_block2vaa3d_raw_sub_buf(
+                buf_t + 3 * pxl_size * (s_stridej * sV0 + sH0),
+                buf + pxl_size * offs,
+                dimi, dimj, dimk, pxl_size,
+                s_stridej, s_strideij,
+                stridex, stridexy, stridexyz)
+        else:
+            raise IOError("VirtualFmtMngr.copy_array_block2buffer: unsupported number of channels.")
 
     cdef void copy_block2sub_buf(self, uint8_t* src, uint8_t* dst,
                            int32_t dimi, int32_t dimj, int32_t dimk, int32_t typesize,
@@ -98,51 +148,30 @@ cdef class Tiff3DFmtMngr(VirtualFmtMngr):
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef void copy_file_block2buffer(self, const char* filename,
-                                     int32_t sV0, int32_t sV1, int32_t sH0, int32_t sH1, int32_t sD0, int32_t sD1,
-                                     uint8_t* buf, uint32_t pxl_size,
-                                     int64_t offs,
-                                     int64_t stridex,
-                                     int64_t stridexy,
-                                     int64_t stridexyz):
+    cdef cnp.ndarray read_file_block(self, const char* filename, int32_t sD0, int32_t sD1, uint32_t pxl_size):
         cdef:
             unsigned int sz[4]
             int datatype = 0
             bint b_swap = 0
+            int64_t t = perf_counter_ns() if self.stats is not None else 0
             void* fhandle = load_tiff3d2metadata(filename, sz[0], sz[1], sz[2], sz[3], datatype, b_swap)
 
+        if self.stats is not None:
+            self.stats.files_opened += 1
+            self.stats.open_ns += perf_counter_ns() - t
+            t = perf_counter_ns()
         if datatype != pxl_size:
-            raise IOError("Tiff3DFmtMngr.copy_file_block2buffer: source data type differs from destination pixel size.")
-
-        cdef cnp.ndarray[cnp.uint8_t, ndim=1] npbuf_t = np.zeros(sz[0] * sz[1] * (sD1 - sD0) * sz[3] * datatype, dtype=np.uint8)
-        cdef unsigned char * buf_t = <uint8_t *> npbuf_t.data
-
-        read_tiff_3d_file_to_buffer(fhandle, buf_t, sz[0], sz[1], sD0, sD1 - 1, b_swap,1, -1, -1, -1, -1)
-        close_tiff3d_file(fhandle)
-
-        cdef:
-            int64_t s_stridej = sz[0]
-            int64_t s_strideij = sz[0] * sz[1]
-            int64_t d_stridej = stridex
-            int64_t d_strideij = stridexy
-            int64_t d_strideijk = stridexyz
-            int32_t dimi = sV1 - sV0
-            int32_t dimj = sH1 - sH0
-            int32_t dimk = sD1 - sD0
-
-        if sz[3] == 1:  # single channel Tiff
-            self.copy_block2sub_buf(
-                buf_t + pxl_size * (s_stridej * sV0 + sH0),
-                buf + pxl_size * offs,
-                dimi, dimj, dimk, pxl_size,
-                s_stridej, s_strideij, d_stridej, d_strideij
-            )
-        elif sz[3] == 3:  # RGB Tiff
-            self.copy_rgb_block2vaa3d_raw_sub_buf(
-                buf_t + 3 * pxl_size * (s_stridej * sV0 + sH0),
-                buf + pxl_size * offs,
-                dimi, dimj, dimk, pxl_size,
-                s_stridej, s_strideij,
-                d_stridej, d_strideij, d_strideijk)
-        else:
-            raise IOError("Tiff3DFmtMngr.copy_file_block2buffer: unsupported number of channels.")
\ No newline at end of file
+            close_tiff3d_file(fhandle)
+            raise IOError("Tiff3DFmtMngr.read_file_block: source data type differs from destination pixel size.")
+
+        cdef cnp.ndarray[cnp.uint8_t, ndim=4] npbuf_t = np.zeros((sD1 - sD0, sz[1], sz[0], sz[3] * datatype),
+                                                                 dtype=np.uint8)
+        try:
+            read_tiff_3d_file_to_buffer(fhandle, <uint8_t *> npbuf_t.data, sz[0], sz[1], sD0, sD1 - 1, b_swap,
+                                        1, -1, -1, -1, -1)
+        finally:
+            close_tiff3d_file(fhandle)
+        if self.stats is not None:
+            self.stats.bytes_read += npbuf_t.nbytes
+            self.stats.decode_ns += perf_counter_ns() - t
+        return npbuf_t
@@ -6,7 +6,7 @@ cimport numpy as cnp
 import numpy as np
 
 
-cdef extern from "tiffio.h":
+cdef extern from "tiffio.h" nogil:
     ctypedef struct TIFF
     ctypedef int64_t ttile_t
     ctypedef uint64_t tstrip_t
@@ -20,6 +20,9 @@ cdef extern from "tiffio.h":
     void TIFFSetErrorHandler(void * handler)
 
     int TIFFGetField(TIFF * tif, unsigned int tag, ...)
+    int TIFFSetField(TIFF * tif, unsigned int tag, ...)
+    int TIFFWriteDirectory(TIFF * tif)
+    tsize_t TIFFWriteEncodedStrip(TIFF * tif, tstrip_t strip, tdata_t buf, tsize_t size)
     int TIFFReadDirectory(TIFF * tif)
     int TIFFIsTiled(TIFF * tif)
     tsize_t TIFFTileSize(TIFF * tif)
@@ -46,15 +49,28 @@ cdef extern from "tiffio.h":
         TIFFTAG_TILELENGTH
         TIFFTAG_TILEDEPTH
         TIFFTAG_ROWSPERSTRIP
+        TIFFTAG_SUBFILETYPE
 
+    enum:  # TIFF tag values
+        COMPRESSION_NONE
+        COMPRESSION_LZW
+        COMPRESSION_ADOBE_DEFLATE
+        PHOTOMETRIC_MINISBLACK
+        PHOTOMETRIC_RGB
+        PLANARCONFIG_CONTIG
+        FILETYPE_PAGE
 
-cdef void swap2bytes(void* targetp):
+
+TIFF_COMPRESSION = {'none': COMPRESSION_NONE, 'lzw': COMPRESSION_LZW, 'deflate': COMPRESSION_ADOBE_DEFLATE}
+
+
+cdef void swap2bytes(void* targetp) noexcept nogil:
     cdef unsigned char* tp = <unsigned char*>targetp
     cdef unsigned char a = tp[0]
     tp[0] = tp[1]
     tp[1] = a
 
-cdef void swap4bytes(void* targetp):
+cdef void swap4bytes(void* targetp) noexcept nogil:
     cdef unsigned char* tp = <unsigned char*>targetp
     cdef unsigned char a = tp[0]
     tp[0] = tp[3]
@@ -124,6 +140,65 @@ cdef void* load_tiff3d2metadata(const char* filename, unsigned int& sz0, unsigne
     return <void*> input
 
 
+cdef int write_tiff3d_file(const char* filename, const unsigned char* img, uint32_t width, uint32_t height,
+                           uint32_t depth, uint16_t bytes_per_sample, uint16_t spp, uint16_t compression) noexcept nogil:
+    """
+    Write a 3D image into a multipage tiff with a single strip per page, the layout of TeraConverter.
+
+    :return: 0 on success, -1 if the file cannot be opened, -2 if a page cannot be written
+    """
+    cdef:
+        TIFF* output = TIFFOpen(filename, 'w')
+        uint32_t page
+        tsize_t page_size = <tsize_t>width * height * spp * bytes_per_sample
+    if output == NULL:
+        return -1
+    for page in range(depth):
+        TIFFSetField(output, TIFFTAG_IMAGEWIDTH, width)
+        TIFFSetField(output, TIFFTAG_IMAGELENGTH, height)
+        TIFFSetField(output, TIFFTAG_BITSPERSAMPLE, <uint16_t>(bytes_per_sample * 8))
+        TIFFSetField(output, TIFFTAG_SAMPLESPERPIXEL, spp)
+        TIFFSetField(output, TIFFTAG_ROWSPERSTRIP, height)
+        TIFFSetField(output, TIFFTAG_COMPRESSION, compression)
+        TIFFSetField(output, TIFFTAG_PHOTOMETRIC, PHOTOMETRIC_RGB if spp == 3 else PHOTOMETRIC_MINISBLACK)
+        TIFFSetField(output, TIFFTAG_PLANARCONFIG, PLANARCONFIG_CONTIG)
+        TIFFSetField(output, TIFFTAG_SUBFILETYPE, FILETYPE_PAGE)
+        TIFFSetField(output, TIFFTAG_PAGENUMBER, <uint16_t>page, <uint16_t>depth)
+        if TIFFWriteEncodedStrip(output, 0, <tdata_t>(img + page * page_size), page_size) < 0 or \
+                not TIFFWriteDirectory(output):
+            TIFFClose(output)
+            return -2
+    TIFFClose(output)
+    return 0
+
+
+def write_tiff3d(path, img: np.ndarray, compression='lzw'):
+    """
+    Write a 3D image into a multipage tiff that Tiff3DFmtMngr reads. The GIL is released while writing, so tiles can be
+    written in parallel threads.
+
+    :param path: the output tiff path
+    :param img: a 3D (Z,Y,X) uint8/uint16 image, or 4D (Z,Y,X,3) for RGB
+    :param compression: 'none', 'lzw' or 'deflate'
+    """
+    assert img.ndim == 3 or img.ndim == 4 and img.shape[3] == 3, "The image has to be 3D or 3D RGB"
+    assert img.dtype in [np.uint8, np.uint16], "The pixel type has to be uint8 or uint16"
+    cdef:
+        cnp.ndarray arr = np.ascontiguousarray(img, dtype=img.dtype.newbyteorder('='))
+        bytes filename = str(path).encode('utf-8')
+        const char* fn = filename
+        const unsigned char* buf = <const unsigned char*>arr.data
+        uint32_t width = arr.shape[2], height = arr.shape[1], depth = arr.shape[0]
+        uint16_t bps = arr.itemsize, spp = 3 if arr.ndim == 4 else 1, comp = TIFF_COMPRESSION[compression]
+        int ret
+    with nogil:
+        ret = write_tiff3d_file(fn, buf, width, height, depth, bps, spp, comp)
+    if ret == -1:
+        raise IOError(f"Cannot open {path} for writing.")
+    elif ret != 0:
+        raise IOError(f"Failed writing {path}.")
+
+
 cdef void copydata(unsigned char *psrc, uint32_t stride_src, unsigned char *pdst, uint32_t stride_dst, uint32_t width, uint32_t len):
     cdef uint32_t i
     for i in range(len):
@@ -276,24 +351,26 @@ cdef void read_tiff_3d_file_to_buffer(void* fhandler,
             if not TIFFSetDirectory(input, first):
                 raise IOError("Cannot open the requested first strip.")
 
-            while True:
-                for i in range(strips_per_image - 1):
+            # decode without the GIL so that tiles, e.g. of different channels, are decoded concurrently
+            with nogil:
+                while True:
+                    for i in range(strips_per_image - 1):
+                        if comp == 1:
+                            TIFFReadRawStrip(input, i, buf, spp * rps * img_width * (bpp / 8))
+                            buf += spp * rps * img_width * (bpp / 8)
+                        else:
+                            TIFFReadEncodedStrip(input, i, buf, spp * rps * img_width * (bpp / 8))
+                            buf += spp * rps * img_width * (bpp / 8)
+
                     if comp == 1:
-                        TIFFReadRawStrip(input, i, buf, spp * rps * img_width * (bpp / 8))
-                        buf += spp * rps * img_width * (bpp / 8)
+                        TIFFReadRawStrip(input, strips_per_image - 1, buf, spp * last_strip_size * img_width * (bpp / 8))
                     else:
-                        TIFFReadEncodedStrip(input, i, buf, spp * rps * img_width * (bpp / 8))
-                        buf += spp * rps * img_width * (bpp / 8)
+                        TIFFReadEncodedStrip(input, strips_per_image - 1, buf, spp * last_strip_size * img_width * (bpp / 8))
+                    buf += spp * last_strip_size * img_width * (bpp / 8)
 
-                if comp == 1:
-                    TIFFReadRawStrip(input, strips_per_image - 1, buf, spp * last_strip_size * img_width * (bpp / 8))
-                else:
-                    TIFFReadEncodedStrip(input, strips_per_image - 1, buf, spp * last_strip_size * img_width * (bpp / 8))
-                buf += spp * last_strip_size * img_width * (bpp / 8)
-
-                page += 1
-                if not (<unsigned int>page < last - first + 1 and TIFFReadDirectory(input)):
-                    break
+                    page += 1
+                    if not (<unsigned int>page < last - first + 1 and TIFFReadDirectory(input)):
+                        break
         else:  # read only a subregion of images from files
             if not TIFFGetField(input, TIFFTAG_IMAGEWIDTH, &XSIZE):
                 raise IOError("Image width of undefined.")
@@ -382,9 +459,10 @@ cdef void read_tiff_3d_file_to_buffer(void* fhandler,
 
     cdef tsize_t total = img_width * img_height * spp * (last-first+1)
     if b_swap:
-        if bpp / 8 == 2:
-            for i in range(total):
-                swap2bytes(<void *> (img + 2 * i))
-        elif bpp / 8 == 4:
-            for i in range(total):
-                swap4bytes(<void *> (img + 4 * i))
\ No newline at end of file
+        with nogil:
+            if bpp / 8 == 2:
+                for i in range(total):
+                    swap2bytes(<void *> (img + 2 * i))
+            elif bpp / 8 == 4:
+                for i in range(total):
+                    swap4bytes(<void *> (img + 4 * i))
\ No newline at end of file
@@ -1,13 +1,18 @@
 cimport cython
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Event
 from .config import *
 import struct
+from time import perf_counter_ns
 import numpy as np
 cimport numpy as cnp
 
 from libcpp.string cimport string
 from libcpp.vector cimport vector
 from .format_managers cimport Tiff3DFmtMngr, VirtualFmtMngr
+from ..iostats cimport IOStats
 from libc.stdint cimport uint32_t, int64_t, int32_t, uint16_t
 
 
@@ -30,8 +35,21 @@ cdef class VirtualVolume:
         self.VXL_D = vxl_3
 
 
+    def get_dim(self):
+        """
+        :return: (DIM_H, DIM_V, DIM_D, DIM_C)
+        """
+        return self.DIM_H, self.DIM_V, self.DIM_D, self.DIM_C
+
+    def bytes_per_channel(self):
+        """
+        :return: BYTESxCHAN, the bytes of a voxel of a channel
+        """
+        return self.BYTESxCHAN
+
     cpdef cnp.ndarray load_sub_volume(self, int32_t v0=-1, int32_t v1=-1, int32_t h0=-1,
-                                    int32_t h1=-1, int32_t d0=-1, int32_t d1=-1):
+                                    int32_t h1=-1, int32_t d0=-1, int32_t d1=-1, cnp.ndarray out=None,
+                                    object channels=None):
         raise NotImplementedError
 
 
@@ -148,16 +166,40 @@ cdef class TiledVolume(VirtualVolume):
         list BLOCKS  # <-- Declare a 2D C-style array of Blocks
         int32_t reference_system_first, reference_system_second, reference_system_thrid
         float VXL_1, VXL_2, VXL_3
+        object tile_cache, tile_cache_lock
+        dict tile_loading
+        public int64_t tile_cache_bytes
+        int64_t tile_cache_used
+        public object disk_cache
+        str disk_cache_token
+        public IOStats stats
 
     def __cinit__(self):
         self.reference_system_first = self.reference_system_second = self.reference_system_thrid = \
             self.VXL_1 = self.VXL_2 = self.VXL_3 = self.N_ROWS = self.N_COLS = 0
-
-    def __init__(self, root_dir: Path):
+        self.tile_cache_bytes = self.tile_cache_used = 0
+
+    def __init__(self, root_dir: Path, int64_t tile_cache_bytes=0, IOStats stats=None, disk_cache=None):
+        """
+        :param root_dir: the resolution directory.
+        :param tile_cache_bytes: the capacity of the in-memory cache of decoded tiles, default as 0 (no cache).
+        With the cache, tiles are decoded as a whole and reused by later crops, least recently used ones are dropped.
+        :param stats: an IOStats to accumulate the loading statistics in, default as None (no instrumentation).
+        :param disk_cache: a DiskChunkCache to keep the decoded tiles in across processes, checked after the
+        in-memory cache, default as None (no disk cache).
+        """
+        self.stats = stats
+        self.disk_cache = disk_cache
         super(TiledVolume, self).__init__(root_dir)
         self.BLOCKS = None
+        self.tile_cache = OrderedDict()
+        self.tile_cache_lock = Lock()
+        self.tile_loading = {}
+        self.tile_cache_bytes = tile_cache_bytes
         mdata_filepath = root_dir / MDATA_BIN_FILE_NAME
         if mdata_filepath.is_file():  # We need to convert string back to Path object for is_file()
+            # identifies the resolution in the disk cache, and invalidates it when the volume is rewritten
+            self.disk_cache_token = f'{Path(root_dir).resolve()}:{mdata_filepath.stat().st_mtime_ns}'
             self.load(mdata_filepath)
             self.init_channels()
         else:
@@ -186,11 +228,115 @@ cdef class TiledVolume(VirtualVolume):
         self.DIM_C = self.BLOCKS[0][0].N_CHANS
         self.BYTESxCHAN = self.BLOCKS[0][0].N_BYTESxCHAN
 
+    cdef cnp.ndarray cached_file_block(self, bytes slice_fullpath, VirtualFmtMngr fmt_mngr, int32_t depth):
+        """
+        Get a whole decoded file block from the tile cache, then the disk cache, decoding and caching it on a miss.
+        """
+        cdef cnp.ndarray block = None
+        cdef str key
+        cdef object loading = None
+        if self.tile_cache_bytes > 0:
+            while True:
+                with self.tile_cache_lock:
+                    block = self.tile_cache.get(slice_fullpath)
+                    if block is not None:
+                        self.tile_cache.move_to_end(slice_fullpath)
+                        break
+                    loading = self.tile_loading.get(slice_fullpath)
+                    if loading is None:
+                        # decode it here, the other threads missing it meanwhile wait for this one
+                        loading = self.tile_loading[slice_fullpath] = Event()
+                        break
+                loading.wait()
+                loading = None
+            if fmt_mngr.stats is not None:
+                if block is None:
+                    fmt_mngr.stats.cache_misses += 1
+                else:
+                    fmt_mngr.stats.cache_hits += 1
+            if block is not None:
+                return block
+        try:
+            if self.disk_cache is not None:
+                key = self.disk_cache.key(self.disk_cache_token, slice_fullpath.decode('utf-8'))
+                block = self.disk_cache.get(key)
+                if fmt_mngr.stats is not None:
+                    if block is None:
+                        fmt_mngr.stats.disk_misses += 1
+                    else:
+                        fmt_mngr.stats.disk_hits += 1
+                if block is not None and self.tile_cache_bytes > 0:
+                    # the tile cache holds decoded arrays in memory, not maps of the disk cache files
+                    block = np.array(block)
+            if block is None:
+                block = fmt_mngr.read_file_block(slice_fullpath, 0, depth, self.BYTESxCHAN)
+                if self.disk_cache is not None:
+                    self.disk_cache.put(key, block)
+            if self.tile_cache_bytes > 0:
+                with self.tile_cache_lock:
+                    if slice_fullpath not in self.tile_cache and block.nbytes <= self.tile_cache_bytes:
+                        self.tile_cache[slice_fullpath] = block
+                        self.tile_cache_used += block.nbytes
+                        while self.tile_cache_used > self.tile_cache_bytes:
+                            self.tile_cache_used -= self.tile_cache.popitem(last=False)[1].nbytes
+        finally:
+            if loading is not None:
+                with self.tile_cache_lock:
+                    del self.tile_loading[slice_fullpath]
+                loading.set()
+        return block
+
+    def clear_tile_cache(self):
+        """
+        Drop all the cached tiles.
+        """
+        with self.tile_cache_lock:
+            self.tile_cache.clear()
+            self.tile_cache_used = 0
+
+    def chunk_grid(self):
+        """
+        The native chunk grid, i.e. the boundaries of the tile rows, columns and file blocks along the depth. A crop
+        aligned to it reads every tile file it touches whole.
+
+        :return: the sorted boundaries along V, H and D, each from 0 to the size of the volume
+        """
+        cdef Block block
+        rows, cols, slices = {0, self.DIM_V}, {0, self.DIM_H}, {0, self.DIM_D}
+        for blocks in self.BLOCKS:
+            for block in blocks:
+                rows.add(block.ABS_V)
+                cols.add(block.ABS_H)
+                slices.update(block.BLOCK_ABS_D)
+        return tuple([np.array(sorted(b), dtype=np.int64) for b in (rows, cols, slices)])
+
+    def tile_nbytes(self):
+        """
+        :return: the size of the largest decoded tile file
+        """
+        cdef Block block
+        cdef int64_t n = 0
+        for blocks in self.BLOCKS:
+            for block in blocks:
+                for k in range(block.N_BLOCKS):
+                    n = max(n, <int64_t>block.HEIGHT * block.WIDTH * block.BLOCK_SIZE[k])
+        return n * self.BYTESxCHAN
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.nonecheck(False)
     cpdef cnp.ndarray load_sub_volume(self, int32_t V0=-1, int32_t V1=-1, int32_t H0=-1,
-                                      int32_t H1=-1, int32_t D0=-1, int32_t d1=-1):
+                                      int32_t H1=-1, int32_t D0=-1, int32_t d1=-1, cnp.ndarray out=None,
+                                      object channels=None):
+        """
+        Load a crop, ends exclusive and clamped to the volume.
+
+        :param out: the array (C, Z, Y, X) or (Z, Y, X) of a single channel to load the crop into, e.g. a view of
+        shared memory, default as a new array. Its shape has to match the requested extent, which is not clamped,
+        and only the parts not covered by tiles, i.e. NULL tiles and beyond the volume, are zeroed.
+        :param channels: the channels to load, only [0] for a single channel volume, default as all
+        :return: the crop (C, Z, Y, X), a view of out if given
+        """
         cdef:
             uint16_t row, col
             int32_t k, sV0, sV1, sH0, sH1, sD0, sD1, bV0, bH0, bD0
@@ -198,24 +344,66 @@ cdef class TiledVolume(VirtualVolume):
             Rect intersect_area
             Segm intersect_segm
             bytes slice_fullpath
-            bint first_time = True
             bytes ffmt
 
         V0, H0, D0 = max(0, V0), max(0, H0), max(0, D0)
+        cdef:
+            # the requested ends, which out can extend beyond the volume
+            int32_t rV1 = V1 if V1 >= 0 else self.DIM_V
+            int32_t rH1 = H1 if H1 >= 0 else self.DIM_H
+            int32_t rd1 = d1 if d1 >= 0 else self.DIM_D
         V1 = V1 if 0 <= V1 <= <int32_t>self.DIM_V else self.DIM_V
         H1 = H1 if 0 <= H1 <= <int32_t>self.DIM_H else self.DIM_H
         d1 = d1 if 0 <= d1 <= <int32_t>self.DIM_D else self.DIM_D
-        assert V1 > V0 and H1 > H0 and d1 > D0, "TiledVolume: The start position should be lower than the end position."
 
         cdef:
             int64_t sbv_height = V1 - V0
             int64_t sbv_width = H1 - H0
             int64_t sbv_depth = d1 - D0
-            int64_t sbv_channels
-            int64_t sbv_bytes_chan
-            cnp.ndarray npsubvol
+            int64_t sbv_channels = self.DIM_C
+            int64_t sbv_bytes_chan = self.BYTESxCHAN
+            int64_t stride_x, stride_xy, stride_xyz
+            cnp.ndarray npsubvol, tile, full
             unsigned char* subvol
             VirtualFmtMngr fmt_mngr
+            IOStats call = IOStats() if self.stats is not None else None
+            int64_t t
+            list covered = []
+
+        assert sbv_channels == 1, "TiledVolume: Multi channel not supported yet."
+        if channels is not None and list(channels) != [0]:
+            raise ValueError(f"TiledVolume: channels {channels} out of range for a single channel volume")
+        if sbv_bytes_chan == 1:
+            dt = np.dtype(np.uint8)
+        elif sbv_bytes_chan == 2:
+            dt = np.dtype(np.uint16)
+        elif sbv_bytes_chan == 4:
+            dt = np.dtype(np.float32)
+        else:
+            raise ValueError(f"TiledVolume: Unsupported Datatype {self.BYTESxCHAN}")
+        if out is None:
+            assert V1 > V0 and H1 > H0 and d1 > D0, \
+                "TiledVolume: The start position should be lower than the end position."
+            npsubvol = full = np.empty((sbv_channels, sbv_depth, sbv_height, sbv_width), dtype=dt)
+        else:
+            full = as_crop_buffer(out, (sbv_channels, rd1 - D0, rV1 - V0, rH1 - H0), dt)
+            # zero the parts beyond the volume and load the rest
+            sbv_depth, sbv_height, sbv_width = max(sbv_depth, 0), max(sbv_height, 0), max(sbv_width, 0)
+            full[:, sbv_depth:] = 0
+            full[:, :, sbv_height:] = 0
+            full[:, :, :, sbv_width:] = 0
+            if sbv_depth == 0 or sbv_height == 0 or sbv_width == 0:
+                return full
+            npsubvol = full[:, :sbv_depth, :sbv_height, :sbv_width]
+            if not rows_contiguous(npsubvol):
+                # the tile copies need contiguous rows, so load elsewhere and copy
+                npsubvol[:] = self.load_sub_volume(V0, V1, H0, H1, D0, d1)
+                return full
+        subvol = <unsigned char *> npsubvol.data
+        # the strides of the crop in pixels
+        stride_x = npsubvol.strides[2] // sbv_bytes_chan
+        stride_xy = npsubvol.strides[1] // sbv_bytes_chan
+        stride_xyz = npsubvol.strides[0] // sbv_bytes_chan
 
         subvol_area = Rect()
         subvol_area.H0 = H0
@@ -226,6 +414,7 @@ cdef class TiledVolume(VirtualVolume):
         ffmt = self.BLOCKS[0][0].get_fmt()
         if ffmt == b'Tiff3D':
             fmt_mngr = Tiff3DFmtMngr()
+            fmt_mngr.stats = call
         elif ffmt == b'Vaa3DRaw':
             raise NotImplementedError
 
@@ -235,22 +424,6 @@ cdef class TiledVolume(VirtualVolume):
                     block = self.BLOCKS[row][col]
                     if intersects_rect(block, subvol_area, intersect_area):
                         for k in range(intersect_segm.ind0, intersect_segm.ind1 + 1):
-                            if first_time:
-                                first_time = False
-                                sbv_channels = self.DIM_C
-                                sbv_bytes_chan = self.BYTESxCHAN
-                                assert sbv_channels == 1 , "TiledVolume: Multi channel not supported yet."
-                                if sbv_bytes_chan == 1:
-                                    dt = np.uint8
-                                elif sbv_bytes_chan == 2:
-                                    dt = np.uint16
-                                elif sbv_bytes_chan == 4:
-                                    dt = np.float32
-                                else:
-                                    raise ValueError(f"TiledVolume: Unsupported Datatype {self.BYTESxCHAN}")
-                                npsubvol = np.zeros((sbv_channels, sbv_depth, sbv_height, sbv_width), dtype=dt)
-                                subvol = <unsigned char *> npsubvol.data
-
                             slice_fullpath = str(self.root_dir / block.DIR_NAME /
                                                  bytes(block.FILENAMES[k]).decode('utf-8')).encode('utf-8')
 
@@ -270,15 +443,224 @@ cdef class TiledVolume(VirtualVolume):
 
                             if b"NULL.tif" in slice_fullpath:
                                 continue
-
-                            fmt_mngr.copy_file_block2buffer(slice_fullpath,
-                                                            sV0, sV1, sH0, sH1, sD0, sD1,
-                                                            subvol, sbv_bytes_chan,
-                                                            bH0 + bV0 * sbv_width + bD0 * sbv_width * sbv_height,
-                                                            sbv_width,
-                                                            sbv_width * sbv_height,
-                                                            sbv_width * sbv_height * sbv_depth)
+                            covered.append((bD0, bD0 + sD1 - sD0, bV0, bV0 + sV1 - sV0, bH0, bH0 + sH1 - sH0))
+                            if call is not None:
+                                call.tiles_touched += 1
+
+                            if self.tile_cache_bytes > 0 or self.disk_cache is not None:
+                                tile = self.cached_file_block(slice_fullpath, fmt_mngr, block.BLOCK_SIZE[k])
+                                if call is not None:
+                                    t = perf_counter_ns()
+                                fmt_mngr.copy_array_block2buffer(
+                                    tile,
+                                    sV0, sV1, sH0, sH1, sD0, sD1,
+                                    subvol, sbv_bytes_chan,
+                                    bH0 + bV0 * stride_x + bD0 * stride_xy,
+                                    stride_x,
+                                    stride_xy,
+                                    stride_xyz)
+                                if call is not None:
+                                    call.copy_ns += perf_counter_ns() - t
+                            else:
+                                fmt_mngr.copy_file_block2buffer(slice_fullpath,
+                                                                sV0, sV1, sH0, sH1, sD0, sD1,
+                                                                subvol, sbv_bytes_chan,
+                                                                bH0 + bV0 * stride_x + bD0 * stride_xy,
+                                                                stride_x,
+                                                                stride_xy,
+                                                                stride_xyz)
         else:
             raise IOError("TiledVolume: Depth interval out of range")
 
-        return npsubvol
+        zero_uncovered(npsubvol, covered)
+        if call is not None:
+            self.stats.report('TiledVolume.load_sub_volume', call)
+        return full
+
+
+def channel_index(path: Path):
+    """
+    Sort channel folders by their numbers, CH_2 before CH_10.
+    """
+    suffix = path.name[len(CHANNEL_PREFIX):]
+    return (0, int(suffix), '') if suffix.isdigit() else (1, 0, suffix)
+
+
+cdef class TiledMCVolume(VirtualVolume):
+    """
+    Multi channel tiled volume, each channel of which is a TiledVolume in a CH_ folder. The channels are opened on
+    their first request, so the folders of the channels not requested are never touched, and the requested ones are
+    decoded concurrently.
+    """
+    cdef:
+        public list channel_dirs
+        list channels
+        object channels_lock
+        int64_t tile_cache_bytes
+        IOStats stats
+        object disk_cache
+
+    def __init__(self, root_dir: Path, int64_t tile_cache_bytes=0, IOStats stats=None, disk_cache=None):
+        """
+        :param root_dir: the resolution directory containing the CH_ folders.
+        :param tile_cache_bytes: the capacity of the in-memory cache of decoded tiles of each channel, default as 0.
+        :param stats: an IOStats to accumulate the loading statistics of all the channels in, default as None.
+        :param disk_cache: a DiskChunkCache shared by the channels, default as None.
+        """
+        super(TiledMCVolume, self).__init__(root_dir)
+        self.channel_dirs = sorted([p for p in Path(root_dir).iterdir()
+                                    if p.is_dir() and p.name.startswith(CHANNEL_PREFIX)], key=channel_index)
+        if len(self.channel_dirs) == 0:
+            raise ValueError(f"TiledMCVolume: unable to find channel folders at {root_dir}")
+        self.channels = [None] * len(self.channel_dirs)
+        self.channels_lock = Lock()
+        self.tile_cache_bytes = tile_cache_bytes
+        self.stats = stats
+        self.disk_cache = disk_cache
+        self.DIM_C = len(self.channel_dirs)
+
+    def channel(self, int c) -> TiledVolume:
+        """
+        :param c: the channel index
+        :return: the TiledVolume of the channel, opened on the first call
+        """
+        cdef TiledVolume vol
+        if not 0 <= c < <int>self.DIM_C:
+            raise ValueError(f"TiledMCVolume: channel {c} out of range, the volume has {self.DIM_C} channels")
+        with self.channels_lock:
+            if self.channels[c] is None:
+                vol = TiledVolume(self.channel_dirs[c], self.tile_cache_bytes, self.stats, self.disk_cache)
+                if self.BYTESxCHAN == 0:
+                    self.VXL_V, self.VXL_H, self.VXL_D = vol.VXL_V, vol.VXL_H, vol.VXL_D
+                    self.ORG_V, self.ORG_H, self.ORG_D = vol.ORG_V, vol.ORG_H, vol.ORG_D
+                    self.DIM_V, self.DIM_H, self.DIM_D = vol.DIM_V, vol.DIM_H, vol.DIM_D
+                    self.BYTESxCHAN = vol.BYTESxCHAN
+                elif (vol.DIM_V, vol.DIM_H, vol.DIM_D, vol.BYTESxCHAN) != \
+                        (self.DIM_V, self.DIM_H, self.DIM_D, self.BYTESxCHAN):
+                    raise ValueError(f"TiledMCVolume: channel {c} differs from the others in size or pixel type")
+                self.channels[c] = vol
+            return self.channels[c]
+
+    def get_dim(self):
+        """
+        :return: (DIM_H, DIM_V, DIM_D, DIM_C), opening the first channel if none is yet
+        """
+        if self.BYTESxCHAN == 0:
+            self.opened_channel()
+        return self.DIM_H, self.DIM_V, self.DIM_D, self.DIM_C
+
+    def bytes_per_channel(self):
+        """
+        :return: BYTESxCHAN of the channels, opening the first channel if none is yet
+        """
+        return self.opened_channel().BYTESxCHAN
+
+    def opened_channel(self) -> TiledVolume:
+        """
+        :return: the TiledVolume of the first channel opened, opening channel 0 if none is yet
+        """
+        for vol in self.channels:
+            if vol is not None:
+                return vol
+        return self.channel(0)
+
+    def chunk_grid(self):
+        """
+        :return: the chunk grid of the channels, see TiledVolume.chunk_grid
+        """
+        return self.opened_channel().chunk_grid()
+
+    def tile_nbytes(self):
+        """
+        :return: the size of the largest decoded tile file of a channel
+        """
+        return self.opened_channel().tile_nbytes()
+
+    cpdef cnp.ndarray load_sub_volume(self, int32_t V0=-1, int32_t V1=-1, int32_t H0=-1,
+                                      int32_t H1=-1, int32_t D0=-1, int32_t d1=-1, cnp.ndarray out=None,
+                                      object channels=None):
+        """
+        Load a crop of the selected channels, each decoded in its own thread, see TiledVolume.load_sub_volume.
+
+        :param out: the array (C, Z, Y, X) of the selected channels to load the crop into, default as a new array
+        :param channels: the channel indices to load, default as all
+        :return: the crop (C, Z, Y, X) of the selected channels in order, a view of out if given
+        """
+        cdef list vols
+        channels = list(range(self.DIM_C)) if channels is None else [int(c) for c in channels]
+        if len(channels) == 0:
+            raise ValueError("TiledMCVolume: no channel selected")
+        vols = [self.channel(c) for c in channels]
+        if out is None:
+            V0, H0, D0 = max(0, V0), max(0, H0), max(0, D0)
+            V1 = V1 if 0 <= V1 <= <int32_t>self.DIM_V else self.DIM_V
+            H1 = H1 if 0 <= H1 <= <int32_t>self.DIM_H else self.DIM_H
+            d1 = d1 if 0 <= d1 <= <int32_t>self.DIM_D else self.DIM_D
+            assert V1 > V0 and H1 > H0 and d1 > D0, \
+                "TiledMCVolume: The start position should be lower than the end position."
+            dt = {1: np.uint8, 2: np.uint16, 4: np.float32}[self.BYTESxCHAN]
+            out = np.empty((len(vols), d1 - D0, V1 - V0, H1 - H0), dtype=dt)
+        elif out.ndim != 4 or out.shape[0] != len(vols):
+            raise ValueError(f"TiledMCVolume: out has to be 4D of {len(vols)} channels")
+        if len(vols) == 1:
+            vols[0].load_sub_volume(V0, V1, H0, H1, D0, d1, out[0])
+            return out
+        with ThreadPoolExecutor(len(vols)) as pool:
+            futures = [pool.submit(vols[i].load_sub_volume, V0, V1, H0, H1, D0, d1, out[i])
+                       for i in range(len(vols))]
+            for f in futures:
+                f.result()
+        return out
+
+
+def as_crop_buffer(out: np.ndarray, shape: tuple, dtype: np.dtype):
+    """
+    Check an output array against the crop to load into it.
+
+    :param out: the array (C, Z, Y, X), or (Z, Y, X) of a single channel
+    :param shape: the crop shape (C, Z, Y, X)
+    :param dtype: the pixel type
+    :return: the array as (C, Z, Y, X)
+    """
+    if out.ndim == 3 and shape[0] == 1 and out.shape == shape[1:]:
+        out = out[None]
+    if out.shape != shape or out.dtype != dtype:
+        raise ValueError(f"TiledVolume: out has to be of shape {shape} and type {dtype}, "
+                         f"got {out.shape} and {out.dtype}")
+    if not out.flags.writeable:
+        raise ValueError("TiledVolume: out is read-only")
+    return out
+
+
+def rows_contiguous(img: np.ndarray) -> bool:
+    """
+    :return: whether the tiles can be copied into the array row by row, i.e. its rows are contiguous and the strides
+    are whole pixels
+    """
+    return img.strides[-1] == img.itemsize and all(s % img.itemsize == 0 for s in img.strides)
+
+
+def zero_uncovered(img: np.ndarray, covered: list):
+    """
+    Zero the parts of a crop (C, Z, Y, X) outside the boxes copied from the tiles, cutting the crop into a grid by
+    the box faces so that each cell is either covered or not.
+
+    :param img: the crop
+    :param covered: the copied boxes (z0, z1, y0, y1, x0, x1)
+    """
+    if len(covered) == 0:
+        img[:] = 0
+        return
+    # the tiles don't overlap, so the boxes fill up the crop if their volumes add up to it
+    if sum((z1 - z0) * (y1 - y0) * (x1 - x0) for z0, z1, y0, y1, x0, x1 in covered) == \
+            img.shape[1] * img.shape[2] * img.shape[3]:
+        return
+    boxes = np.array(covered, dtype=np.int64)
+    shape = img.shape[1:]
+    edges = [np.unique(np.concatenate([[0, shape[i]], boxes[:, 2 * i], boxes[:, 2 * i + 1]])) for i in range(3)]
+    index = [np.searchsorted(edges[i], boxes[:, 2 * i:2 * i + 2]) for i in range(3)]
+    grid = np.zeros([len(e) - 1 for e in edges], dtype=bool)
+    for (z0, z1), (y0, y1), (x0, x1) in zip(*index):
+        grid[z0:z1, y0:y1, x0:x1] = True
+    for z, y, x in zip(*np.nonzero(~grid)):
+        img[:, edges[0][z]:edges[0][z + 1], edges[1][y]:edges[1][y + 1], edges[2][x]:edges[2][x + 1]] = 0
@@ -0,0 +1,191 @@
+"""
+Conversion of volumes into TeraFly tiled 3D tiff resolutions, a replacement of TeraConverter for this layout.
+
+The input is streamed in z slabs, each of which is written into the tiles of the highest resolution and halved into
+the next lower resolution on the fly, so the memory use is bounded by the slab and tile sizes rather than the volume.
+Tiles are written in parallel threads, as libtiff runs without the GIL.
+"""
+
+import os
+import struct
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from .config import *
+from .tiff_manage import write_tiff3d
+from ..slabs import open_slabs
+
+
+def halve(img: np.ndarray, method='mean'):
+    """
+    Halve a 3D image along all the axes, dropping the last slice of odd sizes.
+
+    :param img: 3D image (Z,Y,X)
+    :param method: 'mean' (rounded down) or 'max' of each 2x2x2 cube
+    :return: the halved image
+    """
+    z, y, x = (s // 2 for s in img.shape)
+    cubes = img[:z * 2, :y * 2, :x * 2].reshape(z, 2, y, 2, x, 2)
+    if method == 'max':
+        return cubes.max(axis=(1, 3, 5))
+    elif method == 'mean':
+        return (cubes.sum(axis=(1, 3, 5), dtype=np.uint32) // 8).astype(img.dtype)
+    raise ValueError(f"Unknown halving method {method}")
+
+
+def tile_names(starts, voxel_size: float):
+    """
+    TeraConverter names the tiles by their starts in tenths of micrometers, which falls back to voxels if the names
+    collide for very small voxels.
+    """
+    names = [f'{int(round(s * voxel_size * 10)):06d}' for s in starts]
+    if len(set(names)) < len(names):
+        names = [f'{s:06d}' for s in starts]
+    return names
+
+
+class ResolutionWriter:
+    """
+    Writer of a single resolution that takes z slabs in order, and writes the tiles whenever a full tile depth is
+    buffered.
+    """
+    def __init__(self, root: Path, shape: tuple, dtype: np.dtype, tile_shape: tuple, voxel_size: tuple, pool,
+                 compression='lzw'):
+        """
+        :param root: the directory to create the resolution in
+        :param shape: the resolution shape (Z,Y,X)
+        :param dtype: the pixel type
+        :param tile_shape: the tile shape (Z,Y,X)
+        :param voxel_size: the voxel size in x, y, z order
+        :param pool: the thread pool to write the tiles with
+        :param compression: the tiff compression
+        """
+        self.shape, self.dtype, self.tile_shape, self.voxel_size = shape, dtype, tile_shape, voxel_size
+        self.pool, self.compression = pool, compression
+        depth, height, width = shape
+        self.path = root / f'RES({height}x{width}x{depth})'
+        self.rows, self.cols = range(0, height, tile_shape[1]), range(0, width, tile_shape[2])
+        self.row_names = tile_names(self.rows, voxel_size[1])
+        self.col_names = tile_names(self.cols, voxel_size[0])
+        self.slice_names = tile_names(range(0, depth, tile_shape[0]), voxel_size[2])
+        for r in self.row_names:
+            for c in self.col_names:
+                (self.path / r / f'{r}_{c}').mkdir(parents=True, exist_ok=True)
+        self.buffer, self.buffered, self.written = [], 0, 0
+        self.pending = []
+        self.odd = None     # the unpaired slice to halve with the next slab
+
+    def push(self, slab: np.ndarray):
+        """
+        Append a slab, writing out the full tile depths buffered.
+        """
+        self.buffer.append(slab)
+        self.buffered += slab.shape[0]
+        while self.buffered >= self.tile_shape[0]:
+            self.write_slices(self.tile_shape[0])
+
+    def write_slices(self, depth: int):
+        """
+        Write the first slices in the buffer as a layer of tiles. The previous layer is waited for first, so that
+        at most one layer per resolution is held by the writing threads.
+        """
+        data = self.buffer[0] if len(self.buffer) == 1 else np.concatenate(self.buffer)
+        layer, rest = data[:depth], data[depth:]
+        self.buffer, self.buffered = ([rest] if len(rest) > 0 else []), len(rest)
+        self.wait()
+        name = self.slice_names[self.written // self.tile_shape[0]]
+        th, tw = self.tile_shape[1:]
+        for r, rn in zip(self.rows, self.row_names):
+            for c, cn in zip(self.cols, self.col_names):
+                self.pending.append(self.pool.submit(
+                    write_tiff3d, self.path / rn / f'{rn}_{cn}' / f'{rn}_{cn}_{name}.tif',
+                    layer[:, r:r + th, c:c + tw], self.compression))
+        self.written += depth
+
+    def wait(self):
+        for f in self.pending:
+            f.result()
+        self.pending = []
+
+    def close(self):
+        """
+        Write the remaining slices, wait for all the tiles and write the metadata.
+        """
+        if self.buffered > 0:
+            self.write_slices(self.buffered)
+        self.wait()
+        assert self.written == self.shape[0], "The slabs don't fill up the resolution"
+        depth, height, width = self.shape
+        vx, vy, vz = self.voxel_size
+        mdata = struct.pack('f', MDATA_BIN_FILE_VERSION)
+        mdata += struct.pack('iiifffffffffIIIHH', 1, 2, 3, vy, vx, vz, vy, vx, vz, 0., 0., 0.,
+                             height, width, depth, len(self.rows), len(self.cols))
+        for r, rn in zip(self.rows, self.row_names):
+            for c, cn in zip(self.cols, self.col_names):
+                dirname = f'{rn}/{rn}_{cn}'.encode()
+                mdata += struct.pack('IIIIIiiH', min(self.tile_shape[1], height - r),
+                                     min(self.tile_shape[2], width - c), depth, len(self.slice_names), 1, r, c,
+                                     len(dirname) + 1) + dirname + b'\0'
+                for i, zn in enumerate(self.slice_names):
+                    z = i * self.tile_shape[0]
+                    filename = f'{rn}_{cn}_{zn}.tif'.encode()
+                    mdata += struct.pack('H', len(filename) + 1) + filename + b'\0' + \
+                        struct.pack('Ii', min(self.tile_shape[0], depth - z), z)
+                mdata += struct.pack('I', self.dtype.itemsize)
+        with open(self.path / MDATA_BIN_FILE_NAME, 'wb') as f:
+            f.write(mdata)
+        with open(self.path / FORMAT_MDATA_FILE_NAME, 'w') as f:
+            f.write(TILED_FORMAT + '\n')
+
+
+def write_terafly(src, dst: os.PathLike | str, tile_shape=(256, 256, 256), n_levels=None, voxel_size=(1., 1., 1.),
+                  slab_depth=None, halving='mean', compression='lzw', num_workers=0):
+    """
+    Convert a volume into TeraFly resolutions of tiled 3D tiffs, each halved from the one above, that TiledVolume
+    reads. The input is streamed in z slabs and the lower resolutions are computed on the fly.
+
+    :param src: a 3D (Z,Y,X) or single channel 4D array, a v3draw/v3dpbd path, a TeraFly resolution path or a
+    TeraflyInterface, of uint8 or uint16
+    :param dst: the directory to create the RES(YxXxZ) resolutions in
+    :param tile_shape: the tile shape (Z,Y,X)
+    :param n_levels: the number of resolutions, default as enough halvings for the lowest one to fit in a single
+    tile in x and y
+    :param voxel_size: the voxel size of the highest resolution in x, y, z order, in micrometers
+    :param slab_depth: the number of z slices read at a time, default as the tile depth
+    :param halving: 'mean' or 'max' of each 2x2x2 cube
+    :param compression: the tiff compression, 'none', 'lzw' or 'deflate'
+    :param num_workers: number of tile writing threads, default as all cores
+    :return: the paths of the resolutions, from the highest to the lowest
+    """
+    tile_shape = tuple(int(t) for t in tile_shape)
+    slab_depth = slab_depth or tile_shape[0]
+    shape, dtype, slabs = open_slabs(src, slab_depth)
+    if dtype not in [np.uint8, np.uint16]:
+        raise ValueError(f"Unsupported pixel type {dtype}")
+    shapes = [shape]
+    while n_levels is None and max(shapes[-1][1] / tile_shape[1], shapes[-1][2] / tile_shape[2]) > 1 or \
+            n_levels is not None and len(shapes) < n_levels:
+        shapes.append(tuple(s // 2 for s in shapes[-1]))
+        if min(shapes[-1]) < 1:
+            shapes.pop()
+            break
+    dst = Path(dst)
+    with ThreadPoolExecutor(num_workers if num_workers > 0 else os.cpu_count()) as pool:
+        levels = [ResolutionWriter(dst, s, dtype, tile_shape, tuple(v * 2 ** i for v in voxel_size), pool, compression)
+                  for i, s in enumerate(shapes)]
+        for slab in slabs:
+            for i, level in enumerate(levels):
+                level.push(slab)
+                if i + 1 == len(levels):
+                    break
+                if level.odd is not None:
+                    slab = np.concatenate([level.odd, slab])
+                even = slab.shape[0] // 2 * 2
+                level.odd = slab[even:] if even < slab.shape[0] else None
+                if even == 0:
+                    break
+                # halve pairs of slices in parallel
+                slab = np.concatenate(list(pool.map(lambda z: halve(slab[z:z + 2], halving), range(0, even, 2))))
+        for level in levels:
+            level.close()
+    return [level.path for level in levels]